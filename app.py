@@ -13,6 +13,7 @@ import tempfile
 import time
 from collections import Counter
 from pathlib import Path
+from typing import Optional, Tuple
 
 import requests
 import spotipy
@@ -22,7 +23,15 @@ from pytubefix.exceptions import BotDetection
 
 from check_hardware_compat import FAIL as HARDWARE_COMPAT_FAIL
 from check_hardware_compat import check_file as check_hardware_compat
-from convert_tracks_to_mp3 import convert_to_mp3
+from convert_tracks_to_mp3 import (
+    Conversion,
+    convert_files_to_mp3,
+    convert_to_mp3,
+    get_conversion_settings,
+    plan_for_device,
+)
+from src.content_store import SOURCE_SOUNDCLOUD, SOURCE_YOUTUBE, get_content_store, get_source_key
+from src.conversion_manifest import ConversionManifest
 from src.csv_handling import read_csv, write_csv
 from src.data_handling import (
     COLUMN_ARTIST_NAME,
@@ -42,21 +51,21 @@ from src.data_handling import (
     sanitize_filename,
 )
 from src.device_profiles import DEVICE_PROFILES
+from src.download_queue import JOB_SOURCE_SOUNDCLOUD, JOB_SOURCE_YOUTUBE, DownloadQueue
 from src.file_handling import scan_directory_for_audio_files
 from src.file_metadata import (
+    FILE_EXTENSION_M4A,
     FILE_EXTENSION_MP3,
     FILE_EXTENSION_MP4,
-    SUPPORTED_FORMATS,
     get_file_bit_rate_kbps,
     prepare_metadata_tags,
     set_file_metadata_tags,
 )
+from src.match_memo import MEMO_SOURCE_YOUTUBE, MEMO_SOURCE_YOUTUBE_MUSIC, get_match_memo
+from src.metrics import phase, track_metrics
+from src.rate_limiting import rate_limiters_summary
 from src.soundcloud_download import get_audio_from_soundcloud
-from src.soundcloud_search import (
-    NoMatchingSoundcloudTrackFoundError,
-    find_best_matching_soundcloud_track,
-    search_soundcloud_tracks,
-)
+from src.source_selection import Preflight, StreamCandidate, preflight_sources
 from src.spotify_export import SPOTIFY_CLIENT_ID
 from src.spotify_export import build_login_url as build_spotify_login_url
 from src.spotify_export import complete_login as complete_spotify_login
@@ -71,12 +80,10 @@ from src.tidal_export import list_user_playlists as list_tidal_playlists
 from src.tidal_export import logout as tidal_logout
 from src.tidal_export import start_login as start_tidal_login
 from src.tidal_export import try_complete_login as try_complete_tidal_login
+from src.track_matching import find_youtube_music_match, match_tracks
+from src.transcode_planner import PLAN_TRANSCODE, TranscodeReport, get_passthrough_path
 from src.youtube_download import get_audio_from_youtube
-from src.youtube_music_search import (
-    NoMatchingYoutubeMusicVideoFoundError,
-    find_best_matching_youtube_music_video,
-    get_youtube_music_search_results,
-)
+from src.youtube_music_search import NoMatchingYoutubeMusicVideoFoundError
 from src.youtube_playlist_export import YoutubePlaylistUnavailableError
 from src.youtube_playlist_export import export_playlist_to_csv as export_youtube_playlist_to_csv
 from src.youtube_playlist_export import extract_playlist_id as extract_youtube_playlist_id
@@ -508,7 +515,10 @@ def sync_states_from_disk(download_dir: str):
         song_filename = get_song_filename(row)
         if os.path.exists(os.path.join(download_dir, song_filename + ".mp3")):
             row["State"] = STATE_CONVERTED
-        elif os.path.exists(os.path.join(download_dir, song_filename + ".mp4")):
+        elif any(
+            os.path.exists(os.path.join(download_dir, song_filename + ext))
+            for ext in (FILE_EXTENSION_M4A, FILE_EXTENSION_MP4)
+        ):
             row["State"] = STATE_DOWNLOADED
 
 
@@ -895,6 +905,11 @@ def render_unmatched_tracks_panel():
             if video_id:
                 row[COLUMN_YOUTUBE_ID] = video_id
                 row["State"] = STATE_MATCHED
+                # A hand-picked link is the best answer there is - reuse it for
+                # this track in every other playlist too, whichever search would
+                # have looked for it.
+                for memo_source in (MEMO_SOURCE_YOUTUBE_MUSIC, MEMO_SOURCE_YOUTUBE):
+                    get_match_memo().remember(row, memo_source, video_id)
                 st.rerun()
             else:
                 st.error(f"Couldn't find a Youtube video ID in that link for '{label}'.")
@@ -934,7 +949,8 @@ with options_col:
         )
         st.caption(
             f"Supports {supported_formats} · MP3 capped at {device_profile.max_mp3_kbps}kbps · "
-            f"sample rate {sample_rate_note} (output is still MP3-only — tracks that would "
+            f"sample rate {sample_rate_note} (AAC downloads the device plays are kept as .m4a "
+            f"instead of re-encoded; anything else is converted to MP3, and tracks that would "
             f"need another format to fit this device show up as warnings after download)"
         )
     artist_col, delete_col = st.columns(2)
@@ -1022,88 +1038,106 @@ def render_tracks():
 render_tracks()
 
 
-def _find_soundcloud_match(row: dict, search_strings: list) -> str:
-    """Try each query variant in order (see get_song_search_string_variants),
-    returning the first match found, or None if none of them match."""
-    for search_string in search_strings:
-        try:
-            results = search_soundcloud_tracks(search_string)
-            return find_best_matching_soundcloud_track(db_entry=row, search_results=results)
-        except NoMatchingSoundcloudTrackFoundError:
-            continue
-        except Exception as exc:
-            # SoundCloud is an unofficial API (scraped client_id, reverse-engineered
-            # endpoints) - any failure here just means falling back to YouTube,
-            # not failing the match.
-            print(f"SoundCloud search failed for '{search_string}': {exc}")
-            continue
-    return None
-
-
-def _find_youtube_music_match(row: dict, search_strings: list) -> str:
-    """Try each query variant in order (see get_song_search_string_variants),
-    returning the first match found, or None if none of them match."""
-    for search_string in search_strings:
-        try:
-            results = get_youtube_music_search_results(search_string)
-            return find_best_matching_youtube_music_video(db_entry=row, search_results=results)
-        except NoMatchingYoutubeMusicVideoFoundError:
-            continue
-    return None
-
-
 def run_matching_stage():
     pending_rows = [row for row in st.session_state.tracks if row["State"] == STATE_PENDING]
     total = len(pending_rows)
     if total == 0:
         return
-    for row in pending_rows:
-        search_strings = get_song_search_string_variants(row)
-
-        soundcloud_url = _find_soundcloud_match(row, search_strings)
+    # Rows are matched on worker threads, but only ever updated (and rendered)
+    # here on the script thread - Streamlit calls aren't safe from other threads.
+    for row, soundcloud_url, video_id in match_tracks(pending_rows):
+        # Both are kept when both sources match: downloading compares their streams.
         if soundcloud_url:
             row[COLUMN_SOUNDCLOUD_URL] = soundcloud_url
-            row["State"] = STATE_MATCHED
-            render_tracks()
-            continue
-
-        video_id = _find_youtube_music_match(row, search_strings)
         if video_id:
             row[COLUMN_YOUTUBE_ID] = video_id
+        if soundcloud_url or video_id:
             row["State"] = STATE_MATCHED
         else:
             row["State"] = STATE_NO_MATCH
         render_tracks()
 
 
-def _download_track_audio(row: dict, download_dir: str, song_filename: str) -> str:
+def _download_track_audio(
+    row: dict, download_dir: str, song_filename: str, youtube_metadata_tags: Optional[dict]
+) -> Tuple[str, bool]:
     """Download a track's audio, preferring SoundCloud when matched but falling
     back to YouTube if the SoundCloud download itself fails. Some tracks (e.g.
     ad-monetized/label-affiliated ones) list a progressive stream in their
     metadata that 404s in practice - SoundCloud only actually serves those via
     encrypted HLS, which we don't attempt to decrypt - so this is a real,
-    expected fallback path, not just a rare edge case."""
+    expected fallback path, not just a rare edge case.
+
+    A track matched on both sources isn't simply downloaded from SoundCloud:
+    both stream manifests are compared first (see source_selection.py) and the
+    better stream for its size wins, and the download reuses what the
+    comparison fetched. Either way, the chosen stream's bitrate is recorded in
+    the row, so the file doesn't need probing for it afterwards.
+
+    `youtube_metadata_tags` (for .m4a), if given, are written by the remux of a
+    YouTube download. Returns the file's path, and whether it was tagged that way."""
+
+    def record_bit_rate(candidate: StreamCandidate) -> None:
+        row[COLUMN_BIT_RATE] = str(candidate.bitrate_kbps)
+
     soundcloud_url = row.get(COLUMN_SOUNDCLOUD_URL)
+    preflight = Preflight(None, None, None)
+    if soundcloud_url and row.get(COLUMN_YOUTUBE_ID):
+        preflight = preflight_sources(soundcloud_url, get_youtube_url(row))
+        if preflight.best is not None and preflight.best.source == SOURCE_YOUTUBE:
+            print(f"YouTube offers a better stream than SoundCloud for '{song_filename}'")
+            soundcloud_url = None
     if soundcloud_url:
         try:
-            return get_audio_from_soundcloud(
-                track_url=soundcloud_url, output_dir=download_dir, filename=song_filename
+            output_filepath = get_content_store(download_dir).get_or_download(
+                get_source_key(SOURCE_SOUNDCLOUD, soundcloud_url),
+                download_dir,
+                song_filename,
+                lambda: get_audio_from_soundcloud(
+                    track_url=soundcloud_url,
+                    output_dir=download_dir,
+                    filename=song_filename,
+                    on_stream_selected=record_bit_rate,
+                    resolved_track=preflight.soundcloud_track,
+                ),
             )
+            return output_filepath, False
         except Exception as exc:
             print(f"SoundCloud download failed for '{song_filename}', falling back to YouTube: {exc}")
             row[COLUMN_SOUNDCLOUD_URL] = ""
 
     if not row.get(COLUMN_YOUTUBE_ID):
-        video_id = _find_youtube_music_match(row, get_song_search_string_variants(row))
+        video_id = find_youtube_music_match(row, get_song_search_string_variants(row))
         if video_id is None:
             raise NoMatchingYoutubeMusicVideoFoundError(
                 f"Unable to find a matching YouTube Music video for {get_song_search_string(row)}"
             )
         row[COLUMN_YOUTUBE_ID] = video_id
 
-    return get_audio_from_youtube(
-        youtube_url=get_youtube_url(row), output_dir=download_dir, filename=song_filename
+    tagged_by_download = False
+
+    def download_from_youtube() -> str:
+        nonlocal tagged_by_download
+        filepath = get_audio_from_youtube(
+            youtube_url=get_youtube_url(row),
+            output_dir=download_dir,
+            filename=song_filename,
+            on_stream_selected=record_bit_rate,
+            metadata_tags=youtube_metadata_tags,
+            yt=preflight.youtube,
+        )
+        tagged_by_download = youtube_metadata_tags is not None
+        return filepath
+
+    output_filepath = get_content_store(download_dir).get_or_download(
+        get_source_key(SOURCE_YOUTUBE, row[COLUMN_YOUTUBE_ID]),
+        download_dir,
+        song_filename,
+        download_from_youtube,
+        # Tagged by its remux, the file is never rewritten: the store can hardlink it.
+        final=youtube_metadata_tags is not None,
     )
+    return output_filepath, tagged_by_download
 
 
 def _get_target_bitrate_kbps(row: dict) -> str:
@@ -1153,6 +1187,12 @@ def run_download_stage(download_dir):
     if total == 0:
         return
 
+    # Shared with the CLIs: per-track job state in the download folder (see
+    # download_queue.py), so a run interrupted mid-stage resumes where it stopped.
+    download_queue = DownloadQueue(download_dir)
+    for row in pending_rows:
+        download_queue.enqueue(get_song_filename(row), _get_job_source(row))
+
     for retry_round in range(MAX_BOT_DETECTION_RETRIES + 1):
         if not pending_rows:
             break
@@ -1167,53 +1207,77 @@ def run_download_stage(download_dir):
             render_tracks()
 
             song_filename = get_song_filename(row)
-            existing_ext = next(
-                (
-                    ext
-                    for ext in SUPPORTED_FORMATS
-                    if os.path.exists(os.path.join(download_dir, song_filename + ext))
-                ),
-                None,
-            )
-            if existing_ext:
+            existing_filepath = download_queue.get_finished_path(song_filename)
+            if existing_filepath:
                 # A SoundCloud download already lands as mp3 (no conversion needed);
-                # a YouTube one lands as mp4 and still needs the conversion stage.
+                # a YouTube one lands as m4a and still needs the conversion stage.
+                existing_ext = os.path.splitext(existing_filepath)[1]
                 row["State"] = STATE_CONVERTED if existing_ext == FILE_EXTENSION_MP3 else STATE_DOWNLOADED
-                existing_filepath = os.path.join(download_dir, song_filename + existing_ext)
                 if not row.get(COLUMN_BIT_RATE):
                     row[COLUMN_BIT_RATE] = get_file_bit_rate_kbps(existing_filepath)
                 if existing_ext == FILE_EXTENSION_MP3 and ROW_KEY_HARDWARE_COMPAT_FINDINGS not in row:
                     _run_hardware_compat_check(row, existing_filepath)
             else:
-                try:
-                    output_filepath = _download_track_audio(row, download_dir, song_filename)
-                    row[COLUMN_BIT_RATE] = get_file_bit_rate_kbps(output_filepath)
-                    if not row.get(COLUMN_TEMPO):
-                        try:
-                            row[COLUMN_TEMPO] = str(round(estimate_tempo(output_filepath)))
-                        except Exception:
-                            # Best-effort: leave Tempo blank rather than failing an
-                            # otherwise-successful download over a bad BPM estimate.
-                            pass
-                    file_extension = os.path.splitext(output_filepath)[1]
-                    metadata_tags = prepare_metadata_tags(
-                        music_df_row=row,
-                        file_extension=file_extension,
-                        artist_in_title=artist_in_title,
-                    )
-                    set_file_metadata_tags(filepath=output_filepath, metadata_tags=metadata_tags)
-                    if file_extension == FILE_EXTENSION_MP3:
-                        _maybe_downsample_mp3(output_filepath, row)
-                        _run_hardware_compat_check(row, output_filepath)
-                except BotDetection:
-                    row["State"] = STATE_FAILED_BEFORE_RETRY
-                    still_pending.append(row)
-                except Exception as exc:
-                    source = "SoundCloud" if row.get(COLUMN_SOUNDCLOUD_URL) else "YouTube"
-                    print(f"Error downloading '{song_filename}' from {source}: {exc}")
-                    row["State"] = STATE_FAILED
-                else:
-                    row["State"] = STATE_CONVERTED if file_extension == FILE_EXTENSION_MP3 else STATE_DOWNLOADED
+                download_queue.mark_started(song_filename, _get_job_source(row))
+                with track_metrics("download", song_filename) as metrics:
+                    try:
+                        row[COLUMN_BIT_RATE] = ""
+                        # With a known tempo the tags are complete up front, so a
+                        # YouTube download can be tagged by its remux; otherwise
+                        # they're written once the tempo has been estimated.
+                        youtube_metadata_tags = (
+                            prepare_metadata_tags(
+                                music_df_row=row,
+                                file_extension=FILE_EXTENSION_M4A,
+                                artist_in_title=artist_in_title,
+                            )
+                            if row.get(COLUMN_TEMPO)
+                            else None
+                        )
+                        output_filepath, tagged_by_download = _download_track_audio(
+                            row, download_dir, song_filename, youtube_metadata_tags
+                        )
+                        if not row[COLUMN_BIT_RATE]:
+                            # Linked from the content store: no stream was picked.
+                            row[COLUMN_BIT_RATE] = get_file_bit_rate_kbps(output_filepath)
+                        if not row.get(COLUMN_TEMPO):
+                            try:
+                                with phase("tempo_estimation"):
+                                    row[COLUMN_TEMPO] = str(round(estimate_tempo(output_filepath)))
+                            except Exception:
+                                # Best-effort: leave Tempo blank rather than failing an
+                                # otherwise-successful download over a bad BPM estimate.
+                                pass
+                        file_extension = os.path.splitext(output_filepath)[1]
+                        if not tagged_by_download:
+                            metadata_tags = prepare_metadata_tags(
+                                music_df_row=row,
+                                file_extension=file_extension,
+                                artist_in_title=artist_in_title,
+                            )
+                            with phase("tagging"):
+                                set_file_metadata_tags(filepath=output_filepath, metadata_tags=metadata_tags)
+                        if file_extension == FILE_EXTENSION_MP3:
+                            # Timed as "conversion" by convert_to_mp3 itself.
+                            _maybe_downsample_mp3(output_filepath, row)
+                            with phase("hardware_compat_check"):
+                                _run_hardware_compat_check(row, output_filepath)
+                    except BotDetection as exc:
+                        row["State"] = STATE_FAILED_BEFORE_RETRY
+                        still_pending.append(row)
+                        download_queue.mark_failed(song_filename, exc, retryable=True)
+                        if metrics is not None:
+                            metrics.error = f"BotDetection: {exc}"
+                    except Exception as exc:
+                        source = "SoundCloud" if row.get(COLUMN_SOUNDCLOUD_URL) else "YouTube"
+                        print(f"Error downloading '{song_filename}' from {source}: {exc}")
+                        row["State"] = STATE_FAILED
+                        download_queue.mark_failed(song_filename, exc)
+                        if metrics is not None:
+                            metrics.error = f"{type(exc).__name__}: {exc}"
+                    else:
+                        row["State"] = STATE_CONVERTED if file_extension == FILE_EXTENSION_MP3 else STATE_DOWNLOADED
+                        download_queue.mark_done(song_filename, output_filepath)
 
             render_tracks()
 
@@ -1223,6 +1287,12 @@ def run_download_stage(download_dir):
         row["State"] = STATE_FAILED
     if pending_rows:
         render_tracks()
+    download_queue.close()
+    print(rate_limiters_summary())
+
+
+def _get_job_source(row: dict) -> str:
+    return JOB_SOURCE_SOUNDCLOUD if row.get(COLUMN_SOUNDCLOUD_URL) else JOB_SOURCE_YOUTUBE
 
 
 def run_conversion_stage(download_dir):
@@ -1231,37 +1301,92 @@ def run_conversion_stage(download_dir):
         for row in st.session_state.tracks
         if row["State"] in CONVERT_ELIGIBLE_STATES
     }
-    audio_files = list(scan_directory_for_audio_files(download_dir, {FILE_EXTENSION_MP4}))
+    audio_files = list(scan_directory_for_audio_files(
+        download_dir, {FILE_EXTENSION_M4A, FILE_EXTENSION_MP4}
+    ))
     if not audio_files:
         return
 
+    # Shared with convert_tracks_to_mp3.py: an mp3 only counts as converted if the
+    # manifest shows it came from the current source at the current bitrate.
+    manifest = ConversionManifest(download_dir)
+    # With a target device selected, files it plays as AAC skip the MP3 encode
+    # (see transcode_planner.py); the report tallies the time that saves.
+    transcode_report = TranscodeReport()
+    plans = {}
+    conversions = {}
     for filepath in audio_files:
         song_filename = os.path.splitext(os.path.basename(filepath))[0]
         row = filename_to_row.get(song_filename)
 
         mp3_path = os.path.splitext(filepath)[0] + ".mp3"
-        if os.path.exists(mp3_path):
+        target_bitrate = _get_target_bitrate_kbps(row) if row is not None else bitrate
+        output_path = None
+        if manifest.is_up_to_date(filepath, mp3_path, get_conversion_settings(target_bitrate)):
+            output_path = mp3_path
+        elif device_profile is not None:
+            plan = plan_for_device(
+                filepath, device_profile, manifest, transcode_report, delete_originals
+            )
+            if plan is None or plan.action != PLAN_TRANSCODE:
+                output_path = get_passthrough_path(filepath)
+            else:
+                plans[filepath] = plan
+        if output_path is not None:
             if row is not None:
                 row["State"] = STATE_CONVERTED
                 if not row.get(COLUMN_BIT_RATE):
-                    row[COLUMN_BIT_RATE] = get_file_bit_rate_kbps(mp3_path)
+                    row[COLUMN_BIT_RATE] = get_file_bit_rate_kbps(output_path)
                 if ROW_KEY_HARDWARE_COMPAT_FINDINGS not in row:
-                    _run_hardware_compat_check(row, mp3_path)
+                    _run_hardware_compat_check(row, output_path)
         else:
             if row is not None:
                 row["State"] = STATE_CONVERTING
-                render_tracks()
-            target_bitrate = _get_target_bitrate_kbps(row) if row is not None else bitrate
-            success = convert_to_mp3(filepath, mp3_path, target_bitrate)
             if row is not None:
-                row["State"] = STATE_CONVERTED if success else STATE_FAILED_CONVERTING
-                if success:
-                    row[COLUMN_BIT_RATE] = get_file_bit_rate_kbps(mp3_path)
-                    _run_hardware_compat_check(row, mp3_path)
-            if success and delete_originals:
-                os.remove(filepath)
+                # Tagged from the row by the conversion itself, no second pass.
+                conversion = Conversion(
+                    filepath,
+                    mp3_path,
+                    target_bitrate,
+                    prepare_metadata_tags(
+                        music_df_row=row,
+                        file_extension=FILE_EXTENSION_MP3,
+                        artist_in_title=artist_in_title,
+                    ),
+                )
+            else:
+                conversion = Conversion(filepath, mp3_path, bitrate)
+            conversions[filepath] = conversion
+    render_tracks()
+
+    # Converted on the same pool as convert_tracks_to_mp3.py (one ffmpeg per CPU);
+    # results come back here, on the script thread, so the UI is only touched here.
+    for result in convert_files_to_mp3(conversions.values()):
+        song_filename = os.path.splitext(os.path.basename(result.input_path))[0]
+        row = filename_to_row.get(song_filename)
+        success = result.error is None
+        if not success:
+            print(f"Error converting {result.input_path}:\n  {result.error}")
+        if row is not None:
+            row["State"] = STATE_CONVERTED if success else STATE_FAILED_CONVERTING
+            if success:
+                row[COLUMN_BIT_RATE] = get_file_bit_rate_kbps(result.output_path)
+                _run_hardware_compat_check(row, result.output_path)
+        if success:
+            manifest.record(
+                result.input_path,
+                result.output_path,
+                get_conversion_settings(conversions[result.input_path].bitrate),
+            )
+            if result.input_path in plans:
+                transcode_report.add_transcoded(plans[result.input_path], result.elapsed_s)
+        if success and delete_originals:
+            os.remove(result.input_path)
 
         render_tracks()
+    manifest.close()
+    if device_profile is not None:
+        print(transcode_report.summary())
 
 
 if start or run_matching_clicked or run_downloading_clicked or run_converting_clicked:
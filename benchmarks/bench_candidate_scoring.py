@@ -0,0 +1,142 @@
+"""Micro-benchmark for the candidate scoring in `find_closest_matching_result`.
+
+Compares the current tokenize-once implementation against the previous one,
+which re-ran the normalization regexes for every check on every candidate (kept
+below, verbatim apart from its name, as the reference). Both are run over the
+same synthetic db entries and candidate lists, the way the search modules call
+them - a strict duration pass, then a relaxed one - and must pick the same
+results.
+
+Usage:
+    poetry run python -m benchmarks.bench_candidate_scoring [--rows N] [--candidates N]
+"""
+import argparse
+import random
+import time
+from typing import Callable, Dict, List, Optional
+
+from src.data_handling import (
+    COLUMN_ARTIST_NAME,
+    COLUMN_TRACK_DURATION,
+    COLUMN_TRACK_NAME,
+    DURATION_THRESHOLD,
+    FALLBACK_DURATION_THRESHOLD,
+    TITLE_MATCH_THRESHOLD,
+    VERSION_FILLER_WORDS,
+    VERSION_MARKER_WORDS,
+    _all_words,
+    _normalize_search_words,
+    find_closest_matching_result,
+    get_match_tokens,
+    get_song_search_string,
+)
+
+WORDS = [
+    "night", "drive", "sun", "love", "deep", "house", "city", "lights", "dream",
+    "fire", "ocean", "echo", "gold", "moon", "rain", "summer", "shadow", "heart",
+]
+SUFFIXES = ["", " (Official Video)", " (Extended Mix)", " (Radio Edit)", " [Lyrics]", " (feat. Someone)"]
+
+
+def _legacy_is_title_match(expected: str, candidate: str, threshold: float = TITLE_MATCH_THRESHOLD) -> bool:
+    expected_words = set(_normalize_search_words(expected))
+    candidate_words = set(_normalize_search_words(candidate))
+    if not expected_words or not candidate_words:
+        return False
+    return len(expected_words & candidate_words) / len(expected_words) >= threshold
+
+
+def _legacy_has_unexpected_version_marker(expected: str, candidate: str) -> bool:
+    expected_words = set(_all_words(expected))
+    candidate_words = set(_all_words(candidate))
+    if not (candidate_words & VERSION_MARKER_WORDS) - expected_words:
+        return False
+    unexpected_words = candidate_words - expected_words - VERSION_MARKER_WORDS - VERSION_FILLER_WORDS
+    return bool(unexpected_words)
+
+
+def _legacy_find_closest_matching_result(
+    db_entry: Dict,
+    search_results: List[dict],
+    duration_key: str,
+    title_key: str,
+    duration_threshold: float,
+    title_threshold: float = TITLE_MATCH_THRESHOLD,
+) -> Optional[dict]:
+    db_duration = db_entry[COLUMN_TRACK_DURATION]
+    expected = get_song_search_string(db_entry)
+    track_name_words = set(_normalize_search_words(db_entry[COLUMN_TRACK_NAME]))
+    candidates = [
+        result
+        for result in search_results
+        if abs(db_duration - result[duration_key]) / db_duration < duration_threshold
+        and _legacy_is_title_match(expected, result[title_key], threshold=title_threshold)
+        and not _legacy_has_unexpected_version_marker(expected, result[title_key])
+        and (not track_name_words or track_name_words & set(_normalize_search_words(result[title_key])))
+    ]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda result: abs(db_duration - result[duration_key]))
+
+
+def _build_dataset(n_rows: int, n_candidates: int, seed: int = 0):
+    rng = random.Random(seed)
+    dataset = []
+    for _ in range(n_rows):
+        artist = " ".join(rng.sample(WORDS, 2)).title()
+        track = " ".join(rng.sample(WORDS, 3)).title()
+        duration = rng.randint(150, 420)
+        db_entry = {COLUMN_ARTIST_NAME: artist, COLUMN_TRACK_NAME: track, COLUMN_TRACK_DURATION: duration}
+        results = []
+        for _ in range(n_candidates):
+            title_artist = artist if rng.random() < 0.6 else " ".join(rng.sample(WORDS, 2)).title()
+            title_track = track if rng.random() < 0.6 else " ".join(rng.sample(WORDS, 3)).title()
+            results.append(
+                {
+                    "title": f"{title_artist} {title_track}{rng.choice(SUFFIXES)}",
+                    # Mostly near the real duration, so the title checks actually run.
+                    "duration_s": duration + rng.randint(-25, 25),
+                }
+            )
+        dataset.append((db_entry, results))
+    return dataset
+
+
+def _run(find: Callable, dataset) -> tuple:
+    picks = []
+    start = time.perf_counter()
+    for db_entry, results in dataset:
+        match = find(db_entry, results, "duration_s", "title", DURATION_THRESHOLD)
+        if match is None:
+            match = find(db_entry, results, "duration_s", "title", FALLBACK_DURATION_THRESHOLD)
+        picks.append(None if match is None else match["title"])
+    return time.perf_counter() - start, picks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark candidate scoring in find_closest_matching_result.")
+    parser.add_argument("--rows", type=int, default=2000, help="Number of db entries (default: 2000)")
+    parser.add_argument("--candidates", type=int, default=50, help="Search results per entry (default: 50)")
+    args = parser.parse_args()
+
+    dataset = _build_dataset(args.rows, args.candidates)
+
+    legacy_seconds, legacy_picks = _run(_legacy_find_closest_matching_result, dataset)
+    # Cold: token cache starts empty, as on a fresh run.
+    get_match_tokens.cache_clear()
+    cold_seconds, cold_picks = _run(find_closest_matching_result, dataset)
+    # Warm: every title already tokenized, as when re-matching with cached searches.
+    warm_seconds, _ = _run(find_closest_matching_result, dataset)
+
+    if cold_picks != legacy_picks:
+        raise SystemExit("Tokenize-once scoring picked different results than the legacy implementation!")
+
+    n_checked = args.rows * args.candidates
+    print(f"{args.rows} entries x {args.candidates} candidates ({n_checked} candidate checks per pass)")
+    print(f"  legacy (re-tokenize per check): {legacy_seconds * 1000:8.1f} ms")
+    print(f"  tokenize-once, cold cache:      {cold_seconds * 1000:8.1f} ms  ({legacy_seconds / cold_seconds:.1f}x)")
+    print(f"  tokenize-once, warm cache:      {warm_seconds * 1000:8.1f} ms  ({legacy_seconds / warm_seconds:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Offline benchmark for the track matcher: replays recorded search results
+through `find_best_matching_youtube_id`, `find_best_matching_youtube_music_video`
+and `find_best_matching_soundcloud_track`, with no network access at all, and
+reports throughput (rows/second) plus match precision/recall against each
+case's labeled answer.
+
+A fixture file is a JSON object with a "cases" list; each case holds the
+search "source" ("youtube", "youtube_music" or "soundcloud"), the "db_entry"
+row, the "search_results" exactly as the search function returned them, and
+the "expected" match (video ID / permalink URL), or null when none of the
+results is the right track.
+
+Usage:
+    poetry run python -m benchmarks.bench_matcher [fixtures.json ...] [--repeat N]
+    poetry run python -m benchmarks.bench_matcher --record <exportify.csv> --source youtube -o out.json
+
+--record runs the live searches once and writes a new fixture file, labeling
+each case with whatever the current matcher picks - review and correct those
+labels by hand before using it as a benchmark, or it only measures agreement
+with itself.
+"""
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+from src.data_handling import (
+    get_data_list_from_exportify_csv,
+    get_match_tokens,
+    get_song_search_string,
+)
+from src.soundcloud_search import (
+    NoMatchingSoundcloudTrackFoundError,
+    find_best_matching_soundcloud_track,
+    search_soundcloud_tracks,
+)
+from src.youtube_id_search import (
+    NoMatchingYoutubeVideoFoundError,
+    find_best_matching_youtube_id,
+    get_youtube_search_results,
+)
+from src.youtube_music_search import (
+    NoMatchingYoutubeMusicVideoFoundError,
+    find_best_matching_youtube_music_video,
+    get_youtube_music_search_results,
+)
+
+DEFAULT_FIXTURES = [os.path.join(os.path.dirname(__file__), "fixtures", "matcher_cases.json")]
+
+# source -> (search function, matcher, matcher's "no match" exception)
+SOURCES: Dict[str, Tuple[Callable, Callable, Type[Exception]]] = {
+    "youtube": (
+        get_youtube_search_results,
+        find_best_matching_youtube_id,
+        NoMatchingYoutubeVideoFoundError,
+    ),
+    "youtube_music": (
+        get_youtube_music_search_results,
+        find_best_matching_youtube_music_video,
+        NoMatchingYoutubeMusicVideoFoundError,
+    ),
+    "soundcloud": (
+        search_soundcloud_tracks,
+        find_best_matching_soundcloud_track,
+        NoMatchingSoundcloudTrackFoundError,
+    ),
+}
+
+
+def load_cases(fixture_paths: List[str]) -> List[dict]:
+    cases = []
+    for path in fixture_paths:
+        with open(path, "r", encoding="utf-8") as file:
+            cases.extend(json.load(file)["cases"])
+    return cases
+
+
+def _pick(case: dict) -> Optional[str]:
+    _, find_best_match, no_match_error = SOURCES[case["source"]]
+    try:
+        return find_best_match(db_entry=case["db_entry"], search_results=case["search_results"])
+    except no_match_error:
+        return None
+
+
+def _score(cases: List[dict], picks: List[Optional[str]]) -> Dict[str, int]:
+    counts = {"tp": 0, "fp": 0, "fn": 0, "tn": 0}
+    for case, pick in zip(cases, picks):
+        expected = case["expected"]
+        if pick is not None and pick == expected:
+            counts["tp"] += 1
+        elif pick is not None:
+            # A wrong pick is both a false positive and, if there was a right
+            # answer to find, a missed one.
+            counts["fp"] += 1
+            if expected is not None:
+                counts["fn"] += 1
+        elif expected is not None:
+            counts["fn"] += 1
+        else:
+            counts["tn"] += 1
+    return counts
+
+
+def _format_ratio(numerator: int, denominator: int) -> str:
+    return f"{numerator / denominator:6.1%}" if denominator else "   n/a"
+
+
+def run_benchmark(cases: List[dict], repeat: int) -> None:
+    picks: List[Optional[str]] = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        # Every pass starts from a cold token cache, like a fresh matching run.
+        get_match_tokens.cache_clear()
+        picks = [_pick(case) for case in cases]
+    elapsed = time.perf_counter() - start
+
+    by_source = defaultdict(list)
+    for case, pick in zip(cases, picks):
+        by_source[case["source"]].append((case, pick))
+
+    print(f"{len(cases)} case(s) x {repeat} pass(es): {len(cases) * repeat / elapsed:,.0f} rows/s")
+    print(f"{'source':<15}{'cases':>7}{'precision':>11}{'recall':>9}")
+    for source, source_cases in sorted(by_source.items()) + [("all", list(zip(cases, picks)))]:
+        counts = _score([case for case, _ in source_cases], [pick for _, pick in source_cases])
+        precision = _format_ratio(counts["tp"], counts["tp"] + counts["fp"])
+        recall = _format_ratio(counts["tp"], counts["tp"] + counts["fn"])
+        print(f"{source:<15}{len(source_cases):>7}{precision:>11}{recall:>9}")
+
+    mismatches = [(case, pick) for case, pick in zip(cases, picks) if pick != case["expected"]]
+    for case, pick in mismatches:
+        print(
+            f"  MISMATCH [{case['source']}] {get_song_search_string(case['db_entry'])}: "
+            f"expected {case['expected']}, got {pick}"
+        )
+
+
+def record_fixtures(csv_path: str, source: str, output_path: str) -> None:
+    search, _, _ = SOURCES[source]
+    rows, _ = get_data_list_from_exportify_csv(csv_path)
+    cases = []
+    for row in rows:
+        case = {
+            "source": source,
+            "db_entry": row,
+            "search_results": search(get_song_search_string(row)),
+        }
+        case["expected"] = _pick(case)
+        cases.append(case)
+    with open(output_path, "w", encoding="utf-8") as file:
+        json.dump({"cases": cases}, file, indent=2, ensure_ascii=False)
+    print(f"Recorded {len(cases)} case(s) into {output_path} - review the 'expected' labels by hand.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline speed/accuracy benchmark for the track matcher.")
+    parser.add_argument("fixtures", nargs="*", help="Fixture JSON files (default: the bundled sample fixtures)")
+    parser.add_argument("--repeat", type=int, default=200, help="Passes over the cases for timing (default: 200)")
+    parser.add_argument("--record", metavar="CSV", help="Record a new fixture file from an Exportify CSV instead")
+    parser.add_argument("--source", choices=list(SOURCES), default="youtube", help="Search source to record from")
+    parser.add_argument("-o", "--output", default="recorded_cases.json", help="Where --record writes fixtures")
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixtures(args.record, args.source, args.output)
+        return
+
+    run_benchmark(load_cases(args.fixtures or DEFAULT_FIXTURES), max(1, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,7 @@ import subprocess
 import sys
 
 from src.device_profiles import DEVICE_PROFILES, DeviceProfile
+from src.transcode_planner import scan_mp4_boxes
 
 AUDIO_EXTENSIONS = {
     ".mp3",
@@ -119,35 +120,13 @@ def _ffprobe(filepath: str) -> dict | None:
     return json.loads(result.stdout)
 
 
-def _scan_mp4_boxes(filepath: str) -> list[str]:
-    """Return the top-level MP4 box names, e.g. ['ftyp', 'moov', 'mdat']."""
-    boxes = []
-    size = os.path.getsize(filepath)
-    pos = 0
-    with open(filepath, "rb") as file:
-        while pos < size - 8:
-            file.seek(pos)
-            header = file.read(8)
-            if len(header) < 8:
-                break
-            (box_size,) = struct.unpack(">I", header[:4])
-            name = header[4:8].decode("latin1")
-            if box_size == 1:  # 64-bit box size
-                (box_size,) = struct.unpack(">Q", file.read(8))
-            if box_size < 8:
-                break
-            boxes.append(name)
-            pos += box_size
-    return boxes
-
-
 def _check_mp4(
     filepath: str, probe: dict, device_profile: DeviceProfile | None = None
 ) -> list[tuple[str, str]]:
     """Check .mp4/.m4a files: container structure and codec."""
     findings = []
 
-    boxes = _scan_mp4_boxes(filepath)
+    boxes = scan_mp4_boxes(filepath)
     if "moof" in boxes or "sidx" in boxes or "styp" in boxes:
         findings.append(
             (
@@ -1,72 +1,351 @@
 """
 Script to convert all audio files in a directory (recursively) to MP3 format using ffmpeg and the
 LAME encoder. Only files not already in MP3 format will be converted.
+
+Files are converted in parallel, one ffmpeg process per CPU by default (`-j/--jobs`): LAME
+encodes on a single core, so a one-at-a-time loop leaves the rest of the machine idle. The pool
+(`convert_files_to_mp3`) is shared with the app's conversion stage.
+
+With `--target BITRATE_OR_DEVICE=FOLDER` (repeatable), each source is decoded once and encoded to
+every target in the same ffmpeg run - e.g. a 320k archive copy and a 128k copy for a small stick -
+into separate folders mirroring the scanned directory, instead of converting in place. A device
+target only caps `--bitrate` at what that device supports.
+
+With `--device NAME`, files aren't all re-encoded: for a device that plays AAC, the transcode
+planner (src/transcode_planner.py) keeps AAC-LC downloads as .m4a and remuxes those that are only
+in the wrong container, and the run ends with how much encoding time that skipped.
 """
 
 import argparse
 import os
+import re
 import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
 from tqdm import tqdm
-from mutagen.mp3 import MP3
-from mutagen.mp4 import MP4
-from mutagen.easyid3 import EasyID3
+from mutagen import MutagenError
 from src.file_metadata import (
     extract_metadata_from_file,
+    get_ffmpeg_metadata_args,
+    get_multi_value_tags,
     prepare_metadata_tags,
     set_file_metadata_tags,
     FILE_EXTENSION_M4A,
     FILE_EXTENSION_MP3,
     FILE_EXTENSION_MP4,
+    FILE_EXTENSION_PART,
 )
+from src.conversion_manifest import ConversionManifest
+from src.device_profiles import DEVICE_PROFILES, DeviceProfile
 from src.file_handling import scan_directory_for_audio_files
+from src.metrics import phase, set_metrics_path, track_metrics
+from src.transcode_planner import (
+    PLAN_KEEP,
+    PLAN_REMUX,
+    PLAN_TRANSCODE,
+    TranscodeReport,
+    get_passthrough_path,
+    get_passthrough_settings,
+    plan_transcode,
+)
+
+DEFAULT_JOBS = os.cpu_count() or 1
+
+
+class Conversion(NamedTuple):
+    input_path: str
+    output_path: str
+    bitrate: str = "128k"
+    # Tags for the mp3 (from prepare_metadata_tags); None copies the source's own.
+    metadata_tags: Optional[dict] = None
+    # More (output_path, bitrate) pairs encoded from the same decode of the input.
+    extra_outputs: Tuple[Tuple[str, str], ...] = ()
+
+
+class ConversionTarget(NamedTuple):
+    # None for a device target: the run's --bitrate, capped at max_kbps.
+    bitrate: Optional[str]
+    output_dir: str
+    max_kbps: Optional[int] = None
 
 
-def convert_to_mp3(input_path, output_path, bitrate="128k"):
+class ConversionResult(NamedTuple):
+    input_path: str
+    output_path: str
+    # None on success.
+    error: Optional[str]
+    # Wall time of the ffmpeg run.
+    elapsed_s: float = 0.0
+
+
+def convert_to_mp3(input_path, output_path, bitrate="128k", metadata_tags=None):
     """
     Convert an audio file to MP3 format using ffmpeg and the LAME encoder.
     Overwrites output if it exists.
+
+    The tags are written by ffmpeg in the same pass: `metadata_tags` if given (as prepared by
+    prepare_metadata_tags for an mp3), else those read from an mp4/m4a source. The mp3 is only
+    re-opened (before it's renamed into place) for multi-value tags like several artists, which
+    ffmpeg can't write as separate values.
     """
+    error = _convert_to_mp3(Conversion(input_path, output_path, bitrate, metadata_tags))
+    if error is not None:
+        print(f"Error converting {input_path}:")
+        print(f"  {error}")
+        return False
+    return True
+
+
+def _convert_to_mp3(conversion):
+    """convert_to_mp3, returning the error message instead of printing it (None on success)."""
+    metadata_tags = conversion.metadata_tags
+    if metadata_tags is None:
+        metadata_tags = _get_source_metadata_tags(conversion.input_path)
+    metadata_args = get_ffmpeg_metadata_args(metadata_tags, FILE_EXTENSION_MP3)
+    multi_value_tags = get_multi_value_tags(metadata_tags)
     cmd = [
         "ffmpeg",
         "-y",  # overwrite output
         "-i",
-        input_path,
-        "-codec:a",
-        "libmp3lame",
-        "-b:a",
-        bitrate,
-        output_path,
+        conversion.input_path,
     ]
+    # Output options apply to the output file that follows them, so each output gets its own
+    # encoder settings while ffmpeg decodes the input only once for all of them.
+    # Each output is written as a .part file (hence the explicit `-f mp3`) and only renamed
+    # once ffmpeg has finished, so a killed run never leaves an mp3 that looks converted.
+    outputs = [(conversion.output_path, conversion.bitrate), *conversion.extra_outputs]
+    for output_path, bitrate in outputs:
+        cmd += [
+            "-codec:a",
+            "libmp3lame",
+            "-b:a",
+            bitrate,
+            *metadata_args,
+            "-f",
+            "mp3",
+            output_path + FILE_EXTENSION_PART,
+        ]
 
     try:
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error converting {input_path}:")
-        print(f"  {e.stderr}")
-        return False
+        with phase("conversion"):
+            subprocess.run(cmd, check=True, capture_output=True, text=True)
+        if multi_value_tags:
+            # ffmpeg writes one value per tag; several artists go in as a real multi-value
+            # ID3 frame instead, like every other mp3 tagged by this repo.
+            with phase("tagging"):
+                for output_path, _ in outputs:
+                    set_file_metadata_tags(
+                        output_path + FILE_EXTENSION_PART, multi_value_tags, FILE_EXTENSION_MP3
+                    )
+    except (subprocess.CalledProcessError, OSError, MutagenError) as e:
+        for output_path, _ in outputs:
+            if os.path.exists(output_path + FILE_EXTENSION_PART):
+                os.remove(output_path + FILE_EXTENSION_PART)
+        if isinstance(e, subprocess.CalledProcessError):
+            return e.stderr.strip() or str(e)
+        # ffmpeg itself couldn't be started (e.g. not installed).
+        return str(e)
+    for output_path, _ in outputs:
+        os.replace(output_path + FILE_EXTENSION_PART, output_path)
+    return None
+
+
+def remux_to_m4a(input_path, output_path):
+    """
+    Stream-copy the first audio track of an mp4/m4a into a clean, non-fragmented .m4a (no
+    re-encode, tags kept). `output_path` may be `input_path` itself. Returns the error message,
+    or None on success.
+    """
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-i",
+        input_path,
+        "-map",
+        "0:a:0",
+        "-c",
+        "copy",
+        "-movflags",
+        "+faststart",
+        "-f",
+        "ipod",
+        output_path + FILE_EXTENSION_PART,
+    ]
+    try:
+        with phase("remux"):
+            subprocess.run(cmd, check=True, capture_output=True, text=True)
+    except (subprocess.CalledProcessError, OSError) as e:
+        if os.path.exists(output_path + FILE_EXTENSION_PART):
+            os.remove(output_path + FILE_EXTENSION_PART)
+        if isinstance(e, subprocess.CalledProcessError):
+            return e.stderr.strip() or str(e)
+        return str(e)
+    os.replace(output_path + FILE_EXTENSION_PART, output_path)
+    return None
+
+
+def plan_for_device(filepath, device_profile, manifest, report, delete_original=False):
+    """
+    Keep or remux `filepath` for `device_profile` instead of transcoding it, where the transcode
+    planner allows, and record that in the manifest and the report. With `delete_original`, an
+    .mp4 remuxed into a new .m4a is deleted afterwards.
+
+    Returns None if the manifest shows it was already kept or remuxed (or, for an .mp4, if the .m4a
+    next to it exists: that file is planned for itself), a PLAN_KEEP/PLAN_REMUX plan
+    if that was just done (the file for the device is then get_passthrough_path(filepath)), or a
+    PLAN_TRANSCODE plan: the caller converts it to mp3 as usual and reports it with
+    report.add_transcoded. A failed remux falls back to transcoding.
+    """
+    output_path = get_passthrough_path(filepath)
+    if output_path != filepath and os.path.exists(output_path):
+        return None
+    settings = get_passthrough_settings(device_profile)
+    # Not adopted: a kept file is its own source, so it always "exists".
+    if manifest.is_up_to_date(filepath, output_path, settings, adopt=False):
+        return None
+    plan = plan_transcode(filepath, device_profile)
+    if plan.action == PLAN_REMUX:
+        error = remux_to_m4a(filepath, output_path)
+        if error is not None:
+            print(f"Could not remux {filepath}, transcoding it instead: {error.splitlines()[-1]}")
+            return plan._replace(action=PLAN_TRANSCODE, reason="remux failed")
+    if plan.action in (PLAN_KEEP, PLAN_REMUX):
+        report.add_skipped(plan)
+        if delete_original and output_path != filepath:
+            _delete_original(filepath)
+        # Recorded as its own source: later runs check a remuxed .m4a, not the .mp4.
+        manifest.record(output_path, output_path, settings)
+    return plan
+
+
+def get_conversion_settings(bitrate):
+    """The settings a conversion is recorded with in the conversion manifest."""
+    return f"libmp3lame -b:a {bitrate}"
+
 
+def _get_source_metadata_tags(input_path):
+    """
+    The mp3 tags for an mp4/m4a source's own tags (only its tag atoms are read, not the audio).
+    Other sources get none: ffmpeg already carries their tags over as they are.
+    """
     ext = os.path.splitext(input_path)[1].lower()
+    if ext not in (FILE_EXTENSION_MP4, FILE_EXTENSION_M4A):
+        return {}
     try:
-        if ext in (FILE_EXTENSION_MP4, FILE_EXTENSION_M4A):
-            metadata = extract_metadata_from_file(input_path)
-            music_df_row = {
-                "Artist Name(s)": metadata.get("artist", ""),
-                "Track Name": metadata.get("title", ""),
-                "Genres": metadata.get("genres", ""),
-                "Tempo": metadata.get("tempo", ""),
-            }
-            tags = prepare_metadata_tags(music_df_row, FILE_EXTENSION_MP3)
-            set_file_metadata_tags(output_path, tags)
+        metadata = extract_metadata_from_file(input_path)
+        music_df_row = {
+            "Artist Name(s)": metadata.get("artist", ""),
+            "Track Name": metadata.get("title", ""),
+            "Genres": metadata.get("genres", ""),
+            "Tempo": metadata.get("tempo", ""),
+        }
+        return prepare_metadata_tags(music_df_row, FILE_EXTENSION_MP3)
     except Exception as e:
-        print(
-            f"Warning: Could not copy metadata from {input_path} to {output_path}: {e}"
+        print(f"Warning: Could not read metadata from {input_path}: {e}")
+        return {}
+
+
+def convert_files_to_mp3(
+    conversions: Iterable[Conversion], jobs: int = DEFAULT_JOBS
+) -> Iterator[ConversionResult]:
+    """
+    Run each Conversion with up to `jobs` of them running at once, yielding a ConversionResult
+    as each one finishes (in completion order). Threads are enough here: the encoding happens in
+    the ffmpeg subprocesses, the threads only wait on them. Each conversion is recorded as a
+    "conversion" metrics record.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+    try:
+        futures = {
+            executor.submit(_convert_measured, conversion): conversion
+            for conversion in conversions
+        }
+        for future in as_completed(futures):
+            conversion = futures[future]
+            yield ConversionResult(conversion.input_path, conversion.output_path, *future.result())
+    finally:
+        # Not `with`: if the consumer stops early (closes the generator, or raises while
+        # handling a result), its __exit__ would block until every queued conversion had
+        # run. Queued ones are cancelled instead; the ffmpeg runs already started finish.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _convert_measured(conversion):
+    with track_metrics("conversion", os.path.basename(conversion.input_path)) as metrics:
+        start = time.perf_counter()
+        error = _convert_to_mp3(conversion)
+        elapsed_s = time.perf_counter() - start
+        if metrics is not None and error is not None:
+            metrics.error = "conversion failed"
+    return error, elapsed_s
+
+
+def parse_target(spec):
+    """
+    Parse a `--target` value, BITRATE_OR_DEVICE=FOLDER: a bitrate ("320k", or just "320"), or a
+    device profile (see src/device_profiles.py) named in full or by the start of its name, e.g.
+    "legacy". A device target doesn't pick a bitrate of its own: it converts at `--bitrate`,
+    capped at the device's highest supported mp3 bitrate (320k for every profile so far, so it
+    only matters for a `--bitrate` above that).
+    """
+    target, separator, output_dir = spec.partition("=")
+    if not separator or not target or not output_dir:
+        raise argparse.ArgumentTypeError(f"expected BITRATE_OR_DEVICE=FOLDER, got '{spec}'")
+    if re.fullmatch(r"\d+k?", target):
+        return ConversionTarget(target if target.endswith("k") else target + "k", output_dir)
+    return ConversionTarget(None, output_dir, parse_device(target).max_mp3_kbps)
+
+
+def parse_device(name) -> DeviceProfile:
+    """Parse a device profile named in full or by the start of its name, e.g. "legacy"."""
+    matching_profiles = [
+        profile
+        for profile_name, profile in DEVICE_PROFILES.items()
+        if profile_name.lower().startswith(name.lower())
+    ]
+    if len(matching_profiles) != 1:
+        raise argparse.ArgumentTypeError(
+            f"'{name}' is not exactly one of the device profiles: " + "; ".join(DEVICE_PROFILES)
         )
-    return True
+    return matching_profiles[0]
+
+
+def _get_outputs(filepath, directory, bitrate, targets) -> List[Tuple[str, str]]:
+    """(output_path, bitrate) of each mp3 this file converts to: one per target, or the one next
+    to it when there are no targets."""
+    if not targets:
+        return [(os.path.splitext(filepath)[0] + ".mp3", bitrate)]
+    relative_mp3_path = os.path.splitext(os.path.relpath(filepath, directory))[0] + ".mp3"
+    return [
+        (
+            os.path.join(target.output_dir, relative_mp3_path),
+            target.bitrate or _cap_bitrate(bitrate, target.max_kbps),
+        )
+        for target in targets
+    ]
+
+
+def _cap_bitrate(bitrate, max_kbps):
+    """`bitrate` ("192k"), lowered to `max_kbps` if it's above it."""
+    kbps = int(bitrate.rstrip("k"))
+    return f"{min(kbps, max_kbps)}k" if max_kbps else bitrate
+
+
+def _delete_original(filepath):
+    try:
+        os.remove(filepath)
+    except Exception as e:
+        print(f"Failed to delete {filepath}: {e}")
+
 
 def main():
     """
     Converts all non-MP3 audio files in a directory to MP3 format (default: 128kbps).
-    Skips files that are already in MP3 format or if an MP3 version exists.
+    Skips files that are already in MP3 format, and MP3s that the conversion manifest (see
+    src/conversion_manifest.py) shows are up to date.
     """
     parser = argparse.ArgumentParser(
         description="Convert all audio files in a directory to MP3 format."
@@ -87,7 +366,41 @@ def main():
         action="store_true",
         help="Delete original files after conversion.",
     )
+    parser.add_argument(
+        "--target",
+        dest="targets",
+        action="append",
+        type=parse_target,
+        metavar="BITRATE_OR_DEVICE=FOLDER",
+        help="Write the MP3s into FOLDER instead of next to the originals, at this bitrate "
+        "(e.g. 320k), or at --bitrate capped at what this device profile supports (e.g. "
+        "legacy). Repeat for several targets: each file is decoded once for all of them.",
+    )
+    parser.add_argument(
+        "--device",
+        type=parse_device,
+        metavar="NAME",
+        help="Device profile to convert for (e.g. legacy): files it plays as AAC are kept or "
+        "remuxed to .m4a instead of re-encoded, the rest are converted to MP3 at --bitrate.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"Number of files to convert at once (default: number of CPUs, {DEFAULT_JOBS})",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="PATH",
+        help="Append per-track timing metrics to this JSONL file "
+        "(see summarize_metrics.py)",
+    )
     args = parser.parse_args()
+    if args.device is not None and args.targets:
+        parser.error("--device converts in place, it can't be combined with --target")
+    if args.metrics:
+        set_metrics_path(args.metrics)
     directory = args.directory
     bitrate = args.bitrate
     delete_originals = args.delete_originals
@@ -98,19 +411,69 @@ def main():
         )
     )
     print(f"Found {len(audio_files)} non-MP3 audio files.")
-    for filepath in tqdm(audio_files):
-        song_filename = os.path.basename(filepath)
-        print(f"\nConverting: {song_filename}")
-        mp3_path = os.path.splitext(filepath)[0] + ".mp3"
-        if os.path.exists(mp3_path):
-            continue  # Skip if MP3 already exists
-        conversion_success = convert_to_mp3(filepath, mp3_path, bitrate)
-        if delete_originals and conversion_success:
-            try:
-                os.remove(filepath)
-            except Exception as e:
-                print(f"Failed to delete {filepath}: {e}")
+    manifest = ConversionManifest(directory)
+    report = TranscodeReport()
+    plans = {}
+    conversions = {}
+    for filepath in audio_files:
+        outputs = [
+            (output_path, output_bitrate)
+            for output_path, output_bitrate in _get_outputs(
+                filepath, directory, bitrate, args.targets
+            )
+            if not manifest.is_up_to_date(
+                filepath, output_path, get_conversion_settings(output_bitrate)
+            )
+        ]
+        if not outputs:
+            continue  # Skip if every MP3 is up to date
+        if args.device is not None:
+            plan = plan_for_device(filepath, args.device, manifest, report, delete_originals)
+            if plan is None:
+                continue  # Kept or remuxed on an earlier run
+            if plan.action != PLAN_TRANSCODE:
+                print(f"{plan.action.capitalize()}: {os.path.basename(filepath)} ({plan.reason})")
+                continue
+            plans[filepath] = plan
+        for output_path, _ in outputs:
+            os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        (mp3_path, output_bitrate), *extra_outputs = outputs
+        conversions[filepath] = Conversion(
+            filepath, mp3_path, output_bitrate, extra_outputs=tuple(extra_outputs)
+        )
+    n_passed_through = report.n_kept + report.n_remuxed
+    print(f"{len(audio_files) - len(conversions) - n_passed_through} file(s) already up to date.")
+
+    failures = []
+    results = convert_files_to_mp3(conversions.values(), args.jobs)
+    for result in tqdm(results, total=len(conversions)):
+        song_filename = os.path.basename(result.input_path)
+        if result.error is not None:
+            print(f"\nFailed to convert: {song_filename}")
+            failures.append(result)
+            continue
+        print(f"\nConverted: {song_filename}")
+        if result.input_path in plans:
+            report.add_transcoded(plans[result.input_path], result.elapsed_s)
+        conversion = conversions[result.input_path]
+        for output_path, output_bitrate in (
+            (conversion.output_path, conversion.bitrate),
+            *conversion.extra_outputs,
+        ):
+            manifest.record(
+                result.input_path, output_path, get_conversion_settings(output_bitrate)
+            )
+        if delete_originals:
+            _delete_original(result.input_path)
+    manifest.close()
     print("Conversion complete.")
+    if args.device is not None:
+        print(report.summary())
+    if failures:
+        print(f"{len(failures)} conversion(s) failed:")
+        for result in failures:
+            print(f"  {result.input_path}: {result.error.splitlines()[-1]}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -3,6 +3,8 @@ creates a csv with youtube IDs for the found songs."""
 import argparse
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Optional
 
 from tqdm import tqdm
 
@@ -12,12 +14,24 @@ from src.data_handling import (
     get_data_list_from_exportify_csv,
     get_song_search_string,
 )
+from src.match_journal import MatchJournal, get_journal_key
+from src.match_memo import (
+    MEMO_SOURCE_YOUTUBE,
+    NO_MATCH,
+    get_match_memo,
+    set_match_memo_bypass,
+)
+from src.metrics import set_metrics_path, track_metrics
+from src.rate_limiting import rate_limiters_summary
+from src.search_cache import get_search_cache, set_search_cache_bypass
 from src.youtube_id_search import (
     NoMatchingYoutubeVideoFoundError,
     find_best_matching_youtube_id,
     get_youtube_search_results,
 )
 
+DEFAULT_JOBS = 4
+
 
 def get_output_filename(input_filename: str, with_ids: bool) -> str:
     """Generate output filename for the CSV files: with and without Youtube IDs"""
@@ -34,6 +48,42 @@ def get_output_filename(input_filename: str, with_ids: bool) -> str:
     return modified_path
 
 
+def get_journal_filename(input_filename: str) -> str:
+    """Checkpoint journal for this input file, next to it (see match_journal.py)."""
+    return os.path.splitext(input_filename)[0] + "_journal.jsonl"
+
+
+def find_youtube_id(row: Dict) -> str:
+    """Search Youtube for one song and pick the best match. Raises
+    NoMatchingYoutubeVideoFoundError if none of the results qualify.
+    Tracks already decided for another playlist are answered from the match
+    memo without searching. Safe to run from several worker threads at once."""
+    with track_metrics("matching", get_song_search_string(row)):
+        return _find_youtube_id(row)
+
+
+def _find_youtube_id(row: Dict) -> str:
+    memo = get_match_memo()
+    remembered = memo.lookup(row, MEMO_SOURCE_YOUTUBE)
+    if remembered == NO_MATCH:
+        raise NoMatchingYoutubeVideoFoundError(
+            f"Unable to find a matching youtube video for {get_song_search_string(row)} "
+            "(remembered from an earlier run)"
+        )
+    if remembered:
+        return remembered
+
+    search_string = get_song_search_string(row)
+    search_results = get_youtube_search_results(search_string)
+    try:
+        video_id = find_best_matching_youtube_id(db_entry=row, search_results=search_results)
+    except NoMatchingYoutubeVideoFoundError:
+        memo.remember(row, MEMO_SOURCE_YOUTUBE, None)
+        raise
+    memo.remember(row, MEMO_SOURCE_YOUTUBE, video_id)
+    return video_id
+
+
 def main():
     """Parse the CSV exported from exportify, find song youtube IDs and
     write the results into CSVs"""
@@ -44,6 +94,33 @@ def main():
 
     parser.add_argument("file_path", help="Path to a CSV file from Exportify", type=str)
 
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always search online, ignoring (and not updating) the on-disk search cache "
+        "and the cross-playlist match memo",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"Number of songs to search for concurrently (default: {DEFAULT_JOBS})",
+    )
+
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="Discard the checkpoint journal from a previous run and search every song again",
+    )
+
+    parser.add_argument(
+        "--metrics",
+        metavar="PATH",
+        help="Append per-song timing metrics to this JSONL file (see summarize_metrics.py)",
+    )
+
     args = parser.parse_args()
     if not args.file_path:
         print("Use -f to specify the path to the CSV file.")
@@ -51,27 +128,68 @@ def main():
     else:
         input_filepath = args.file_path
 
+    if args.metrics:
+        set_metrics_path(args.metrics)
+
+    if args.no_cache:
+        set_search_cache_bypass(True)
+        set_match_memo_bypass(True)
+
     # Read CSV file
     music_df, column_names = get_data_list_from_exportify_csv(filepath=input_filepath)
 
+    # Every decision is appended to the journal as soon as it's made, so an
+    # interrupted run resumes from there instead of searching everything again.
+    journal = MatchJournal(get_journal_filename(input_filepath))
+    if args.fresh:
+        journal.reset()
+    decisions: Dict[str, Optional[str]] = journal.load()
+    pending_rows = [row for row in music_df if get_journal_key(row) not in decisions]
+    if len(pending_rows) < len(music_df):
+        print(
+            f"Resuming from {journal.path}: {len(music_df) - len(pending_rows)} song(s) "
+            "already decided in a previous run."
+        )
+
     print("Finding Youtube IDs for the songs...")
 
+    # Searches run concurrently (network latency dominates, not CPU) but are paced
+    # per source by the search modules' own rate limiters. The output CSVs are
+    # built from the decisions afterwards, in input order, regardless of which
+    # search happens to finish first.
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = {executor.submit(find_youtube_id, row): row for row in pending_rows}
+        try:
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                key = get_journal_key(futures[future])
+                try:
+                    decisions[key] = future.result()
+                except NoMatchingYoutubeVideoFoundError as error:
+                    print(error)
+                    decisions[key] = None
+                journal.append(key, decisions[key])
+        except BaseException:
+            # Any other failure (or Ctrl-C) aborts the run, same as the serial loop
+            # did - don't sit through every still-queued search first. Everything
+            # decided so far is already safe in the journal.
+            executor.shutdown(cancel_futures=True)
+            raise
+        finally:
+            journal.close()
+
     row_list_with_ids = list()
     row_list_missing_ids = list()
 
-    for row in tqdm(music_df):
-        search_string = get_song_search_string(row)
-        search_results = get_youtube_search_results(search_string)
-        try:
-            video_id = find_best_matching_youtube_id(
-                db_entry=row, search_results=search_results
-            )
-        except NoMatchingYoutubeVideoFoundError as error:
-            print(error)
-            row_list_missing_ids.append(row)
-        else:
+    for row in music_df:
+        video_id = decisions[get_journal_key(row)]
+        if video_id:
             row[COLUMN_YOUTUBE_ID] = video_id
             row_list_with_ids.append(row)
+        else:
+            row_list_missing_ids.append(row)
+
+    print(get_search_cache().stats_summary())
+    print(rate_limiters_summary())
 
     filename_with_ids = get_output_filename(input_filepath, with_ids=True)
     write_csv(
@@ -88,6 +206,10 @@ def main():
             fieldnames=column_names,
         )
 
+    # The results are in the CSVs now; a later run should search afresh rather
+    # than replay this run's decisions.
+    journal.reset()
+
 
 if __name__ == "__main__":
     main()
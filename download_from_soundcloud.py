@@ -3,16 +3,14 @@ import argparse
 import os
 import sys
 
+from src.content_store import SOURCE_SOUNDCLOUD, get_content_store, get_source_key
 from src.data_handling import (
     COLUMN_ARTIST_NAME,
     COLUMN_TRACK_NAME,
     sanitize_filename,
 )
-from src.file_metadata import (
-    SUPPORTED_FORMATS,
-    prepare_metadata_tags,
-    set_file_metadata_tags,
-)
+from src.download_queue import JOB_SOURCE_SOUNDCLOUD, DownloadQueue
+from src.file_metadata import prepare_metadata_tags, set_file_metadata_tags
 from src.soundcloud_download import (
     get_audio_from_soundcloud,
     get_soundcloud_track_info,
@@ -46,8 +44,10 @@ def main():
     os.makedirs(args.output_dir, exist_ok=True)
     print("Starting downloads into ", args.output_dir)
 
+    download_queue = DownloadQueue(args.output_dir)
     n_errors = 0
     for url in args.urls:
+        song_filename = None
         try:
             track_info = get_soundcloud_track_info(url)
             music_df_row = {
@@ -59,17 +59,20 @@ def main():
             )
 
             # Skip the track if it was already downloaded in a previous run
-            if any(
-                os.path.exists(os.path.join(args.output_dir, song_filename + ext))
-                for ext in SUPPORTED_FORMATS
-            ):
+            if download_queue.get_finished_path(song_filename):
                 print(f"Skipping '{song_filename}', already downloaded.")
                 continue
 
-            output_filepath = get_audio_from_soundcloud(
-                track_url=url,
-                output_dir=args.output_dir,
-                filename=song_filename,
+            download_queue.mark_started(song_filename, JOB_SOURCE_SOUNDCLOUD)
+            output_filepath = get_content_store(args.output_dir).get_or_download(
+                get_source_key(SOURCE_SOUNDCLOUD, url),
+                args.output_dir,
+                song_filename,
+                lambda: get_audio_from_soundcloud(
+                    track_url=url,
+                    output_dir=args.output_dir,
+                    filename=song_filename,
+                ),
             )
             file_extension = os.path.splitext(output_filepath)[1]
             metadata_tags = prepare_metadata_tags(
@@ -80,10 +83,14 @@ def main():
             set_file_metadata_tags(
                 filepath=output_filepath, metadata_tags=metadata_tags
             )
+            download_queue.mark_done(song_filename, output_filepath)
         except Exception as error:
             n_errors += 1
             print(f"Error downloading {url}: {error}")
+            if song_filename is not None:
+                download_queue.mark_failed(song_filename, error)
 
+    download_queue.close()
     print("Successfully finished song downloads.\n")
     if n_errors:
         print(f"{n_errors} download(s) failed.")
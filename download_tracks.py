@@ -4,39 +4,90 @@ import os
 import random
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from pytubefix.exceptions import BotDetection
 from tqdm import tqdm
 
+from src.content_store import SOURCE_YOUTUBE, get_content_store, get_source_key
 from src.data_handling import (
+    COLUMN_YOUTUBE_ID,
     get_data_list_from_csv_with_ids,
     get_song_filename,
     get_youtube_url,
 )
-from src.file_metadata import (
-    SUPPORTED_FORMATS,
-    prepare_metadata_tags,
-    set_file_metadata_tags,
-)
+from src.download_queue import JOB_SOURCE_YOUTUBE, DownloadQueue
+from src.file_metadata import FILE_EXTENSION_M4A, prepare_metadata_tags, set_file_metadata_tags
+from src.metrics import phase, set_metrics_path, track_metrics
+from src.rate_limiting import rate_limiters_summary
 from src.youtube_download import get_audio_from_youtube
 
 MAX_BOT_DETECTION_RETRIES = 3
 RETRY_BACKOFF_BASE_SECONDS = 5
-
-
-def _download_and_tag(row: dict, download_dir: str, artist_in_title: bool) -> None:
-    """Download one track and write its metadata tags. Raises BotDetection on transient
-    bot-detection failures so the caller can retry it in a later round."""
+DEFAULT_JOBS = 1
+
+
+def _download_and_tag(
+    row: dict,
+    download_dir: str,
+    download_queue: DownloadQueue,
+    artist_in_title: bool,
+    audio_only_first: bool = True,
+) -> None:
+    """Download one track and write its metadata tags, recording the outcome in the
+    download queue. Raises BotDetection on transient bot-detection failures so the
+    caller can retry it in a later round.
+
+    A downloaded track is tagged by the remux that writes it, so it's final as
+    downloaded and hardlinked into the content store; only one copied from the
+    content store is opened again to tag it."""
     song_filename = get_song_filename(row)
     youtube_url = get_youtube_url(row)
-    output_filepath = get_audio_from_youtube(
-        youtube_url=youtube_url, output_dir=download_dir, filename=song_filename
-    )
-    file_extension = os.path.splitext(output_filepath)[1]
     metadata_tags = prepare_metadata_tags(
-        music_df_row=row, file_extension=file_extension, artist_in_title=artist_in_title
+        music_df_row=row, file_extension=FILE_EXTENSION_M4A, artist_in_title=artist_in_title
     )
-    set_file_metadata_tags(filepath=output_filepath, metadata_tags=metadata_tags)
+    tagged_by_download = False
+
+    def download() -> str:
+        nonlocal tagged_by_download
+        filepath = get_audio_from_youtube(
+            youtube_url=youtube_url,
+            output_dir=download_dir,
+            filename=song_filename,
+            audio_only_first=audio_only_first,
+            metadata_tags=metadata_tags,
+        )
+        tagged_by_download = True
+        return filepath
+
+    download_queue.mark_started(song_filename, JOB_SOURCE_YOUTUBE)
+    try:
+        with track_metrics("download", song_filename):
+            output_filepath = get_content_store(download_dir).get_or_download(
+                get_source_key(SOURCE_YOUTUBE, row[COLUMN_YOUTUBE_ID]),
+                download_dir,
+                song_filename,
+                download,
+                final=True,
+            )
+            if not tagged_by_download:
+                file_extension = os.path.splitext(output_filepath)[1]
+                with phase("tagging"):
+                    set_file_metadata_tags(
+                        filepath=output_filepath,
+                        metadata_tags=prepare_metadata_tags(
+                            music_df_row=row,
+                            file_extension=file_extension,
+                            artist_in_title=artist_in_title,
+                        ),
+                    )
+    except BotDetection as error:
+        download_queue.mark_failed(song_filename, error, retryable=True)
+        raise
+    except Exception as error:
+        download_queue.mark_failed(song_filename, error)
+        raise
+    download_queue.mark_done(song_filename, output_filepath)
 
 
 def main():
@@ -56,6 +107,27 @@ def main():
         help="Include artist name in track title metadata (format: 'ARTIST - TRACK TITLE')"
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"Number of tracks to download concurrently (default: {DEFAULT_JOBS})",
+    )
+
+    parser.add_argument(
+        "--video-first",
+        action="store_true",
+        help="Download the full video and extract its audio, only falling back to the "
+        "audio-only stream on failure (slower, uses far more bandwidth)",
+    )
+
+    parser.add_argument(
+        "--metrics",
+        metavar="PATH",
+        help="Append per-track timing metrics to this JSONL file (see summarize_metrics.py)",
+    )
+
     args = parser.parse_args()
     if not args.file_path:
         print("Use -f to specify the path to the CSV file.")
@@ -63,6 +135,9 @@ def main():
     else:
         input_filepath = args.file_path
 
+    if args.metrics:
+        set_metrics_path(args.metrics)
+
     # Create directory with the same name as the input file,
     # this is the destination folder for the downloads
     input_song_list_file, _ = os.path.splitext(input_filepath)
@@ -74,6 +149,12 @@ def main():
     # Read CSV file
     pending_rows = get_data_list_from_csv_with_ids(input_filepath)
 
+    # Per-track job state lives in the download folder (see download_queue.py), so
+    # an interrupted run picks up exactly where it stopped.
+    download_queue = DownloadQueue(download_dir)
+    for row in pending_rows:
+        download_queue.enqueue(get_song_filename(row), JOB_SOURCE_YOUTUBE)
+
     for retry_round in range(MAX_BOT_DETECTION_RETRIES + 1):
         if not pending_rows:
             break
@@ -86,29 +167,52 @@ def main():
             )
             time.sleep(delay)
 
-        still_pending = []
-        for row in tqdm(pending_rows, desc=f"Round {retry_round + 1}"):
-            song_filename = get_song_filename(row)
-            # Skip the track if it was already downloaded in a previous run
-            if any(
-                os.path.exists(os.path.join(download_dir, song_filename + ext))
-                for ext in SUPPORTED_FORMATS
-            ):
-                print(f"Skipping '{song_filename}', already downloaded.")
-                continue
-
-            try:
-                _download_and_tag(row, download_dir, args.ait)
-            except BotDetection:
-                still_pending.append(row)
-            except Exception as error:
-                print(f"Error downloading {song_filename}: {error}")
-        pending_rows = still_pending
+        bot_detected_row_ids = set()
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor, tqdm(
+            total=len(pending_rows), desc=f"Round {retry_round + 1}"
+        ) as progress_bar:
+            futures = {}
+            queued_filenames = set()
+            for row in pending_rows:
+                song_filename = get_song_filename(row)
+                # Skip the track if it was already downloaded in a previous run - or
+                # is a duplicate row of one already queued in this round, which the
+                # serial loop would find done by the time it got to it.
+                if song_filename in queued_filenames or download_queue.get_finished_path(
+                    song_filename
+                ):
+                    print(f"Skipping '{song_filename}', already downloaded.")
+                    progress_bar.update()
+                    continue
+                queued_filenames.add(song_filename)
+                future = executor.submit(
+                    _download_and_tag,
+                    row,
+                    download_dir,
+                    download_queue,
+                    args.ait,
+                    not args.video_first,
+                )
+                futures[future] = row
+
+            for future in as_completed(futures):
+                row = futures[future]
+                try:
+                    future.result()
+                except BotDetection:
+                    bot_detected_row_ids.add(id(row))
+                except Exception as error:
+                    print(f"Error downloading {get_song_filename(row)}: {error}")
+                progress_bar.update()
+        # Retry rounds keep the input order, regardless of completion order.
+        pending_rows = [row for row in pending_rows if id(row) in bot_detected_row_ids]
 
     if pending_rows:
         song_names = ", ".join(get_song_filename(row) for row in pending_rows)
         print(f"\n{len(pending_rows)} track(s) failed after repeated bot detection: {song_names}")
 
+    download_queue.close()
+    print(rate_limiters_summary())
     print("Successfully finished song downloads.\n")
 
 
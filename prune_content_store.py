@@ -0,0 +1,50 @@
+"""Script to shrink the content store shared by the playlist folders under a
+destination root (see src/content_store.py) to a size limit, removing the least
+recently used tracks first. Playlist folders keep their own files; a removed
+track is just downloaded again the next time a playlist needs it."""
+import argparse
+import os
+import re
+import sys
+
+from src.content_store import CONTENT_STORE_DIRNAME, ContentStore
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+_SIZE_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", re.IGNORECASE)
+
+
+def parse_size(size: str) -> int:
+    """Bytes in a size like "500M" or "20G" (binary units)."""
+    match = _SIZE_PATTERN.fullmatch(size.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"not a size: {size!r} (e.g. 500M, 20G)")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Remove the least recently used tracks from a content store until it "
+        "fits a size limit."
+    )
+    parser.add_argument(
+        "destination_root",
+        help=f"Folder holding the playlist folders (and their shared {CONTENT_STORE_DIRNAME}/)",
+    )
+    parser.add_argument(
+        "--max-size",
+        type=parse_size,
+        required=True,
+        help="Size to shrink the store to, e.g. 500M or 20G (0 empties it)",
+    )
+    args = parser.parse_args()
+
+    root = os.path.join(args.destination_root, CONTENT_STORE_DIRNAME)
+    if not os.path.isdir(root):
+        print(f"No content store in {args.destination_root}")
+        sys.exit(1)
+    n_removed, freed_bytes = ContentStore(root).prune(args.max_size)
+    print(f"Removed {n_removed} track(s), freeing {freed_bytes / 1024**2:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+"""Module for locating the on-disk caches kept between runs: the search cache,
+the match memo and the SoundCloud client_id. They all live in one directory -
+the current working directory by default, as before, or the directory named by
+MUSIC_DOWNLOADER_CACHE_DIR - so the CLIs and the web UI share them no matter
+where they're started from, and none of them ends up scattered across whatever
+folder a script happened to run in."""
+import os
+
+CACHE_DIR_ENV = "MUSIC_DOWNLOADER_CACHE_DIR"
+
+
+def get_cache_path(filename: str) -> str:
+    """Where the cache file `filename` lives, creating the cache directory if needed.
+    Read at call time, so setting the environment variable after import works too."""
+    cache_dir = os.environ.get(CACHE_DIR_ENV) or os.curdir
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, filename)
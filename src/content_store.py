@@ -0,0 +1,247 @@
+"""Module for the content store shared by every playlist folder under one
+destination root. The same track (same Youtube ID or SoundCloud URL) tends to
+be in many playlists; instead of downloading it again for each of them, the
+first download is stored once under `<destination root>/.content_store/` and
+every playlist folder gets its own copy of it.
+
+Stored files are content-addressed: `objects/<sha256[:2]>/<sha256><ext>`, the
+hash being that of the file as downloaded, with an SQLite index mapping each
+source ID to its object. Two source IDs that resolve to identical bytes share
+one object.
+
+Files copied out of the store are copies, not hardlinks: each playlist tags its
+file in place (artist spelling, --ait titles, tempo and genres differ between
+playlists), and tagging through a hardlink would rewrite the stored object -
+breaking its content address - and every other playlist's file with it. Where
+the filesystem supports reflinks (btrfs, XFS), the copy is a copy-on-write
+clone that shares the data until one side is written to; elsewhere it's a plain
+copy. Going into the store is different: a download that is already in its
+final form (tagged by the download itself, never rewritten afterwards) is
+hardlinked in, so storing it costs no extra write at all.
+
+Storage cost: without reflinks, every track occupies its size once in the store
+(unless hardlinked in) plus once per playlist folder holding it, and adding a
+download re-reads it once to hash it. The store only grows on its own;
+`prune_content_store.py` (ContentStore.prune) shrinks it to a size limit by
+removing the least recently used objects. Playlist folders keep their files -
+a pruned track is simply downloaded again the next time it's needed."""
+import contextlib
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+CONTENT_STORE_DIRNAME = ".content_store"
+CONTENT_STORE_INDEX_FILENAME = "index.sqlite3"
+HASH_CHUNK_SIZE = 1024 * 1024
+# Linux ioctl cloning a whole file's extents copy-on-write (a reflink).
+FICLONE = 0x40049409
+
+SOURCE_YOUTUBE = "youtube"
+SOURCE_SOUNDCLOUD = "soundcloud"
+
+
+def get_source_key(source: str, source_id: str) -> str:
+    """Index key for a track on a source, e.g. "youtube:dQw4w9WgXcQ"."""
+    return f"{source}:{source_id}"
+
+
+class ContentStore:
+    """Content-addressed store of downloaded files, safe to share between threads."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        # One lock per source key, so two workers asked for the same track (e.g.
+        # duplicate rows in a playlist) download it once: the second one waits
+        # and then links the first one's result.
+        self._source_key_locks: Dict[str, threading.Lock] = {}
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(self.root, exist_ok=True)
+            self._connection = sqlite3.connect(
+                os.path.join(self.root, CONTENT_STORE_INDEX_FILENAME), check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                " source_key TEXT PRIMARY KEY,"
+                " sha256 TEXT NOT NULL,"
+                " extension TEXT NOT NULL,"
+                " last_used_at REAL NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in self._connection.execute("PRAGMA table_info(objects)")}
+            if "last_used_at" not in columns:  # An index from before pruning existed.
+                self._connection.execute(
+                    "ALTER TABLE objects ADD COLUMN last_used_at REAL NOT NULL DEFAULT 0"
+                )
+            self._connection.commit()
+        return self._connection
+
+    def _get_source_key_lock(self, source_key: str) -> threading.Lock:
+        with self._lock:
+            return self._source_key_locks.setdefault(source_key, threading.Lock())
+
+    def _get_object_path(self, sha256: str, extension: str) -> str:
+        return os.path.join(self.root, "objects", sha256[:2], sha256 + extension)
+
+    def lookup(self, source_key: str) -> Optional[str]:
+        """Path of the stored object for this source key, or None if there isn't one."""
+        with self._lock:
+            entry = self._get_connection().execute(
+                "SELECT sha256, extension FROM objects WHERE source_key = ?", (source_key,)
+            ).fetchone()
+        if entry is None:
+            return None
+        object_path = self._get_object_path(*entry)
+        return object_path if os.path.exists(object_path) else None
+
+    def _mark_used(self, source_key: str) -> None:
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "UPDATE objects SET last_used_at = ? WHERE source_key = ?",
+                (time.time(), source_key),
+            )
+            connection.commit()
+
+    def add(self, source_key: str, filepath: str, final: bool = False) -> str:
+        """Store a freshly downloaded file under `source_key` (it stays where it is
+        too). With `final`, the file is hardlinked into the store rather than
+        copied - only for files that are never modified in place afterwards.
+        Returns the stored object's path."""
+        sha256 = hash_file(filepath)
+        extension = os.path.splitext(filepath)[1]
+        object_path = self._get_object_path(sha256, extension)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            _store_file(filepath, object_path, final)
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+                (source_key, sha256, extension, time.time()),
+            )
+            connection.commit()
+        return object_path
+
+    def prune(self, max_bytes: int) -> Tuple[int, int]:
+        """Remove the least recently used objects until the store holds at most
+        `max_bytes`. Returns (objects removed, bytes freed). An object still
+        hardlinked to a playlist's file takes no space of its own - removing it
+        would free nothing - so it doesn't count and is kept."""
+        with self._lock:
+            objects = self._get_connection().execute(
+                "SELECT sha256, extension FROM objects"
+                " GROUP BY sha256, extension ORDER BY MAX(last_used_at) DESC"
+            ).fetchall()
+        kept_bytes = 0
+        n_removed = 0
+        freed_bytes = 0
+        for sha256, extension in objects:
+            object_path = self._get_object_path(sha256, extension)
+            try:
+                stat = os.stat(object_path)
+                size = stat.st_size if stat.st_nlink == 1 else 0
+            except FileNotFoundError:
+                size = 0
+            if kept_bytes + size <= max_bytes:
+                kept_bytes += size
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(object_path)
+            with self._lock:
+                connection = self._get_connection()
+                connection.execute(
+                    "DELETE FROM objects WHERE sha256 = ? AND extension = ?", (sha256, extension)
+                )
+                connection.commit()
+            n_removed += 1
+            freed_bytes += size
+        return n_removed, freed_bytes
+
+    def get_or_download(
+        self,
+        source_key: str,
+        output_dir: str,
+        filename: str,
+        download: Callable[[], str],
+        final: bool = False,
+    ) -> str:
+        """Put the track for `source_key` at `output_dir/filename<ext>`: copied from
+        the store if it's already there, else obtained with `download()` (which
+        returns the downloaded file's path) and stored for next time. `final`
+        says the downloaded file is never modified in place afterwards (see add)."""
+        with self._get_source_key_lock(source_key):
+            object_path = self.lookup(source_key)
+            if object_path is not None:
+                output_filepath = os.path.join(
+                    output_dir, filename + os.path.splitext(object_path)[1]
+                )
+                if not os.path.exists(output_filepath):
+                    _clone_or_copy(object_path, output_filepath)
+                self._mark_used(source_key)
+                print(f"Copied '{filename}' from the content store, no download needed.")
+                return output_filepath
+
+            output_filepath = download()
+            try:
+                self.add(source_key, output_filepath, final)
+            except (OSError, sqlite3.Error) as error:
+                # The download itself succeeded; only the sharing is lost.
+                print(f"Could not add '{filename}' to the content store: {error}")
+            return output_filepath
+
+
+def hash_file(filepath: str) -> str:
+    """SHA-256 of a file's contents, as a hex string."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _store_file(source_path: str, object_path: str, final: bool) -> None:
+    if final:
+        try:
+            os.link(source_path, object_path)
+            return
+        except OSError:
+            pass  # Across devices, or no hardlinks (FAT): copy instead.
+    _clone_or_copy(source_path, object_path)
+
+
+def _clone_or_copy(source_path: str, destination_path: str) -> None:
+    """Copy a file as a reflink where the filesystem supports it, else byte by byte."""
+    if sys.platform.startswith("linux"):
+        import fcntl
+
+        try:
+            with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+                fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+            shutil.copystat(source_path, destination_path)
+            return
+        except OSError:
+            pass  # No reflink support here (ext4, FAT, across devices): copy instead.
+    shutil.copy2(source_path, destination_path)
+
+
+_content_stores: Dict[str, ContentStore] = {}
+_content_stores_lock = threading.Lock()
+
+
+def get_content_store(download_dir: str) -> ContentStore:
+    """Process-wide store for a playlist download folder: the one shared by every
+    folder next to it (i.e. under the same destination root)."""
+    root = os.path.join(os.path.dirname(os.path.abspath(download_dir)), CONTENT_STORE_DIRNAME)
+    with _content_stores_lock:
+        if root not in _content_stores:
+            _content_stores[root] = ContentStore(root)
+        return _content_stores[root]
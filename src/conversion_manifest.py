@@ -0,0 +1,177 @@
+"""Module for the record of finished conversions in a converted folder, shared by
+convert_tracks_to_mp3.py and the app's conversion stage.
+
+Each output file gets one row in `<folder>/.conversion_manifest.sqlite3`: the
+source it was converted from (its size, mtime and SHA-256 at the time), the
+settings used (encoder and bitrate) and the size the output came out at. A
+rerun only redoes an output whose source changed, whose settings changed, or
+that is missing or not the size it was written at - so a library that hasn't
+changed is checked with a couple of `stat` calls per file and one read of the
+table, never by opening the files themselves. A source whose mtime changed but
+whose size didn't is hashed before being reconverted, so merely touched files
+(copied folders, restored backups) are recognized as unchanged.
+
+Outputs that already existed before the manifest did are adopted as done on
+first sight - but only once their audio headers show they're as long as their
+source: an older run may have been killed halfway through writing one, back
+when outputs weren't written atomically yet. Anything shorter (or unreadable)
+is reconverted. Adopted outputs' sources are only hashed if they change later."""
+import os
+import sqlite3
+import threading
+from typing import Dict, NamedTuple, Optional
+
+import mutagen
+
+from src.content_store import hash_file
+
+CONVERSION_MANIFEST_FILENAME = ".conversion_manifest.sqlite3"
+# How much shorter than its source an existing output may be and still be
+# adopted (encoder padding and frame rounding, not a missing tail).
+ADOPT_DURATION_TOLERANCE_S = 1.0
+
+
+class ManifestEntry(NamedTuple):
+    output_path: str
+    source_path: str
+    source_size: int
+    source_mtime_ns: int
+    # None for adopted outputs, whose source was never hashed.
+    source_sha256: Optional[str]
+    settings: str
+    output_size: int
+
+
+class ConversionManifest:
+    """SQLite-backed record of the conversions into one folder. The whole table is
+    read once, up front, so checks don't query SQLite per file. Meant to be used
+    from one thread (the one deciding what to convert and collecting results)."""
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, CONVERSION_MANIFEST_FILENAME)
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._entries: Optional[Dict[str, ManifestEntry]] = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversions ("
+                " output_path TEXT PRIMARY KEY,"
+                " source_path TEXT NOT NULL,"
+                " source_size INTEGER NOT NULL,"
+                " source_mtime_ns INTEGER NOT NULL,"
+                " source_sha256 TEXT,"
+                " settings TEXT NOT NULL,"
+                " output_size INTEGER NOT NULL)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def _get_entries(self) -> Dict[str, ManifestEntry]:
+        if self._entries is None:
+            with self._lock:
+                rows = self._get_connection().execute(
+                    "SELECT output_path, source_path, source_size, source_mtime_ns,"
+                    " source_sha256, settings, output_size FROM conversions"
+                ).fetchall()
+            self._entries = {row[0]: ManifestEntry(*row) for row in rows}
+        return self._entries
+
+    def _save(self, entry: ManifestEntry, commit: bool = True) -> None:
+        self._get_entries()[entry.output_path] = entry
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?, ?, ?)", entry
+            )
+            if commit:
+                connection.commit()
+
+    def is_up_to_date(
+        self, source_path: str, output_path: str, settings: str, adopt: bool = True
+    ) -> bool:
+        """Whether `output_path` is a finished conversion of the current `source_path`
+        with these settings - i.e. converting it again can be skipped. With
+        `adopt=False`, an output without an entry doesn't count as done (for outputs
+        that can exist without any conversion, like a kept source)."""
+        output_path = os.path.abspath(output_path)
+        try:
+            output_size = os.stat(output_path).st_size
+        except FileNotFoundError:
+            return False
+        source_stat = os.stat(source_path)
+
+        entry = self._get_entries().get(output_path)
+        if entry is None:
+            if not adopt or not _is_complete_output(source_path, output_path):
+                return False
+            # Converted before the manifest existed, and complete: adopt it.
+            # Committed on close - a first run may adopt a whole library.
+            self._save(
+                ManifestEntry(
+                    output_path,
+                    os.path.abspath(source_path),
+                    source_stat.st_size,
+                    source_stat.st_mtime_ns,
+                    None,
+                    settings,
+                    output_size,
+                ),
+                commit=False,
+            )
+            return True
+
+        if entry.settings != settings or entry.output_size != output_size:
+            return False
+        if (
+            entry.source_size == source_stat.st_size
+            and entry.source_mtime_ns == source_stat.st_mtime_ns
+        ):
+            return True
+        if (
+            entry.source_sha256 is None
+            or entry.source_size != source_stat.st_size
+            or hash_file(source_path) != entry.source_sha256
+        ):
+            return False
+        # Same contents, new mtime: remember the new one so it isn't hashed again.
+        self._save(entry._replace(source_mtime_ns=source_stat.st_mtime_ns))
+        return True
+
+    def record(self, source_path: str, output_path: str, settings: str) -> None:
+        """Record a just-finished conversion."""
+        source_stat = os.stat(source_path)
+        self._save(
+            ManifestEntry(
+                os.path.abspath(output_path),
+                os.path.abspath(source_path),
+                source_stat.st_size,
+                source_stat.st_mtime_ns,
+                hash_file(source_path),
+                settings,
+                os.path.getsize(output_path),
+            )
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.commit()
+                self._connection.close()
+                self._connection = None
+
+
+def _is_complete_output(source_path: str, output_path: str) -> bool:
+    """Whether an output written before the manifest existed is as long as its
+    source, going by both files' audio headers (the audio itself isn't decoded)."""
+    try:
+        source = mutagen.File(source_path)
+        output = mutagen.File(output_path)
+    except Exception:
+        return False
+    if source is None or output is None:
+        return False
+    return output.info.length >= source.info.length - ADOPT_DURATION_TOLERANCE_S
@@ -1,6 +1,7 @@
 """Module for handling file reading and writing data files."""
 import re
-from typing import Dict, List, Optional, Tuple
+from functools import lru_cache
+from typing import Dict, FrozenSet, List, Optional, Tuple
 
 from src.csv_handling import read_csv
 
@@ -186,14 +187,45 @@ def _all_words(text: str) -> List[str]:
     return [word for word in text.split() if word]
 
 
+class MatchTokens:
+    """Both word bags the matching checks need for one piece of text (a db entry's
+    "Artist - Track" string, its track name, or a search result's title), computed
+    once. Every candidate gets checked against the same expected string two or
+    three times over (strict then relaxed duration threshold, title overlap,
+    version markers, track-name words), so re-running the regexes for each check
+    was where most of the matching time went."""
+
+    __slots__ = ("search_words", "all_words")
+
+    def __init__(self, text: str):
+        self.all_words: FrozenSet[str] = frozenset(_all_words(text))
+        # Without any brackets there's nothing for _normalize_search_words to strip,
+        # so both bags are the same - skip the second regex pass.
+        if "(" in text or "[" in text:
+            self.search_words: FrozenSet[str] = frozenset(_normalize_search_words(text))
+        else:
+            self.search_words = self.all_words
+
+
+@lru_cache(maxsize=65536)
+def get_match_tokens(text: str) -> MatchTokens:
+    """Cached MatchTokens for `text` - the same titles come back across the strict
+    and relaxed passes, across query variants and across sources."""
+    return MatchTokens(text)
+
+
 def is_title_match(expected: str, candidate: str, threshold: float = TITLE_MATCH_THRESHOLD) -> bool:
     """Whether `candidate` (a search result's title/artist text) plausibly refers to
     the same song as `expected` (an "Artist - Track" search string), based on what
     fraction of the expected artist/track words show up in the candidate. This is a
     second, independent signal alongside duration - a result can have a matching
     length while being a completely different song."""
-    expected_words = set(_normalize_search_words(expected))
-    candidate_words = set(_normalize_search_words(candidate))
+    return _is_title_token_match(get_match_tokens(expected), get_match_tokens(candidate), threshold)
+
+
+def _is_title_token_match(expected: MatchTokens, candidate: MatchTokens, threshold: float) -> bool:
+    expected_words = expected.search_words
+    candidate_words = candidate.search_words
     if not expected_words or not candidate_words:
         return False
     return len(expected_words & candidate_words) / len(expected_words) >= threshold
@@ -207,14 +239,32 @@ def has_unexpected_version_marker(expected: str, candidate: str) -> bool:
     "(Artist B Remix)" where Artist B is already one of the expected artists, and
     the db's Track Name field just doesn't spell that out. It's only a sign of a
     different, uncredited version when it comes bundled with unexpected content."""
-    expected_words = set(_all_words(expected))
-    candidate_words = set(_all_words(candidate))
+    return _has_unexpected_version_marker_tokens(get_match_tokens(expected), get_match_tokens(candidate))
+
+
+def _has_unexpected_version_marker_tokens(expected: MatchTokens, candidate: MatchTokens) -> bool:
+    expected_words = expected.all_words
+    candidate_words = candidate.all_words
     if not (candidate_words & VERSION_MARKER_WORDS) - expected_words:
         return False
     unexpected_words = candidate_words - expected_words - VERSION_MARKER_WORDS - VERSION_FILLER_WORDS
     return bool(unexpected_words)
 
 
+def _is_plausible_candidate(
+    expected: MatchTokens,
+    track_name_words: FrozenSet[str],
+    candidate: MatchTokens,
+    title_threshold: float,
+) -> bool:
+    """The title checks from find_closest_matching_result, all on pre-tokenized text."""
+    return (
+        _is_title_token_match(expected, candidate, title_threshold)
+        and not _has_unexpected_version_marker_tokens(expected, candidate)
+        and bool(not track_name_words or track_name_words & candidate.search_words)
+    )
+
+
 def find_closest_matching_result(
     db_entry: Dict,
     search_results: List[dict],
@@ -229,20 +279,22 @@ def find_closest_matching_result(
     nothing qualifies - callers should treat that as "no match on this source",
     not settle for a same-length but differently-versioned result."""
     db_duration = db_entry[COLUMN_TRACK_DURATION]
-    expected = get_song_search_string(db_entry)
+    expected = get_match_tokens(get_song_search_string(db_entry))
     # A multi-artist collab's own name words (e.g. 3 credited artists) can by
     # themselves clear is_title_match's overlap threshold even when the
     # candidate is a completely different song by that same collab - the track
     # name's own words barely move the ratio. Requiring at least one of them to
     # actually appear closes that hole without needing an exact title match.
-    track_name_words = set(_normalize_search_words(db_entry[COLUMN_TRACK_NAME]))
+    track_name_words = get_match_tokens(db_entry[COLUMN_TRACK_NAME]).search_words
+    # The cheap duration check runs first, so results outside the threshold are
+    # never tokenized at all.
     candidates = [
         result
         for result in search_results
         if abs(db_duration - result[duration_key]) / db_duration < duration_threshold
-        and is_title_match(expected, result[title_key], threshold=title_threshold)
-        and not has_unexpected_version_marker(expected, result[title_key])
-        and (not track_name_words or track_name_words & set(_normalize_search_words(result[title_key])))
+        and _is_plausible_candidate(
+            expected, track_name_words, get_match_tokens(result[title_key]), title_threshold
+        )
     ]
     if not candidates:
         return None
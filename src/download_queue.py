@@ -0,0 +1,165 @@
+"""Module for the durable record of download jobs in a download folder, shared by
+download_tracks.py, download_from_soundcloud.py and the app's download stage.
+
+Each track gets one row in `<download folder>/.download_jobs.sqlite3`, keyed by
+its song filename: its state, how many attempts it took, the last error and the
+file it was saved to. A crashed or interrupted run resumes from this table -
+finished tracks are known to be finished without probing the folder for every
+supported extension, and a track that was mid-download when the run died is
+simply picked up again (its `.part` file, if any, is resumed or overwritten).
+
+Folders downloaded into before the table existed are adopted on first sight:
+a track with no job row but an existing file is recorded as done."""
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from src.file_metadata import SUPPORTED_FORMATS
+
+DOWNLOAD_QUEUE_FILENAME = ".download_jobs.sqlite3"
+
+JOB_PENDING = "pending"
+JOB_DOWNLOADING = "downloading"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+# Hit bot detection: worth retrying later in the same run.
+JOB_RETRYABLE = "retryable"
+
+JOB_SOURCE_YOUTUBE = "youtube"
+JOB_SOURCE_SOUNDCLOUD = "soundcloud"
+
+
+class DownloadJob(NamedTuple):
+    key: str
+    source: str
+    state: str
+    attempts: int
+    last_error: Optional[str]
+    output_path: Optional[str]
+    updated_at: float
+
+
+class DownloadQueue:
+    """SQLite-backed job table for one download folder, safe to share between threads."""
+
+    def __init__(self, download_dir: str):
+        self.download_dir = download_dir
+        self.path = os.path.join(download_dir, DOWNLOAD_QUEUE_FILENAME)
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " key TEXT PRIMARY KEY,"
+                " source TEXT NOT NULL,"
+                " state TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " last_error TEXT,"
+                " output_path TEXT,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def _execute(self, sql: str, parameters: tuple) -> None:
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(sql, parameters)
+            connection.commit()
+
+    def get(self, key: str) -> Optional[DownloadJob]:
+        with self._lock:
+            entry = self._get_connection().execute(
+                "SELECT key, source, state, attempts, last_error, output_path, updated_at"
+                " FROM jobs WHERE key = ?",
+                (key,),
+            ).fetchone()
+        return DownloadJob(*entry) if entry else None
+
+    def get_finished_path(self, key: str) -> Optional[str]:
+        """Where this track was saved, if it's already downloaded - else None.
+
+        Answered from the job table. The folder is only probed for a track that
+        was never attempted (adopting a file downloaded before the table existed),
+        or whose recorded file is gone - typically replaced by its converted mp3
+        (conversion with --delete-originals); if nothing is found either, the
+        track counts as not downloaded."""
+        job = self.get(key)
+        if (
+            job is not None
+            and job.state == JOB_DONE
+            and job.output_path is not None
+            and os.path.exists(job.output_path)
+        ):
+            return job.output_path
+        if job is not None and job.state != JOB_DONE and job.attempts > 0:
+            return None
+
+        existing_path = next(
+            (
+                os.path.join(self.download_dir, key + ext)
+                for ext in SUPPORTED_FORMATS
+                if os.path.exists(os.path.join(self.download_dir, key + ext))
+            ),
+            None,
+        )
+        if existing_path is not None:
+            self._execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, NULL, ?, ?)",
+                (
+                    key,
+                    job.source if job else "",
+                    JOB_DONE,
+                    job.attempts if job else 0,
+                    existing_path,
+                    time.time(),
+                ),
+            )
+        return existing_path
+
+    def enqueue(self, key: str, source: str) -> None:
+        """Add a job for this track, unless there already is one."""
+        self._execute(
+            "INSERT OR IGNORE INTO jobs (key, source, state, updated_at) VALUES (?, ?, ?, ?)",
+            (key, source, JOB_PENDING, time.time()),
+        )
+
+    def mark_started(self, key: str, source: str) -> None:
+        """Record an attempt starting (creating the job if needed)."""
+        self._execute(
+            "INSERT INTO jobs (key, source, state, attempts, updated_at) VALUES (?, ?, ?, 1, ?)"
+            " ON CONFLICT(key) DO UPDATE SET"
+            " source = excluded.source, state = excluded.state,"
+            " attempts = attempts + 1, updated_at = excluded.updated_at",
+            (key, source, JOB_DOWNLOADING, time.time()),
+        )
+
+    def mark_done(self, key: str, output_path: str) -> None:
+        self._execute(
+            "UPDATE jobs SET state = ?, last_error = NULL, output_path = ?, updated_at = ?"
+            " WHERE key = ?",
+            (JOB_DONE, output_path, time.time(), key),
+        )
+
+    def mark_failed(self, key: str, error: BaseException, retryable: bool = False) -> None:
+        self._execute(
+            "UPDATE jobs SET state = ?, last_error = ?, updated_at = ? WHERE key = ?",
+            (
+                JOB_RETRYABLE if retryable else JOB_FAILED,
+                f"{type(error).__name__}: {error}",
+                time.time(),
+                key,
+            ),
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
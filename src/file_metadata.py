@@ -1,6 +1,7 @@
 """Module for handling file metadata for the supported file types."""
 
 import os
+from typing import List, Optional
 
 from mutagen.easyid3 import EasyID3
 from mutagen.id3 import ID3NoHeaderError
@@ -21,6 +22,10 @@ FILE_EXTENSION_M4A = ".m4a"
 
 SUPPORTED_FORMATS = {FILE_EXTENSION_MP3, FILE_EXTENSION_MP4, FILE_EXTENSION_M4A}
 
+# Appended to a download's final filename while it's still being written, so an
+# unfinished file is never mistaken for a finished one by the skip checks.
+FILE_EXTENSION_PART = ".part"
+
 METADATA_TAGS = {
     FILE_EXTENSION_MP3: {
         "artist": "artist",
@@ -41,9 +46,27 @@ METADATA_CLASSES = {
     FILE_EXTENSION_MP4: MP4,
 }
 
+# ffmpeg's own names for the same tags, for `-metadata key=value` (see
+# get_ffmpeg_metadata_args). Its id3v2 writer takes frame IDs like TBPM as-is.
+FFMPEG_METADATA_KEYS = {
+    FILE_EXTENSION_MP3: {
+        "artist": "artist",
+        "title": "title",
+        "genre": "genre",
+        "tempo": "TBPM",
+    },
+    FILE_EXTENSION_MP4: {
+        "artist": "artist",
+        "title": "title",
+        "genre": "genre",
+        "tempo": "tmpo",
+    },
+}
+
 # .m4a files are MP4 containers, so they share the MP4 tag mapping and handler
 METADATA_TAGS[FILE_EXTENSION_M4A] = METADATA_TAGS[FILE_EXTENSION_MP4]
 METADATA_CLASSES[FILE_EXTENSION_M4A] = METADATA_CLASSES[FILE_EXTENSION_MP4]
+FFMPEG_METADATA_KEYS[FILE_EXTENSION_M4A] = FFMPEG_METADATA_KEYS[FILE_EXTENSION_MP4]
 
 
 def get_file_bit_rate_kbps(filepath: str) -> str:
@@ -54,7 +77,7 @@ def get_file_bit_rate_kbps(filepath: str) -> str:
     try:
         if ext == FILE_EXTENSION_MP3:
             info = MP3(filepath).info
-        elif ext == FILE_EXTENSION_MP4:
+        elif ext in (FILE_EXTENSION_MP4, FILE_EXTENSION_M4A):
             info = MP4(filepath).info
         else:
             return ""
@@ -140,9 +163,45 @@ def prepare_metadata_tags(
     return metadata_tags
 
 
-def set_file_metadata_tags(filepath: str, metadata_tags: dict):
-    """This function sets the provided metadata tags onto a file."""
-    file_extension = os.path.splitext(filepath)[1]
+def get_ffmpeg_metadata_args(metadata_tags: dict, file_extension: str) -> List[str]:
+    """This function turns tags prepared by prepare_metadata_tags into ffmpeg
+    `-metadata` arguments, so they're written by the same ffmpeg pass that writes
+    the file, instead of re-opening and rewriting it with mutagen afterwards.
+    Multi-value tags are left out: ffmpeg can only write one value per tag, so
+    they're written with mutagen instead (see get_multi_value_tags)."""
+    ffmpeg_args = []
+    multi_value_tags = get_multi_value_tags(metadata_tags)
+    for tag_name, file_tag in METADATA_TAGS[file_extension].items():
+        if file_tag not in metadata_tags or file_tag in multi_value_tags:
+            continue
+        value = metadata_tags[file_tag]
+        if isinstance(value, list):
+            value = str(value[0]).strip() if value else ""
+        if not value:
+            # An empty value would make ffmpeg drop the tag copied from the source.
+            continue
+        ffmpeg_key = FFMPEG_METADATA_KEYS[file_extension][tag_name]
+        ffmpeg_args += ["-metadata", f"{ffmpeg_key}={value}"]
+    return ffmpeg_args
+
+
+def get_multi_value_tags(metadata_tags: dict) -> dict:
+    """The tags with several values (e.g. an mp3's artists), which ffmpeg would
+    flatten into one string - they're kept as real multi-value frames by writing
+    them with set_file_metadata_tags instead."""
+    return {
+        tag: value
+        for tag, value in metadata_tags.items()
+        if isinstance(value, list) and len(value) > 1
+    }
+
+
+def set_file_metadata_tags(
+    filepath: str, metadata_tags: dict, file_extension: Optional[str] = None
+):
+    """This function sets the provided metadata tags onto a file. `file_extension`
+    overrides the file's own, e.g. for a `.part` file still being written."""
+    file_extension = file_extension or os.path.splitext(filepath)[1]
     tag_handling_class = METADATA_CLASSES[file_extension]
     try:
         tag_dict = tag_handling_class(filepath)
@@ -0,0 +1,81 @@
+"""Module for the HTTP session shared by every module that talks to a web API
+directly (SoundCloud search/resolve/stream requests, the client_id scraper,
+YouTube Music search). Calling `requests.get` opens a fresh TCP+TLS connection
+each time; going through one pooled session keeps connections alive between
+requests, so bulk matching pays the handshake once per host instead of once
+per request.
+
+The session also retries transient failures (connection errors and 5xx
+responses) with exponential backoff, caps the number of open connections per
+host, and applies DEFAULT_TIMEOUT_SECONDS to any request that doesn't pass its
+own timeout (ytmusicapi drops its 30s timeout once it's handed a session). Rate limiting (429) is deliberately not retried here: it's handed
+straight back so the per-source limiters (rate_limiting.py) see it and slow
+down, instead of urllib3 quietly absorbing it."""
+import functools
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connections kept open per host. Worker threads beyond this wait for a free
+# connection rather than opening extra ones (see `pool_block` below).
+MAX_CONNECTIONS_PER_HOST = 8
+# Distinct hosts whose pools are kept at once (SoundCloud's API and CDN,
+# YouTube Music, the client_id scraper's pages and scripts...).
+MAX_POOLED_HOSTS = 10
+
+DEFAULT_TIMEOUT_SECONDS = 30
+
+MAX_RETRIES = 3
+# Sleeps 0.5s, 1s, 2s... between retries (urllib3's exponential backoff).
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+_http_session: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
+
+
+def _build_adapter() -> HTTPAdapter:
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        # urllib3's default never retries POSTs (ytmusicapi's search is one);
+        # those are left to the callers' own error handling.
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        respect_retry_after_header=True,
+        # Hand the final failed response back to the caller (who calls
+        # raise_for_status) instead of raising urllib3's MaxRetryError.
+        raise_on_status=False,
+    )
+    return HTTPAdapter(
+        pool_connections=MAX_POOLED_HOSTS,
+        pool_maxsize=MAX_CONNECTIONS_PER_HOST,
+        pool_block=True,
+        max_retries=retry,
+    )
+
+
+def build_http_session() -> requests.Session:
+    """A new session with keep-alive pooling, retries, per-host connection limits
+    and a default timeout."""
+    session = requests.Session()
+    adapter = _build_adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # A timeout passed by the caller still wins over the partial's keyword.
+    session.request = functools.partial(  # type: ignore[method-assign]
+        session.request, timeout=DEFAULT_TIMEOUT_SECONDS
+    )
+    return session
+
+
+def get_http_session() -> requests.Session:
+    """Process-wide session, shared by every thread."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = build_http_session()
+        return _http_session
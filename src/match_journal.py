@@ -0,0 +1,83 @@
+"""Module for checkpointing match decisions as they're made, so an interrupted
+matching run (crash, Ctrl-C, lost connection) can pick up where it stopped
+instead of repeating every search.
+
+The journal is an append-only JSONL file: one line per decided song, written
+and fsynced the moment the decision is made. A half-written last line (the
+process died mid-write) is simply ignored on the next load - that song just
+gets searched again - and the next run starts its first record on a new line,
+so the torn line can't swallow it.
+
+It only exists while a run is unfinished: once the output CSVs are written the
+journal is removed, so later runs search again instead of replaying its old
+decisions (including stale "no match" ones)."""
+import json
+import os
+from typing import Dict, Optional, TextIO
+
+from src.data_handling import COLUMN_TRACK_DURATION, get_song_search_string
+
+
+def get_journal_key(row: Dict) -> str:
+    """Identify a song by what it's searched and matched on, rather than by its
+    row position - so the journal stays valid if rows are added, removed or
+    reordered between runs, and duplicate rows share one decision."""
+    return f"{get_song_search_string(row)}|{row[COLUMN_TRACK_DURATION]}"
+
+
+class MatchJournal:
+    """Append-only record of match decisions: key -> Youtube ID, or None for "no match"."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file: Optional[TextIO] = None
+
+    def load(self) -> Dict[str, Optional[str]]:
+        """Every decision recorded so far. Later lines win over earlier ones."""
+        decisions: Dict[str, Optional[str]] = {}
+        if not os.path.exists(self.path):
+            return decisions
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                decisions[entry["key"]] = entry["youtube_id"]
+        return decisions
+
+    def append(self, key: str, youtube_id: Optional[str]) -> None:
+        """Record one decision and sync it to disk."""
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+            if not _ends_with_newline(self.path):
+                # A torn last line from an interrupted run: end it, so this record
+                # isn't appended onto it (and lost along with it on the next load).
+                self._file.write("\n")
+        self._file.write(json.dumps({"key": key, "youtube_id": youtube_id}) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def reset(self) -> None:
+        """Discard every recorded decision, starting the journal over (or removing it
+        once the run it checkpoints has finished)."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _ends_with_newline(path: str) -> bool:
+    """Whether the file is empty or its last byte is a newline."""
+    with open(path, "rb") as file:
+        file.seek(0, os.SEEK_END)
+        if file.tell() == 0:
+            return True
+        file.seek(-1, os.SEEK_END)
+        return file.read(1) == b"\n"
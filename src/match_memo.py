@@ -0,0 +1,147 @@
+"""Module for remembering accepted matches across playlists. The same tracks show
+up again and again across playlists, and once a track has been matched there's
+no need to go through every query variant and search source again - the memo
+maps a track's identity (normalized artist + track name + duration bucket) to
+the Youtube ID or SoundCloud URL that was accepted for it.
+
+"No match" outcomes are remembered too, but only for `NO_MATCH_TTL_SECONDS`:
+new uploads appear over time, so a track that had no match last week may well
+have one now. Accepted matches never expire.
+
+Unlike the search cache (search_cache.py), which remembers raw results for a
+query text, this remembers the final decision for a track - so it also short-
+circuits the matching logic itself, and survives query/threshold changes that
+would make cached search results irrelevant."""
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from src.cache_dir import get_cache_path
+from src.data_handling import (
+    COLUMN_ARTIST_NAME,
+    COLUMN_TRACK_DURATION,
+    COLUMN_TRACK_NAME,
+    _all_words,
+)
+
+# In the cache directory (see cache_dir.py).
+MATCH_MEMO_FILENAME = ".match_memo.sqlite3"
+NO_MATCH_TTL_SECONDS = 7 * 24 * 3600
+DURATION_BUCKET_SECONDS = 5
+
+# Decisions are remembered per search, not just per site: the CLI's plain
+# YouTube search and the app's multi-variant YouTube Music search can reach
+# different answers, and one's "no match" mustn't suppress the other.
+MEMO_SOURCE_YOUTUBE = "youtube"
+MEMO_SOURCE_YOUTUBE_MUSIC = "youtube_music"
+MEMO_SOURCE_SOUNDCLOUD = "soundcloud"
+
+# What `lookup` returns for a remembered (and not yet expired) "no match" - the
+# same empty value an unmatched row has in its CSV column.
+NO_MATCH = ""
+
+# Shares the search cache's switch: "don't reuse anything remembered from
+# earlier runs" applies to both.
+MATCH_MEMO_BYPASS_ENV = "MUSIC_DOWNLOADER_NO_SEARCH_CACHE"
+
+
+def get_track_identity(row: Dict) -> Tuple[str, str, int]:
+    """Normalized (artist, track, duration bucket) for a row - punctuation, case and
+    bracket styles don't matter, so the same track exported by Spotify and Tidal
+    (or typed slightly differently in two CSVs) maps to the same memo entry.
+    Durations a second apart can still round into adjacent buckets, so lookups
+    also consult the neighbouring buckets (see MatchMemo.lookup)."""
+    artist = " ".join(_all_words(row[COLUMN_ARTIST_NAME]))
+    track = " ".join(_all_words(row[COLUMN_TRACK_NAME]))
+    duration_bucket = round(float(row[COLUMN_TRACK_DURATION]) / DURATION_BUCKET_SECONDS)
+    return artist, track, duration_bucket
+
+
+class MatchMemo:
+    """SQLite-backed store of per-track match decisions, safe to share between threads."""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        no_match_ttl_seconds: float = NO_MATCH_TTL_SECONDS,
+        bypass: bool = False,
+    ):
+        self.path = path or get_cache_path(MATCH_MEMO_FILENAME)
+        self.no_match_ttl_seconds = no_match_ttl_seconds
+        self.bypass = bypass
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS matches ("
+                " artist TEXT NOT NULL,"
+                " track TEXT NOT NULL,"
+                " duration_bucket INTEGER NOT NULL,"
+                " source TEXT NOT NULL,"
+                " value TEXT,"
+                " decided_at REAL NOT NULL,"
+                " PRIMARY KEY (artist, track, duration_bucket, source))"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def lookup(self, row: Dict, source: str) -> Optional[str]:
+        """The remembered decision for this track on `source`: the accepted Youtube
+        ID / SoundCloud URL, NO_MATCH for a recent "no match", or None if there's
+        nothing (still valid) to go on and the track has to be searched."""
+        if self.bypass:
+            return None
+        artist, track, duration_bucket = get_track_identity(row)
+        # The track's own bucket and its neighbours: the same track listed a second
+        # longer in another export may have rounded across the bucket edge. The
+        # nearest bucket wins, then the newest decision.
+        with self._lock:
+            entries = self._get_connection().execute(
+                "SELECT value, decided_at FROM matches"
+                " WHERE artist = ? AND track = ? AND source = ?"
+                " AND duration_bucket BETWEEN ? AND ?"
+                " ORDER BY ABS(duration_bucket - ?), decided_at DESC",
+                (artist, track, source, duration_bucket - 1, duration_bucket + 1, duration_bucket),
+            ).fetchall()
+        for value, decided_at in entries:
+            if value is not None:
+                return value
+            if time.time() - decided_at <= self.no_match_ttl_seconds:
+                return NO_MATCH
+        return None
+
+    def remember(self, row: Dict, source: str, value: Optional[str]) -> None:
+        """Record the decision for this track on `source` - None/empty for "no match"."""
+        if self.bypass:
+            return
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?)",
+                get_track_identity(row) + (source, value or None, time.time()),
+            )
+            connection.commit()
+
+
+_match_memo: Optional[MatchMemo] = None
+_match_memo_lock = threading.Lock()
+
+
+def get_match_memo() -> MatchMemo:
+    """Process-wide memo shared by the CLI and the app (and their worker threads)."""
+    global _match_memo
+    with _match_memo_lock:
+        if _match_memo is None:
+            _match_memo = MatchMemo(bypass=bool(os.getenv(MATCH_MEMO_BYPASS_ENV)))
+        return _match_memo
+
+
+def set_match_memo_bypass(bypass: bool) -> None:
+    """Turn the shared memo off (or back on) for the rest of this process."""
+    get_match_memo().bypass = bypass
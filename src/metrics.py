@@ -0,0 +1,173 @@
+"""Module for optional per-track timing metrics, to tell where a slow run spends
+its time (search, download, remux, tempo estimation, tagging, conversion).
+
+When enabled (`--metrics PATH` on the CLIs, or the MUSIC_DOWNLOADER_METRICS
+environment variable for any entry point, including the app), one JSONL record
+is appended per track and stage:
+
+    {"stage": "download", "track": "...", "started_at": ..., "ok": true,
+     "error": null, "total_s": 4.2, "phases": {"download": 3.1, "remux": 0.4,
+     "tagging": 0.1}, "bytes": 4812345, "throughput_bytes_per_s": 1552369.4}
+
+Code deep in the pipeline doesn't need the record passed down to it: `phase`
+and `add_bytes` attach to whichever track the current thread is working on
+(see `track_metrics`), and do nothing outside of one. summarize_metrics.py
+prints p50/p95 per phase from the file."""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, TextIO
+
+METRICS_PATH_ENV = "MUSIC_DOWNLOADER_METRICS"
+
+
+class TrackMetrics:
+    """Phase timings and bytes transferred for one track in one stage."""
+
+    def __init__(self, stage: str, track: str):
+        self.stage = stage
+        self.track = track
+        self.started_at = time.time()
+        self.phases: Dict[str, float] = {}
+        self.bytes = 0
+        # Set by callers that handle a failure themselves instead of raising.
+        self.error: Optional[str] = None
+        # A track's work can span threads (see attach_track_metrics).
+        self._lock = threading.Lock()
+
+    def add_phase_time(self, name: str, seconds: float) -> None:
+        # A phase can run more than once per track (e.g. a retried download).
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_bytes(self, num_bytes: int) -> None:
+        with self._lock:
+            self.bytes += num_bytes
+
+    def to_record(self, total_s: float, exception: Optional[BaseException]) -> Dict:
+        download_s = self.phases.get("download")
+        error = self.error
+        if exception is not None:
+            error = f"{type(exception).__name__}: {exception}"
+        return {
+            "stage": self.stage,
+            "track": self.track,
+            "started_at": self.started_at,
+            "ok": error is None,
+            "error": error,
+            "total_s": round(total_s, 4),
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "bytes": self.bytes,
+            "throughput_bytes_per_s": (
+                round(self.bytes / download_s, 1) if self.bytes and download_s else None
+            ),
+        }
+
+
+class MetricsWriter:
+    """Appends metrics records to a JSONL file, safe to share between threads."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file: Optional[TextIO] = None
+
+    def write(self, record: Dict) -> None:
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_metrics_writer: Optional[MetricsWriter] = None
+_metrics_writer_configured = False
+# Guards the two above: the writer is first asked for from pool threads.
+_metrics_writer_lock = threading.Lock()
+_current = threading.local()
+
+
+def _get_metrics_writer() -> Optional[MetricsWriter]:
+    global _metrics_writer, _metrics_writer_configured
+    with _metrics_writer_lock:
+        if not _metrics_writer_configured:
+            path = os.getenv(METRICS_PATH_ENV)
+            _metrics_writer = MetricsWriter(path) if path else None
+            _metrics_writer_configured = True
+        return _metrics_writer
+
+
+def set_metrics_path(path: Optional[str]) -> None:
+    """Write metrics to `path` for the rest of this process (None turns them off)."""
+    global _metrics_writer, _metrics_writer_configured
+    with _metrics_writer_lock:
+        if _metrics_writer is not None:
+            _metrics_writer.close()
+        _metrics_writer = MetricsWriter(path) if path else None
+        _metrics_writer_configured = True
+
+
+@contextmanager
+def track_metrics(stage: str, track: str) -> Iterator[Optional[TrackMetrics]]:
+    """Measure one track's work in `stage` on the current thread, writing its
+    record on exit - also when the work raises (the record is marked failed and
+    the exception propagates). Yields None, at no cost, when metrics are off."""
+    writer = _get_metrics_writer()
+    if writer is None:
+        yield None
+        return
+
+    metrics = TrackMetrics(stage, track)
+    previous = getattr(_current, "metrics", None)
+    _current.metrics = metrics
+    start = time.perf_counter()
+    error: Optional[BaseException] = None
+    try:
+        yield metrics
+    except BaseException as exc:
+        error = exc
+        raise
+    finally:
+        _current.metrics = previous
+        writer.write(metrics.to_record(time.perf_counter() - start, error))
+
+
+@contextmanager
+def attach_track_metrics(metrics: Optional[TrackMetrics]) -> Iterator[None]:
+    """Make work done on this thread count towards `metrics` - for a track whose
+    work is partly handed off to another thread (e.g. a pool). No-op for None."""
+    previous = getattr(_current, "metrics", None)
+    _current.metrics = metrics if metrics is not None else previous
+    try:
+        yield
+    finally:
+        _current.metrics = previous
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Time a phase of the track the current thread is measuring, if any."""
+    metrics: Optional[TrackMetrics] = getattr(_current, "metrics", None)
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_phase_time(name, time.perf_counter() - start)
+
+
+def add_bytes(num_bytes: int) -> None:
+    """Count bytes transferred for the track the current thread is measuring, if any."""
+    metrics: Optional[TrackMetrics] = getattr(_current, "metrics", None)
+    if metrics is not None:
+        metrics.add_bytes(num_bytes)
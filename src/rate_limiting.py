@@ -0,0 +1,154 @@
+"""Module for pacing network calls per source, so running searches (or downloads)
+from several worker threads at once doesn't turn into a burst of requests that
+gets us throttled or flagged as a bot. Each source gets its own limiter, shared
+by every thread in the process.
+
+The rate isn't fixed: none of these endpoints publish a quota, so each limiter
+looks for the highest rate the remote side tolerates with an additive-increase/
+multiplicative-decrease (AIMD) controller, like TCP's congestion control. Every
+successful call nudges the rate up a little; every throttling signal (YouTube's
+BotDetection, an HTTP 429) halves it. Wrap calls in `rate_limited(source)` to
+feed those signals in, and print `rate_limiters_summary()` to see where each
+source settled."""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+from pytubefix.exceptions import BotDetection
+
+from src.metrics import phase
+
+# Starting requests per second per source. Conservative on purpose: these are
+# unofficial/scraped endpoints with no published quota, so the controller only
+# climbs above this once it has seen the remote side keep up.
+DEFAULT_INITIAL_CALLS_PER_SECOND = 4.0
+INITIAL_CALLS_PER_SECOND_BY_SOURCE: Dict[str, float] = {
+    "youtube": 4.0,
+    "youtube_music": 4.0,
+    "soundcloud": 4.0,
+    "youtube_download": 1.0,
+}
+
+# AIMD tuning: the ceiling is a multiple of the starting rate; each success adds
+# ADDITIVE_INCREASE calls/s, each throttling signal multiplies the rate by
+# MULTIPLICATIVE_DECREASE. Signals arriving within DECREASE_COOLDOWN_SECONDS of
+# a decrease count as the same event - several requests already in flight all
+# failing together shouldn't crash the rate to the floor.
+CEILING_FACTOR = 4.0
+MIN_CALLS_PER_SECOND = 0.05
+ADDITIVE_INCREASE = 0.05
+MULTIPLICATIVE_DECREASE = 0.5
+DECREASE_COOLDOWN_SECONDS = 5.0
+
+HTTP_TOO_MANY_REQUESTS = 429
+# How libraries that only report a 429 as text word it: urllib's HTTPError
+# (youtube-search, pytubefix) and ytmusicapi's own exception.
+THROTTLING_ERROR_MESSAGES = ("HTTP Error 429", "Server returned HTTP 429")
+
+
+class RateLimiter:
+    """Spaces out calls to at most `max_calls_per_second`, across all threads.
+    Callers block in `acquire` until their slot comes up - slots are handed out
+    in arrival order, so no thread starves. `record_success`/`record_throttled`
+    adjust the rate between `min_calls_per_second` and `ceiling_calls_per_second`."""
+
+    def __init__(
+        self,
+        max_calls_per_second: float,
+        min_calls_per_second: float = MIN_CALLS_PER_SECOND,
+        ceiling_calls_per_second: float = 0.0,
+    ):
+        self.max_calls_per_second = max_calls_per_second
+        self.min_calls_per_second = min_calls_per_second
+        self.ceiling_calls_per_second = ceiling_calls_per_second or max_calls_per_second
+        self.n_throttled = 0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self._last_decrease = float("-inf")
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1.0 / self.max_calls_per_second
+        delay = slot - now
+        if delay > 0:
+            with phase("rate_limit_wait"):
+                time.sleep(delay)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.max_calls_per_second = min(
+                self.ceiling_calls_per_second, self.max_calls_per_second + ADDITIVE_INCREASE
+            )
+
+    def record_throttled(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < DECREASE_COOLDOWN_SECONDS:
+                return
+            self._last_decrease = now
+            self.n_throttled += 1
+            self.max_calls_per_second = max(
+                self.min_calls_per_second, self.max_calls_per_second * MULTIPLICATIVE_DECREASE
+            )
+            # Hold off the next call for a full slot at the new rate, rather than
+            # letting already-handed-out slots keep hitting a server that just said no.
+            self._next_slot = max(self._next_slot, now + 1.0 / self.max_calls_per_second)
+
+
+def is_throttling_error(error: BaseException) -> bool:
+    """Whether an exception means the remote side wants us to slow down."""
+    if isinstance(error, BotDetection):
+        return True
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == HTTP_TOO_MANY_REQUESTS:
+        return True
+    # Some libraries surface it as text only.
+    error_message = str(error)
+    return any(message in error_message for message in THROTTLING_ERROR_MESSAGES)
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(source: str) -> RateLimiter:
+    """Process-wide limiter for one source (e.g. "youtube", "soundcloud")."""
+    with _rate_limiters_lock:
+        if source not in _rate_limiters:
+            start = INITIAL_CALLS_PER_SECOND_BY_SOURCE.get(source, DEFAULT_INITIAL_CALLS_PER_SECOND)
+            _rate_limiters[source] = RateLimiter(
+                start, ceiling_calls_per_second=start * CEILING_FACTOR
+            )
+        return _rate_limiters[source]
+
+
+@contextmanager
+def rate_limited(source: str) -> Iterator[None]:
+    """Wait for a slot on `source`'s limiter, then run the wrapped call, feeding
+    its outcome back: success raises the rate, a throttling error lowers it
+    (and is re-raised). Other errors don't affect the rate."""
+    rate_limiter = get_rate_limiter(source)
+    rate_limiter.acquire()
+    try:
+        yield
+    except Exception as error:
+        if is_throttling_error(error):
+            rate_limiter.record_throttled()
+        raise
+    rate_limiter.record_success()
+
+
+def rate_limiters_summary() -> str:
+    """One line per source used so far: the rate its controller settled on."""
+    with _rate_limiters_lock:
+        rate_limiters = dict(_rate_limiters)
+    lines: List[str] = []
+    for source, rate_limiter in sorted(rate_limiters.items()):
+        lines.append(
+            f"Rate for {source}: settled at {rate_limiter.max_calls_per_second:.2f} calls/s "
+            f"(throttled {rate_limiter.n_throttled} time(s))"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,190 @@
+"""Module for caching search results on disk, shared by every search source
+(YouTube, YouTube Music, SoundCloud). Re-running matching on an overlapping
+playlist would otherwise repeat hundreds of identical network searches - a
+cached answer comes back in well under a millisecond instead.
+
+Entries are keyed by source, normalized query text and result limit, and
+expire after a TTL so a search eventually picks up newly uploaded tracks. The
+cache is bounded: once it grows past `max_entries`, the least recently used
+entries are evicted first."""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional
+
+from src.cache_dir import get_cache_path
+
+# In the cache directory (see cache_dir.py).
+SEARCH_CACHE_FILENAME = ".search_cache.sqlite3"
+DEFAULT_TTL_SECONDS = 14 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 50_000
+
+# Set to any non-empty value to skip the cache entirely - every search goes
+# straight to the network, and nothing is read from or written to disk. The
+# CLI's --no-cache flag does the same thing for a single run.
+SEARCH_CACHE_BYPASS_ENV = "MUSIC_DOWNLOADER_NO_SEARCH_CACHE"
+
+# Size-based eviction only runs every this many writes, rather than counting
+# rows on every single insert.
+_EVICTION_INTERVAL = 200
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Casefold and collapse whitespace, so trivially different spellings of the
+    same query ("Artist  - Track" vs "artist - track") share one cache entry.
+    Only affects the cache key - the query sent to the search source is unchanged."""
+    return _WHITESPACE_RE.sub(" ", query.casefold()).strip()
+
+
+class SearchCache:
+    """SQLite-backed cache of search results, safe to share between threads."""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        bypass: bool = False,
+    ):
+        self.path = path or get_cache_path(SEARCH_CACHE_FILENAME)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._writes_since_eviction = 0
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # Opened lazily, so a bypassed cache never creates the file at all.
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS search_results ("
+                " source TEXT NOT NULL,"
+                " query TEXT NOT NULL,"
+                " result_limit INTEGER NOT NULL,"
+                " results TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_used_at REAL NOT NULL,"
+                " PRIMARY KEY (source, query, result_limit))"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def get(self, source: str, query: str, limit: int) -> Optional[List[dict]]:
+        """Return the cached results for this search, or None on a miss (never
+        cached, expired, or cache bypassed)."""
+        if self.bypass:
+            return None
+        key = (source, normalize_query(query), limit)
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute(
+                "SELECT results, created_at FROM search_results"
+                " WHERE source = ? AND query = ? AND result_limit = ?",
+                key,
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            connection.execute(
+                "UPDATE search_results SET last_used_at = ?"
+                " WHERE source = ? AND query = ? AND result_limit = ?",
+                (now,) + key,
+            )
+            connection.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, source: str, query: str, limit: int, results: List[dict]) -> None:
+        """Store a search's results, replacing any previous entry for it."""
+        if self.bypass:
+            return
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO search_results VALUES (?, ?, ?, ?, ?, ?)",
+                (source, normalize_query(query), limit, json.dumps(results), now, now),
+            )
+            connection.commit()
+            self._writes_since_eviction += 1
+            if self._writes_since_eviction >= _EVICTION_INTERVAL:
+                self._evict(connection, now)
+
+    def get_or_fetch(
+        self, source: str, query: str, limit: int, fetch: Callable[[], List[dict]]
+    ) -> List[dict]:
+        """Return cached results if there are any, otherwise call `fetch` and cache
+        what it returns. Exceptions from `fetch` propagate and nothing is cached,
+        so a transient network failure is retried next time rather than remembered."""
+        results = self.get(source, query, limit)
+        if results is None:
+            results = fetch()
+            self.put(source, query, limit, results)
+        return results
+
+    def evict(self) -> None:
+        """Drop expired entries, then the least recently used ones beyond `max_entries`."""
+        if self.bypass:
+            return
+        with self._lock:
+            self._evict(self._get_connection(), time.time())
+
+    def _evict(self, connection: sqlite3.Connection, now: float) -> None:
+        connection.execute(
+            "DELETE FROM search_results WHERE created_at < ?", (now - self.ttl_seconds,)
+        )
+        (n_entries,) = connection.execute("SELECT COUNT(*) FROM search_results").fetchone()
+        if n_entries > self.max_entries:
+            connection.execute(
+                "DELETE FROM search_results WHERE rowid IN ("
+                " SELECT rowid FROM search_results ORDER BY last_used_at ASC LIMIT ?)",
+                (n_entries - self.max_entries,),
+            )
+        connection.commit()
+        self._writes_since_eviction = 0
+
+    def clear(self) -> None:
+        """Delete every cached entry."""
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute("DELETE FROM search_results")
+            connection.commit()
+
+    def stats_summary(self) -> str:
+        """One-line hit/miss summary, for printing at the end of a run."""
+        if self.bypass:
+            return "Search cache: bypassed"
+        total = self.hits + self.misses
+        hit_rate = f" ({self.hits / total:.0%} hit rate)" if total else ""
+        return f"Search cache: {self.hits} hit(s), {self.misses} miss(es){hit_rate}"
+
+
+_search_cache: Optional[SearchCache] = None
+_search_cache_lock = threading.Lock()
+
+
+def get_search_cache() -> SearchCache:
+    """Process-wide cache instance shared by all search sources (and threads)."""
+    global _search_cache
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = SearchCache(bypass=bool(os.getenv(SEARCH_CACHE_BYPASS_ENV)))
+        return _search_cache
+
+
+def set_search_cache_bypass(bypass: bool) -> None:
+    """Turn the shared cache off (or back on) for the rest of this process. The
+    environment variable keeps it off either way, so passing a command-line flag's
+    default (False) through can't turn a cache the environment disabled back on."""
+    get_search_cache().bypass = bypass or bool(os.getenv(SEARCH_CACHE_BYPASS_ENV))
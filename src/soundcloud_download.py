@@ -1,17 +1,44 @@
 """Module for downloading a track's audio from SoundCloud, given a permalink URL
 found by soundcloud_search.py. Uses the progressive (plain HTTP mp3) stream -
-the same one SoundCloud's own web player streams from for normal playback."""
+the same one SoundCloud's own web player streams from for normal playback - or,
+for tracks that don't offer one, the non-encrypted mp3 HLS stream: its segments
+are fetched concurrently and concatenated into the same kind of mp3 file."""
+import contextlib
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, cast
+from urllib.parse import urljoin
 
 import requests
 
-from src.file_metadata import FILE_EXTENSION_MP3
-from src.soundcloud_search import HEADERS, RESOLVE_URL, get_client_id
+from src.file_metadata import FILE_EXTENSION_MP3, FILE_EXTENSION_PART
+from src.http_session import get_http_session
+from src.metrics import add_bytes, phase
+from src.soundcloud_search import HEADERS, RESOLVE_URL, soundcloud_api_get
+from src.source_selection import StreamCandidate, get_soundcloud_candidates, select_stream
+
+# How many times an interrupted transfer is resumed within one download call.
+NUM_RETRIES = 5
+DOWNLOAD_CHUNK_SIZE = 1024 * 256
+
+# HLS segments are small (a few seconds of audio each), so a track is dozens of
+# short requests - fetched several at a time over the pooled session.
+HLS_SEGMENT_JOBS = 8
 
 
 class NoProgressiveStreamAvailableError(Exception):
-    """Exception raised when a SoundCloud track has no progressive stream
-    available (HLS-only or fully playback-restricted tracks)."""
+    """Exception raised when a SoundCloud track has neither a progressive stream
+    nor a non-encrypted mp3 HLS stream available (encrypted-HLS-only or fully
+    playback-restricted tracks)."""
+
+
+class EncryptedHlsStreamError(Exception):
+    """Exception raised when an HLS playlist turns out to use encrypted segments."""
+
+
+class IncompleteDownloadError(Exception):
+    """Exception raised when a download ends with fewer bytes than the server
+    announced. The partial file is kept, so the next attempt resumes it."""
 
 
 def get_soundcloud_track_info(track_url: str) -> dict:
@@ -21,8 +48,7 @@ def get_soundcloud_track_info(track_url: str) -> dict:
     titles frequently embed the artist as 'Artist - Track'; when they do not,
     the uploader name is used as the artist.
     """
-    client_id = get_client_id()
-    track = _resolve_track(track_url, client_id)
+    track = _resolve_track(track_url)
 
     title = (track.get("title") or "").strip()
     uploader = (track.get("user") or {}).get("username", "").strip()
@@ -38,48 +64,198 @@ def get_soundcloud_track_info(track_url: str) -> dict:
     }
 
 
-def get_audio_from_soundcloud(track_url: str, output_dir: str, filename: str) -> str:
+def get_audio_from_soundcloud(
+    track_url: str,
+    output_dir: str,
+    filename: str,
+    on_stream_selected: Optional[Callable[[StreamCandidate], None]] = None,
+    resolved_track: Optional[dict] = None,
+) -> str:
     """Download a track's audio from SoundCloud. Returns the final filepath,
     already in mp3 format - unlike YouTube, no separate conversion step is
-    needed afterwards."""
+    needed afterwards. `on_stream_selected` is told which transcoding was
+    picked (see source_selection.py), e.g. to record its bitrate.
+    `resolved_track` skips resolving the URL again when the caller already has
+    (e.g. preflight_sources)."""
     if not filename.endswith(FILE_EXTENSION_MP3):
         filename += FILE_EXTENSION_MP3
 
     print(f"\nDownloading '{filename.rstrip(FILE_EXTENSION_MP3)}' from SoundCloud")
 
-    client_id = get_client_id()
-    track = _resolve_track(track_url, client_id)
-    stream_url = _get_progressive_stream_url(track, client_id)
-
+    track = resolved_track or _resolve_track(track_url)
     output_filepath = os.path.join(output_dir, filename)
-    with requests.get(stream_url, headers=HEADERS, timeout=30, stream=True) as response:
-        response.raise_for_status()
-        with open(output_filepath, "wb") as f:
-            for chunk in response.iter_content(chunk_size=1024 * 256):
-                f.write(chunk)
 
+    candidate = _get_downloadable_transcoding(track)
+    if on_stream_selected is not None:
+        on_stream_selected(candidate)
+    transcoding = cast(dict, candidate.stream)
+    stream_url = _get_stream_url(transcoding)
+    with phase("download"):
+        if transcoding["format"]["protocol"] == "progressive":
+            _download_with_resume(stream_url, output_filepath)
+        else:
+            _download_hls_stream(stream_url, output_filepath)
     return output_filepath
 
 
-def _resolve_track(track_url: str, client_id: str) -> dict:
-    response = requests.get(
-        RESOLVE_URL, params={"url": track_url, "client_id": client_id}, headers=HEADERS, timeout=15
-    )
+def _download_with_resume(url: str, output_filepath: str) -> None:
+    """Download `url` to `output_filepath` via a `.part` file. An interrupted
+    transfer - earlier in this call, or in a previous run - is resumed with an
+    HTTP Range request instead of starting over, and the `.part` file is only
+    renamed to its final name once its size matches what the server announced,
+    so a truncated file never passes for a finished download."""
+    part_filepath = output_filepath + FILE_EXTENSION_PART
+    for attempt in range(NUM_RETRIES + 1):
+        try:
+            total_bytes = _download_remaining_bytes(url, part_filepath)
+            downloaded_bytes = os.path.getsize(part_filepath)
+            if total_bytes is not None and downloaded_bytes != total_bytes:
+                raise IncompleteDownloadError(
+                    f"Incomplete download: {downloaded_bytes} of {total_bytes} bytes"
+                )
+            break
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            IncompleteDownloadError,
+        ) as error:
+            if attempt == NUM_RETRIES:
+                raise
+            print(f"Download interrupted ({error}), resuming")
+
+    os.replace(part_filepath, output_filepath)
+
+
+def _download_remaining_bytes(
+    url: str, part_filepath: str, restarted: bool = False
+) -> Optional[int]:
+    """Append whatever `part_filepath` is still missing, returning the full size
+    of the file according to the server (None if it didn't say). `restarted` is
+    set on the one retry from byte 0 after a `.part` that couldn't be resumed."""
+    resume_from = os.path.getsize(part_filepath) if os.path.exists(part_filepath) else 0
+    headers = dict(HEADERS)
+    if resume_from:
+        headers["Range"] = f"bytes={resume_from}-"
+
+    with get_http_session().get(url, headers=headers, timeout=30, stream=True) as response:
+        if response.status_code == 416:
+            total_bytes = _get_total_bytes(response)
+            if total_bytes == resume_from:
+                # Range starts right at the end: the previous attempt had in fact
+                # received everything.
+                return total_bytes
+            if restarted:
+                # Still refused after starting over: give up on this download.
+                response.raise_for_status()
+        else:
+            response.raise_for_status()
+            if response.status_code == 206:
+                mode = "ab"
+            else:
+                # The server ignored the Range header and sent the whole file again.
+                mode = "wb"
+            total_bytes = _get_total_bytes(response)
+            with open(part_filepath, mode) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    add_bytes(len(chunk))
+            return total_bytes
+
+    # Range starts past the end: the `.part` is longer than the remote file (e.g.
+    # left over from a different transcoding), so it can't be resumed. Start over
+    # from byte 0, once.
+    print("Partial download is longer than the remote file, starting over")
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(part_filepath)
+    return _download_remaining_bytes(url, part_filepath, restarted=True)
+
+
+def _get_total_bytes(response: requests.Response) -> Optional[int]:
+    """Full size of the resource: from Content-Range ("bytes 100-999/1000", or
+    "bytes */1000" on a 416) for ranged responses, Content-Length otherwise."""
+    content_range = response.headers.get("Content-Range")
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get("Content-Length")
+    if response.status_code == 200 and content_length and content_length.isdigit():
+        return int(content_length)
+    return None
+
+
+def _resolve_track(track_url: str) -> dict:
+    response = soundcloud_api_get(RESOLVE_URL, params={"url": track_url}, timeout=15)
     response.raise_for_status()
     return response.json()
 
 
-def _get_progressive_stream_url(track: dict, client_id: str) -> str:
-    transcodings = track.get("media", {}).get("transcodings", [])
-    progressive = next(
-        (t for t in transcodings if t.get("format", {}).get("protocol") == "progressive"), None
-    )
-    if not progressive:
-        raise NoProgressiveStreamAvailableError(
-            f"No progressive stream available for {track.get('permalink_url')}"
-        )
-    response = requests.get(
-        progressive["url"], params={"client_id": client_id}, headers=HEADERS, timeout=15
+def _get_downloadable_transcoding(track: dict) -> StreamCandidate:
+    """The best progressive or non-encrypted mp3 HLS transcoding; progressive
+    wins between equivalent ones."""
+    candidate = select_stream(get_soundcloud_candidates(track))
+    if candidate is not None:
+        return candidate
+    raise NoProgressiveStreamAvailableError(
+        f"No progressive or plain HLS stream available for {track.get('permalink_url')}"
     )
+
+
+def _get_stream_url(transcoding: dict) -> str:
+    response = soundcloud_api_get(transcoding["url"], params={}, timeout=15)
     response.raise_for_status()
     return response.json()["url"]
+
+
+def _download_hls_stream(playlist_url: str, output_filepath: str) -> None:
+    """Download every segment of an mp3 HLS stream and concatenate them, in
+    order, into `output_filepath`. mp3 is a sequence of self-contained frames, so
+    the joined segments are a regular mp3 file - no remux or re-encode needed.
+    Segments are downloaded concurrently into memory (a track is only a few
+    MB), and the file goes through a `.part` file like progressive downloads."""
+    segment_urls = _get_hls_segment_urls(playlist_url)
+    session = get_http_session()
+
+    def download_segment(segment_url: str) -> bytes:
+        response = session.get(segment_url, headers=HEADERS, timeout=30)
+        response.raise_for_status()
+        return response.content
+
+    with ThreadPoolExecutor(max_workers=HLS_SEGMENT_JOBS) as executor:
+        # map() keeps the playlist order, whichever segment finishes first.
+        segments = list(executor.map(download_segment, segment_urls))
+
+    part_filepath = output_filepath + FILE_EXTENSION_PART
+    with open(part_filepath, "wb") as f:
+        for segment in segments:
+            f.write(segment)
+    add_bytes(sum(len(segment) for segment in segments))
+    os.replace(part_filepath, output_filepath)
+
+
+def _get_hls_segment_urls(playlist_url: str) -> List[str]:
+    """Absolute segment URLs of an HLS media playlist, in playback order. A
+    master playlist is followed to its first variant."""
+    response = get_http_session().get(playlist_url, headers=HEADERS, timeout=15)
+    response.raise_for_status()
+
+    segment_urls = []
+    is_variant_uri = False
+    for line in response.text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#EXT-X-KEY") and "METHOD=NONE" not in line:
+            raise EncryptedHlsStreamError(f"HLS stream is encrypted: {playlist_url}")
+        if line.startswith("#EXT-X-STREAM-INF"):
+            is_variant_uri = True
+            continue
+        if line.startswith("#"):
+            continue
+        if is_variant_uri:
+            return _get_hls_segment_urls(urljoin(playlist_url, line))
+        segment_urls.append(urljoin(playlist_url, line))
+
+    if not segment_urls:
+        raise NoProgressiveStreamAvailableError(f"HLS playlist has no segments: {playlist_url}")
+    return segment_urls
@@ -2,17 +2,26 @@
 the same ones soundcloud.com's own web player uses. There's no official public
 API key program anymore, so this scrapes a client_id out of SoundCloud's own JS
 bundles, the same way it always resolves the ones its own web player uses."""
+import json
+import os
 import re
-from typing import Dict, List, Optional
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
 
 import requests
 
+from src.cache_dir import get_cache_path
 from src.data_handling import (
     DURATION_THRESHOLD,
     FALLBACK_DURATION_THRESHOLD,
     find_closest_matching_result,
     get_song_search_string,
 )
+from src.http_session import get_http_session
+from src.metrics import phase
+from src.rate_limiting import rate_limited
+from src.search_cache import get_search_cache
 
 USER_AGENT = (
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
@@ -23,7 +32,18 @@ HEADERS = {"User-Agent": USER_AGENT}
 SEARCH_URL = "https://api-v2.soundcloud.com/search/tracks"
 RESOLVE_URL = "https://api-v2.soundcloud.com/resolve"
 
+SEARCH_SOURCE = "soundcloud"
+
+# A working client_id is remembered on disk for CLIENT_ID_VALIDITY_SECONDS, so
+# neither a new process nor a new call has to scrape or re-validate one. Within
+# that window it's trusted until the API actually rejects it (401/403).
+# In the cache directory (see cache_dir.py).
+CLIENT_ID_CACHE_FILENAME = ".soundcloud_client_id.json"
+CLIENT_ID_VALIDITY_SECONDS = 24 * 3600
+CLIENT_ID_REJECTED_STATUS_CODES = (401, 403)
+
 _cached_client_id: Optional[str] = None
+_client_id_lock = threading.Lock()
 
 
 class NoMatchingSoundcloudTrackFoundError(Exception):
@@ -35,38 +55,124 @@ class SoundcloudClientIdUnavailableError(Exception):
 
 
 def get_client_id() -> str:
-    """Get a working SoundCloud client_id, reusing a cached one if it's still
-    valid. Candidates scraped from SoundCloud's JS bundles are validated against
-    a real API call rather than trusted on regex match alone - bundles can
-    contain unrelated strings that happen to match the pattern."""
+    """Get a working SoundCloud client_id: the one already in use, or the one
+    persisted on disk if it's within its validity window, or else a freshly
+    scraped one. Only scraped candidates are validated against a real API call
+    - bundles can contain unrelated strings that happen to match the pattern; a
+    known-good ID is trusted until soundcloud_api_get sees it rejected."""
     global _cached_client_id
-    if _cached_client_id and _is_client_id_valid(_cached_client_id):
-        return _cached_client_id
+    with _client_id_lock:
+        if _cached_client_id:
+            return _cached_client_id
+
+        client_id_cache = _load_client_id_cache()
+        client_id = client_id_cache.get("client_id")
+        if client_id:
+            is_fresh = time.time() - client_id_cache.get("validated_at", 0) < CLIENT_ID_VALIDITY_SECONDS
+            # Past its window, one test search is still far cheaper than scraping.
+            if is_fresh or _is_client_id_valid(client_id):
+                if not is_fresh:
+                    client_id_cache["validated_at"] = time.time()
+                    _save_client_id_cache(client_id_cache)
+                _cached_client_id = client_id
+                return client_id
 
-    for candidate in _scrape_client_id_candidates():
-        if _is_client_id_valid(candidate):
-            _cached_client_id = candidate
-            return candidate
+        bundle_candidates: Dict[str, List[str]] = client_id_cache.get("bundle_candidates", {})
+        for candidate in _scrape_client_id_candidates(bundle_candidates):
+            if _is_client_id_valid(candidate):
+                _cached_client_id = candidate
+                _save_client_id_cache(
+                    {
+                        "client_id": candidate,
+                        "validated_at": time.time(),
+                        "bundle_candidates": bundle_candidates,
+                    }
+                )
+                return candidate
+        # Keep what was learned about the bundles even though none of them worked.
+        client_id_cache["bundle_candidates"] = bundle_candidates
+        _save_client_id_cache(client_id_cache)
 
     raise SoundcloudClientIdUnavailableError("Could not obtain a working SoundCloud client_id")
 
 
-def _scrape_client_id_candidates() -> List[str]:
-    html = requests.get("https://soundcloud.com", headers=HEADERS, timeout=15).text
+def invalidate_client_id(client_id: str) -> None:
+    """Forget `client_id` after the API rejected it, so the next get_client_id
+    scrapes a new one. A no-op if another thread already replaced it."""
+    global _cached_client_id
+    with _client_id_lock:
+        if _cached_client_id == client_id:
+            _cached_client_id = None
+        client_id_cache = _load_client_id_cache()
+        if client_id_cache.get("client_id") == client_id:
+            client_id_cache.pop("client_id")
+            _save_client_id_cache(client_id_cache)
+
+
+def soundcloud_api_get(url: str, params: Dict, timeout: float) -> requests.Response:
+    """GET an api-v2 endpoint with the current client_id added to `params`. If
+    the client_id is rejected (401/403), it's dropped and the request is made
+    once more with a freshly obtained one. Doesn't raise on other HTTP errors -
+    callers still call raise_for_status."""
+    for attempt in range(2):
+        client_id = get_client_id()
+        response = get_http_session().get(
+            url, params={**params, "client_id": client_id}, headers=HEADERS, timeout=timeout
+        )
+        if response.status_code not in CLIENT_ID_REJECTED_STATUS_CODES or attempt == 1:
+            return response
+        invalidate_client_id(client_id)
+    return response
+
+
+def _load_client_id_cache() -> Dict:
+    try:
+        with open(get_cache_path(CLIENT_ID_CACHE_FILENAME), "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_client_id_cache(client_id_cache: Dict) -> None:
+    # Written to a temp file and renamed, so a concurrent reader (another
+    # process) never sees a half-written file.
+    try:
+        cache_path = get_cache_path(CLIENT_ID_CACHE_FILENAME)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(client_id_cache, file)
+        os.replace(tmp_path, cache_path)
+    except OSError as error:
+        print(f"Could not save the SoundCloud client_id cache: {error}")
+
+
+def _scrape_client_id_candidates(bundle_candidates: Dict[str, List[str]]) -> Iterator[str]:
+    """Yield client_id candidates from SoundCloud's JS bundles, one bundle at a
+    time, so scraping stops as soon as the caller finds a valid one.
+
+    Bundle URLs are content-hashed, so a bundle's candidates never change:
+    `bundle_candidates` (bundle URL -> candidates) is used instead of fetching a
+    bundle seen before, and is updated in place with the ones fetched now -
+    pruned to the bundles the homepage currently references."""
+    session = get_http_session()
+    html = session.get("https://soundcloud.com", headers=HEADERS, timeout=15).text
     script_srcs = [
         src for src in re.findall(r'<script[^>]+src="([^"]+)"', html) if "sndcdn.com" in src
     ]
-    candidates = []
+    for stale_src in set(bundle_candidates) - set(script_srcs):
+        del bundle_candidates[stale_src]
+
     # SoundCloud's own config tends to live in one of the later-loaded bundles.
     for src in reversed(script_srcs):
-        js = requests.get(src, headers=HEADERS, timeout=15).text
-        candidates.extend(re.findall(r'client_id\s*[:=]\s*"([a-zA-Z0-9]{16,})"', js))
-    return candidates
+        if src not in bundle_candidates:
+            js = session.get(src, headers=HEADERS, timeout=15).text
+            bundle_candidates[src] = re.findall(r'client_id\s*[:=]\s*"([a-zA-Z0-9]{16,})"', js)
+        yield from bundle_candidates[src]
 
 
 def _is_client_id_valid(client_id: str) -> bool:
     try:
-        response = requests.get(
+        response = get_http_session().get(
             SEARCH_URL,
             params={"q": "a", "client_id": client_id, "limit": 1},
             headers=HEADERS,
@@ -77,12 +183,20 @@ def _is_client_id_valid(client_id: str) -> bool:
         return False
 
 
-def _has_usable_progressive_stream(track: dict) -> bool:
-    """Whether a track's progressive (plain HTTP mp3) stream is actually reachable.
+def is_downloadable_hls_transcoding(transcoding: dict) -> bool:
+    """Whether a transcoding is plain (non-encrypted) HLS of mp3 segments - the
+    kind whose segments can simply be concatenated into one mp3 file."""
+    stream_format = transcoding.get("format", {})
+    return stream_format.get("protocol") == "hls" and stream_format.get("mime_type") == "audio/mpeg"
+
+
+def _has_usable_stream(track: dict) -> bool:
+    """Whether a track has a stream we can actually download: progressive (plain
+    HTTP mp3), or else non-encrypted mp3 HLS.
 
-    Some tracks list a progressive transcoding in their metadata that 404s in
+    Some tracks list progressive/hls transcodings in their metadata that 404 in
     practice - verified empirically: when an encrypted-hls variant is also listed
-    alongside it, the plain progressive/hls entries turn out to be non-functional,
+    alongside them, the plain progressive/hls entries turn out to be non-functional,
     and only the encrypted streams (real DRM, not something we decrypt) actually
     work. The `policy`/`monetization_model` fields don't reliably predict this -
     they're identical between tracks that do and don't actually work - so presence
@@ -90,29 +204,32 @@ def _has_usable_progressive_stream(track: dict) -> bool:
     """
     transcodings = track.get("media", {}).get("transcodings", [])
     has_progressive = any(t.get("format", {}).get("protocol") == "progressive" for t in transcodings)
+    has_hls = any(is_downloadable_hls_transcoding(t) for t in transcodings)
     has_encrypted = any("encrypted" in t.get("format", {}).get("protocol", "") for t in transcodings)
-    return has_progressive and not has_encrypted
+    return (has_progressive or has_hls) and not has_encrypted
 
 
 def search_soundcloud_tracks(query: str, limit: int = 10) -> List[dict]:
     """Search SoundCloud for tracks matching a query. Only returns tracks with a
-    usable progressive stream, so a track known to be undownloadable never gets
+    usable stream (see _has_usable_stream), so a track known to be undownloadable never gets
     picked as a match - meaning the YouTube fallback kicks in immediately at
-    matching time instead of only after a wasted download attempt."""
-    client_id = get_client_id()
-    response = requests.get(
-        SEARCH_URL,
-        params={"q": query, "client_id": client_id, "limit": limit},
-        headers=HEADERS,
-        timeout=15,
+    matching time instead of only after a wasted download attempt. Served from the
+    on-disk search cache when this exact search was run before."""
+    return get_search_cache().get_or_fetch(
+        SEARCH_SOURCE, query, limit, lambda: _fetch_soundcloud_tracks(query, limit)
     )
-    response.raise_for_status()
+
+
+def _fetch_soundcloud_tracks(query: str, limit: int) -> List[dict]:
+    with rate_limited(SEARCH_SOURCE), phase("search"):
+        response = soundcloud_api_get(SEARCH_URL, params={"q": query, "limit": limit}, timeout=15)
+        response.raise_for_status()
 
     results = []
     for track in response.json().get("collection", []):
         if track.get("kind") != "track" or not track.get("permalink_url"):
             continue
-        if not _has_usable_progressive_stream(track):
+        if not _has_usable_stream(track):
             continue
         uploader = track.get("user", {}).get("username", "")
         results.append(
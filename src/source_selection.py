@@ -0,0 +1,182 @@
+"""Module for choosing which stream to download a track from, by comparing what
+each source actually offers instead of going by a fixed preference order.
+
+Both sources publish a manifest of their streams before any audio is fetched:
+SoundCloud lists its transcodings in the resolved track, and YouTube lists its
+streams (codec, average bitrate, size) in the player response pytubefix parses.
+Each stream is turned into a StreamCandidate and scored by its effective
+quality - its bitrate, weighted by how efficient its codec is, and discounted
+when it will still need a lossy transcode to reach the output format (mp3). The
+best-scoring candidate wins; candidates within EQUIVALENT_QUALITY_MARGIN of it
+are considered just as good, and among those the choice follows a fixed order:
+the preferred source (SOURCE_PREFERENCE), then the more efficient codec, then
+the fewest bytes to download. Sizes only decide within one source - SoundCloud
+doesn't publish its sizes, so they're estimated from the bitrate and can't
+fairly be weighed against YouTube's. Remaining ties keep the order the
+candidates were listed in (progressive before HLS).
+
+preflight_sources hands back the resolved SoundCloud track and the YouTube
+object along with its verdict, so the download that follows reuses them
+instead of resolving the track or fetching the player response a second time."""
+import re
+from typing import Iterable, List, NamedTuple, Optional, Union
+
+from pytubefix import Stream, YouTube
+
+from src.content_store import SOURCE_SOUNDCLOUD, SOURCE_YOUTUBE
+from src.rate_limiting import rate_limited
+from src.soundcloud_search import RESOLVE_URL, is_downloadable_hls_transcoding, soundcloud_api_get
+
+OUTPUT_CODEC = "mp3"
+
+# Rough perceptual efficiency per kbps, relative to mp3: AAC and Opus reach the
+# same quality at noticeably lower bitrates.
+CODEC_EFFICIENCY = {"mp3": 1.0, "aac": 1.3, "opus": 1.5}
+# Streams not already in the output codec lose some of that quality again in
+# the conversion's lossy re-encode.
+TRANSCODE_PENALTY = 0.8
+EQUIVALENT_QUALITY_MARGIN = 0.1
+# Which source wins between equivalent-quality candidates.
+SOURCE_PREFERENCE = (SOURCE_SOUNDCLOUD, SOURCE_YOUTUBE)
+
+# SoundCloud's transcodings don't state their bitrate; presets either spell it
+# out ("aac_160k") or are the fixed-rate defaults below.
+SOUNDCLOUD_DEFAULT_KBPS_BY_CODEC = {"mp3": 128, "opus": 64, "aac": 160}
+_PRESET_KBPS_PATTERN = re.compile(r"(\d+)k")
+_YOUTUBE_ABR_PATTERN = re.compile(r"(\d+)kbps")
+
+
+class StreamCandidate(NamedTuple):
+    source: str
+    codec: str
+    bitrate_kbps: int
+    size_bytes: int
+    # The pytubefix Stream, or the SoundCloud transcoding dict.
+    stream: Union[Stream, dict]
+
+
+class Preflight(NamedTuple):
+    # The best stream across both sources (None if neither manifest could be read).
+    best: Optional[StreamCandidate]
+    # What was fetched to get there, for the download to reuse.
+    soundcloud_track: Optional[dict]
+    youtube: Optional[YouTube]
+
+
+def get_effective_quality(candidate: StreamCandidate) -> float:
+    quality = candidate.bitrate_kbps * CODEC_EFFICIENCY.get(candidate.codec, 1.0)
+    if candidate.codec != OUTPUT_CODEC:
+        quality *= TRANSCODE_PENALTY
+    return quality
+
+
+def select_stream(candidates: Iterable[StreamCandidate]) -> Optional[StreamCandidate]:
+    """The best-quality candidate, breaking near-ties by source preference, codec
+    efficiency and then size (see the module docstring). None if there are no
+    candidates."""
+    candidates = list(candidates)
+    if not candidates:
+        return None
+    best_quality = max(get_effective_quality(candidate) for candidate in candidates)
+    equivalent = [
+        candidate
+        for candidate in candidates
+        if get_effective_quality(candidate) >= best_quality * (1 - EQUIVALENT_QUALITY_MARGIN)
+    ]
+    return min(
+        equivalent,
+        key=lambda candidate: (
+            SOURCE_PREFERENCE.index(candidate.source),
+            -CODEC_EFFICIENCY.get(candidate.codec, 1.0),
+            candidate.size_bytes,
+        ),
+    )
+
+
+def get_soundcloud_candidates(track: dict) -> List[StreamCandidate]:
+    """Candidates for a resolved SoundCloud track's downloadable transcodings:
+    progressive ones first, then non-encrypted mp3 HLS."""
+    duration_s = (track.get("duration") or 0) / 1000
+    transcodings = track.get("media", {}).get("transcodings", [])
+    downloadable = [
+        t for t in transcodings if t.get("format", {}).get("protocol") == "progressive"
+    ] + [t for t in transcodings if is_downloadable_hls_transcoding(t)]
+
+    candidates = []
+    for transcoding in downloadable:
+        codec = _get_soundcloud_codec(transcoding)
+        preset_match = _PRESET_KBPS_PATTERN.search(transcoding.get("preset", ""))
+        bitrate_kbps = (
+            int(preset_match.group(1))
+            if preset_match
+            else SOUNDCLOUD_DEFAULT_KBPS_BY_CODEC.get(codec, SOUNDCLOUD_DEFAULT_KBPS_BY_CODEC["mp3"])
+        )
+        candidates.append(
+            StreamCandidate(
+                source=SOURCE_SOUNDCLOUD,
+                codec=codec,
+                bitrate_kbps=bitrate_kbps,
+                size_bytes=int(duration_s * bitrate_kbps * 1000 / 8),
+                stream=transcoding,
+            )
+        )
+    return candidates
+
+
+def _get_soundcloud_codec(transcoding: dict) -> str:
+    mime_type = transcoding.get("format", {}).get("mime_type", "")
+    if mime_type == "audio/mpeg":
+        return "mp3"
+    if "opus" in mime_type:
+        return "opus"
+    if "mp4" in mime_type:
+        return "aac"
+    return mime_type
+
+
+def get_youtube_candidates(streams: Iterable) -> List[StreamCandidate]:
+    """Candidates for the pytubefix streams that carry audio (an average bitrate)."""
+    candidates = []
+    for stream in streams:
+        abr_match = _YOUTUBE_ABR_PATTERN.match(getattr(stream, "abr", None) or "")
+        if abr_match is None:
+            continue
+        audio_codec = getattr(stream, "audio_codec", None) or ""
+        codec = "aac" if audio_codec.startswith("mp4a") else audio_codec
+        candidates.append(
+            StreamCandidate(
+                source=SOURCE_YOUTUBE,
+                codec=codec,
+                bitrate_kbps=int(abr_match.group(1)),
+                # The approximate size comes with the manifest; the exact one can
+                # cost an extra request per stream.
+                size_bytes=int(getattr(stream, "filesize_approx", None) or 0),
+                stream=stream,
+            )
+        )
+    return candidates
+
+
+def preflight_sources(soundcloud_url: str, youtube_url: str) -> Preflight:
+    """Fetch both sources' stream manifests for a track matched on both, and
+    pick the best stream across them. A source whose manifest can't be fetched
+    simply doesn't compete (and isn't handed back for reuse)."""
+    candidates: List[StreamCandidate] = []
+    soundcloud_track = None
+    try:
+        response = soundcloud_api_get(RESOLVE_URL, params={"url": soundcloud_url}, timeout=15)
+        response.raise_for_status()
+        soundcloud_track = response.json()
+        candidates += get_soundcloud_candidates(soundcloud_track)
+    except Exception as error:
+        print(f"Could not read the SoundCloud stream manifest for {soundcloud_url}: {error}")
+    yt = None
+    try:
+        # Paced by the same limiter as the YouTube downloads themselves.
+        with rate_limited("youtube_download"):
+            yt = YouTube(youtube_url, client="WEB_MUSIC")
+            candidates += get_youtube_candidates(yt.streams.filter(only_audio=True, subtype="mp4"))
+    except Exception as error:
+        print(f"Could not read the YouTube stream manifest for {youtube_url}: {error}")
+        yt = None
+    return Preflight(select_stream(candidates), soundcloud_track, yt)
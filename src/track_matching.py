@@ -0,0 +1,157 @@
+"""Module for matching tracks against every search source at once, used by the
+app's matching stage. SoundCloud is the preferred source and YouTube Music the
+fallback, but rather than waiting for SoundCloud to come up empty before even
+starting on YouTube Music, both lookups for a track run side by side, and
+several tracks are matched at once - matching is almost entirely network wait.
+
+The preference order is unaffected by the concurrency: a SoundCloud match always
+wins. The YouTube Music lookup still runs to the end, though, and its result is
+returned alongside the SoundCloud one: a track matched on both sources gets its
+two stream manifests compared before downloading (see source_selection.py), and
+that needs the video id too. Since both lookups start together, waiting for it
+only costs whatever part of the YouTube Music search outlasts SoundCloud's."""
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from src.data_handling import get_song_search_string, get_song_search_string_variants
+from src.match_memo import MEMO_SOURCE_SOUNDCLOUD, MEMO_SOURCE_YOUTUBE_MUSIC, get_match_memo
+from src.metrics import TrackMetrics, attach_track_metrics, track_metrics
+from src.soundcloud_search import (
+    NoMatchingSoundcloudTrackFoundError,
+    find_best_matching_soundcloud_track,
+    search_soundcloud_tracks,
+)
+from src.youtube_music_search import (
+    NoMatchingYoutubeMusicVideoFoundError,
+    find_best_matching_youtube_music_video,
+    get_youtube_music_search_results,
+)
+
+MATCHING_JOBS = 4
+
+
+def find_soundcloud_match(
+    row: Dict, search_strings: List[str], cancel_event: Optional[threading.Event] = None
+) -> Optional[str]:
+    """Try each query variant in order (see get_song_search_string_variants),
+    returning the first match found, or None if none of them match."""
+    soundcloud_url, _ = _search_soundcloud_variants(row, search_strings, cancel_event)
+    return soundcloud_url
+
+
+def _search_soundcloud_variants(
+    row: Dict, search_strings: List[str], cancel_event: Optional[threading.Event] = None
+) -> Tuple[Optional[str], bool]:
+    """find_soundcloud_match, also reporting whether any search failed outright -
+    a "no match" reached that way shouldn't be remembered as a real one."""
+    had_error = False
+    for search_string in search_strings:
+        if cancel_event is not None and cancel_event.is_set():
+            return None, had_error
+        try:
+            results = search_soundcloud_tracks(search_string)
+            return find_best_matching_soundcloud_track(db_entry=row, search_results=results), had_error
+        except NoMatchingSoundcloudTrackFoundError:
+            continue
+        except Exception as exc:
+            # SoundCloud is an unofficial API (scraped client_id, reverse-engineered
+            # endpoints) - any failure here just means falling back to YouTube,
+            # not failing the match.
+            print(f"SoundCloud search failed for '{search_string}': {exc}")
+            had_error = True
+            continue
+    return None, had_error
+
+
+def find_youtube_music_match(
+    row: Dict, search_strings: List[str], cancel_event: Optional[threading.Event] = None
+) -> Optional[str]:
+    """Try each query variant in order (see get_song_search_string_variants),
+    returning the first match found, or None if none of them match."""
+    for search_string in search_strings:
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        try:
+            results = get_youtube_music_search_results(search_string)
+            return find_best_matching_youtube_music_video(db_entry=row, search_results=results)
+        except NoMatchingYoutubeMusicVideoFoundError:
+            continue
+    return None
+
+
+def match_track(row: Dict, fallback_executor: Executor) -> Tuple[Optional[str], Optional[str]]:
+    """Match one track, returning (soundcloud_url, youtube_video_id) - either,
+    both or neither set, depending on which sources have a match. The YouTube Music
+    lookup runs on `fallback_executor` while SoundCloud is searched on the
+    calling thread. Either source is skipped when the match memo already knows
+    its answer for this track (see match_memo.py)."""
+    with track_metrics("matching", get_song_search_string(row)) as metrics:
+        return _match_track(row, fallback_executor, metrics)
+
+
+def _match_track(
+    row: Dict, fallback_executor: Executor, metrics: Optional[TrackMetrics]
+) -> Tuple[Optional[str], Optional[str]]:
+    memo = get_match_memo()
+    remembered_soundcloud_url = memo.lookup(row, MEMO_SOURCE_SOUNDCLOUD)
+    remembered_video_id = memo.lookup(row, MEMO_SOURCE_YOUTUBE_MUSIC)
+    if remembered_soundcloud_url and remembered_video_id is not None:
+        return remembered_soundcloud_url, remembered_video_id or None
+
+    search_strings = get_song_search_string_variants(row)
+    youtube_future = None
+    if remembered_video_id is None:
+        youtube_future = fallback_executor.submit(
+            _find_youtube_music_match_measured, metrics, row, search_strings
+        )
+
+    # None means unknown; a remembered "no match" (NO_MATCH) skips the search.
+    soundcloud_url = remembered_soundcloud_url or None
+    if remembered_soundcloud_url is None:
+        soundcloud_url, had_error = _search_soundcloud_variants(row, search_strings)
+        if soundcloud_url or not had_error:
+            memo.remember(row, MEMO_SOURCE_SOUNDCLOUD, soundcloud_url)
+
+    if youtube_future is None:
+        return soundcloud_url, remembered_video_id or None
+    video_id = youtube_future.result()
+    memo.remember(row, MEMO_SOURCE_YOUTUBE_MUSIC, video_id)
+    return soundcloud_url, video_id
+
+
+def _find_youtube_music_match_measured(
+    metrics: Optional[TrackMetrics],
+    row: Dict,
+    search_strings: List[str],
+) -> Optional[str]:
+    """find_youtube_music_match, with its searches counted towards the track's
+    metrics even though it runs on the fallback pool's thread."""
+    with attach_track_metrics(metrics):
+        return find_youtube_music_match(row, search_strings)
+
+
+def match_tracks(
+    rows: Iterable[Dict], jobs: int = MATCHING_JOBS
+) -> Iterator[Tuple[Dict, Optional[str], Optional[str]]]:
+    """Match many tracks concurrently, yielding (row, soundcloud_url,
+    youtube_video_id) as each one finishes - not in input order, so callers can
+    show progress live. Rows are never modified here; applying the result is
+    left to the caller (and its thread)."""
+    # Two separate pools: a row worker blocks on its own YouTube Music lookup,
+    # so running those lookups on the same pool could deadlock once every
+    # worker is waiting on a lookup that has no free worker to run on.
+    row_executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+    fallback_executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+    try:
+        futures = {
+            row_executor.submit(match_track, row, fallback_executor): row for row in rows
+        }
+        for future in as_completed(futures):
+            soundcloud_url, video_id = future.result()
+            yield futures[future], soundcloud_url, video_id
+    finally:
+        # Also reached when the consumer stops early (e.g. Streamlit interrupting
+        # the script mid-stage) - drop whatever hasn't started yet.
+        row_executor.shutdown(wait=False, cancel_futures=True)
+        fallback_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,184 @@
+"""Module for deciding, per file, how little work gets a download onto the
+selected target device. Conversion defaults to re-encoding everything to MP3,
+but a device whose DeviceProfile lists "aac" plays most YouTube downloads as
+they are - they're AAC-LC in an .m4a - and re-encoding those burns CPU and
+costs a generation of lossy quality for nothing.
+
+For each file the planner picks one of:
+  * PLAN_KEEP      - already a clean .m4a of AAC-LC the device plays: nothing to do
+  * PLAN_REMUX     - playable audio in a container the device rejects (fragmented
+                     DASH MP4, an extra video track, .mp4 instead of .m4a):
+                     stream-copy it into a clean .m4a
+  * PLAN_TRANSCODE - anything else (HE-AAC, Opus, odd sample rates, or a device
+                     without AAC support): re-encode to MP3 as before
+
+The checks mirror check_hardware_compat.py's MP4 checks, so a kept or remuxed
+file passes that script for the same device. TranscodeReport adds up how much
+encoding the kept and remuxed files spared. It uses the encode speed measured
+on this run's transcodes, or ESTIMATED_ENCODE_SECONDS_PER_AUDIO_SECOND when
+there were none."""
+import json
+import os
+import struct
+import subprocess
+from typing import List, NamedTuple, Optional
+
+from src.device_profiles import DeviceProfile
+
+# Not src.file_metadata's constants: that module needs mutagen, and
+# check_hardware_compat.py (which uses scan_mp4_boxes) only needs ffprobe.
+MP4_EXTENSIONS = (".mp4", ".m4a")
+CLEAN_AAC_EXTENSION = ".m4a"
+
+PLAN_KEEP = "keep"
+PLAN_REMUX = "remux"
+PLAN_TRANSCODE = "transcode"
+
+# Sample rates every AAC-capable player in DEVICE_PROFILES decodes.
+PLAYABLE_AAC_SAMPLE_RATES = (44100, 48000)
+
+# LAME encodes a typical track at roughly 50x realtime on one core.
+ESTIMATED_ENCODE_SECONDS_PER_AUDIO_SECOND = 0.02
+
+
+class TranscodePlan(NamedTuple):
+    action: str
+    reason: str
+    # Length of the audio, for the encode time report (0 if unknown).
+    duration_s: float
+
+
+def get_passthrough_path(filepath: str) -> str:
+    """Where a kept or remuxed file ends up: the source itself, or the .m4a next to it."""
+    return os.path.splitext(filepath)[0] + CLEAN_AAC_EXTENSION
+
+
+def get_passthrough_settings(device_profile: DeviceProfile) -> str:
+    """The settings a kept/remuxed file is recorded with in the conversion manifest."""
+    return f"aac passthrough for {device_profile.name}"
+
+
+def plan_transcode(filepath: str, device_profile: DeviceProfile) -> TranscodePlan:
+    """Decide whether `filepath` can be kept as is, remuxed, or must be transcoded
+    to play on `device_profile`."""
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext not in MP4_EXTENSIONS:
+        return TranscodePlan(PLAN_TRANSCODE, "not an MP4 container", 0.0)
+    # Before probing: for a device without AAC every file is transcoded anyway.
+    if "aac" not in device_profile.formats:
+        return TranscodePlan(PLAN_TRANSCODE, f"{device_profile.name} doesn't play AAC", 0.0)
+
+    probe = _ffprobe(filepath)
+    if probe is None:
+        return TranscodePlan(PLAN_TRANSCODE, "ffprobe could not read it", 0.0)
+    duration_s = float(probe.get("format", {}).get("duration") or 0.0)
+
+    def transcode(reason: str) -> TranscodePlan:
+        return TranscodePlan(PLAN_TRANSCODE, reason, duration_s)
+
+    audio_streams = [s for s in probe["streams"] if s["codec_type"] == "audio"]
+    if not audio_streams:
+        return transcode("no audio track")
+    audio = audio_streams[0]
+    if audio.get("codec_name") != "aac":
+        return transcode(f"{audio.get('codec_name')} audio")
+    profile = audio.get("profile") or ""
+    if "HE" in profile or "SBR" in profile:
+        return transcode(f"AAC profile is {profile}, players decode AAC-LC only")
+    sample_rate = int(audio.get("sample_rate") or 0)
+    if sample_rate not in PLAYABLE_AAC_SAMPLE_RATES or (
+        device_profile.max_sample_rate_hz and sample_rate > device_profile.max_sample_rate_hz
+    ):
+        return transcode(f"{sample_rate} Hz sample rate")
+    if int(audio.get("channels") or 2) > 2:
+        return transcode(f"{audio.get('channels')} channels")
+
+    boxes = scan_mp4_boxes(filepath)
+    if "moof" in boxes or "sidx" in boxes or "styp" in boxes:
+        return TranscodePlan(PLAN_REMUX, "fragmented DASH MP4 container", duration_s)
+    if boxes.count("moov") > 1 or (boxes and boxes[0] != "ftyp"):
+        return TranscodePlan(PLAN_REMUX, "irregular MP4 container", duration_s)
+    if len(audio_streams) > 1 or any(
+        s["codec_type"] == "video" and not s.get("disposition", {}).get("attached_pic")
+        for s in probe["streams"]
+    ):
+        return TranscodePlan(PLAN_REMUX, "extra tracks besides the audio", duration_s)
+    if ext != CLEAN_AAC_EXTENSION:
+        return TranscodePlan(PLAN_REMUX, "audio in an .mp4 file", duration_s)
+    return TranscodePlan(PLAN_KEEP, "clean AAC-LC .m4a", duration_s)
+
+
+def scan_mp4_boxes(filepath: str) -> List[str]:
+    """Return the top-level MP4 box names, e.g. ['ftyp', 'moov', 'mdat']."""
+    boxes = []
+    size = os.path.getsize(filepath)
+    pos = 0
+    with open(filepath, "rb") as file:
+        while pos < size - 8:
+            file.seek(pos)
+            header = file.read(8)
+            if len(header) < 8:
+                break
+            (box_size,) = struct.unpack(">I", header[:4])
+            name = header[4:8].decode("latin1")
+            if box_size == 1:  # 64-bit box size
+                (box_size,) = struct.unpack(">Q", file.read(8))
+            if box_size < 8:
+                break
+            boxes.append(name)
+            pos += box_size
+    return boxes
+
+
+def _ffprobe(filepath: str) -> Optional[dict]:
+    """Run ffprobe and return the parsed JSON, or None if the file cannot be parsed."""
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_format", "-show_streams", "-of", "json", filepath],
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    return json.loads(result.stdout)
+
+
+class TranscodeReport:
+    """Tally of what the planner decided over a run, and the encode time it saved."""
+
+    def __init__(self):
+        self.n_kept = 0
+        self.n_remuxed = 0
+        self.n_transcoded = 0
+        self.skipped_audio_s = 0.0
+        self.transcoded_audio_s = 0.0
+        self.transcode_s = 0.0
+
+    def add_skipped(self, plan: TranscodePlan) -> None:
+        if plan.action == PLAN_KEEP:
+            self.n_kept += 1
+        else:
+            self.n_remuxed += 1
+        self.skipped_audio_s += plan.duration_s
+
+    def add_transcoded(self, plan: TranscodePlan, elapsed_s: float) -> None:
+        self.n_transcoded += 1
+        if plan.duration_s:
+            self.transcoded_audio_s += plan.duration_s
+            self.transcode_s += elapsed_s
+
+    def summary(self) -> str:
+        if self.transcoded_audio_s:
+            seconds_per_audio_second = self.transcode_s / self.transcoded_audio_s
+            basis = "at this run's measured encode speed"
+        else:
+            seconds_per_audio_second = ESTIMATED_ENCODE_SECONDS_PER_AUDIO_SECOND
+            basis = "estimated"
+        skipped_s = self.skipped_audio_s * seconds_per_audio_second
+        return (
+            f"Kept {self.n_kept} and remuxed {self.n_remuxed} file(s) as AAC, "
+            f"transcoded {self.n_transcoded}: about {skipped_s:.0f}s of encoding "
+            f"skipped ({basis})"
+        )
@@ -1,56 +1,180 @@
 """Module for handling youtube download"""
 import os
+import re
 import subprocess
+from typing import IO, Callable, List, Optional
 
-from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
-from moviepy.video.io.VideoFileClip import VideoFileClip
 from pytubefix import YouTube
+from pytubefix.exceptions import BotDetection
 
 from src.file_metadata import (
     FILE_EXTENSION_M4A,
-    FILE_EXTENSION_MP3,
     FILE_EXTENSION_MP4,
+    FILE_EXTENSION_PART,
+    get_ffmpeg_metadata_args,
 )
+from src.metrics import add_bytes, phase
+from src.rate_limiting import rate_limited
+from src.source_selection import StreamCandidate, get_youtube_candidates, select_stream
 
 NUM_RETRIES = 5
 
+DOWNLOAD_SOURCE = "youtube_download"
 
-def get_audio_from_youtube(youtube_url: str, output_dir: str, filename: str) -> str:
+# How far a downloaded audio stream's duration may stray from the video's own
+# length before the download is considered corrupt/truncated.
+DURATION_TOLERANCE_SECONDS = 2
+
+# Called with the stream chosen for a download, e.g. to record its bitrate.
+StreamSelectedCallback = Optional[Callable[[StreamCandidate], None]]
+
+# "Duration: 00:03:25.47" line of `ffmpeg -i`'s input summary.
+_FFMPEG_DURATION_PATTERN = re.compile(r"Duration: (\d+):(\d{2}):(\d{2}(?:\.\d+)?)")
+
+
+class CorruptAudioDownloadError(Exception):
+    """Exception raised when a downloaded audio-only stream fails verification."""
+
+
+def get_audio_from_youtube(
+    youtube_url: str,
+    output_dir: str,
+    filename: str,
+    audio_only_first: bool = True,
+    stream_remux: bool = True,
+    on_stream_selected: StreamSelectedCallback = None,
+    metadata_tags: Optional[dict] = None,
+    yt: Optional[YouTube] = None,
+) -> str:
     """This function downloads a song from youtube.
 
-    In a first attempt, we download the video and then extract the audio, as this
-    way proved to be more reliable.
-    If that fails, we attempt to download the audio stream directly from youtube.
+    By default, we first download the best audio-only stream directly - a fraction
+    of the bytes of a full video. Direct audio-only downloads can come out
+    corrupted, so the file is verified (complete size, plausible duration) before
+    it's accepted; if that fails, we fall back to downloading the video and
+    extracting its audio, the slower but more reliable route.
+
+    With `audio_only_first=False`, the video route is tried first instead, and
+    the audio-only stream is only used if extracting the audio fails.
+
+    With `stream_remux` (the default), the audio-only stream is piped straight
+    into the remux instead of being saved to disk and read back first, so only
+    the final .m4a is ever written (see _stream_audio_from_youtube_to_m4a). If
+    streaming fails, the two-step download + remux is tried before giving up on
+    the audio-only stream.
+
+    Streams are picked from the manifest by source_selection.select_stream;
+    `on_stream_selected` is told which one, so callers can record its bitrate
+    without probing the file afterwards.
+
+    `metadata_tags` (from prepare_metadata_tags, for .m4a) are written by the
+    remux itself, so the finished file needn't be re-opened to tag it.
+
+    `yt`, if given, is a YouTube object for `youtube_url` whose streams were
+    already fetched (e.g. by preflight_sources); the first audio-only attempt
+    uses it instead of fetching the player response again. Fallback attempts
+    always start from a fresh one.
     """
-    mp4_filepath = _download_mp4_video_from_youtube(youtube_url, output_dir, filename)
+    metadata_args = get_ffmpeg_metadata_args(metadata_tags or {}, FILE_EXTENSION_M4A)
+    # Paced (and slowed down on bot detection) per process, see rate_limiting.py.
+    with rate_limited(DOWNLOAD_SOURCE):
+        return _get_audio_from_youtube(
+            youtube_url,
+            output_dir,
+            filename,
+            audio_only_first,
+            stream_remux,
+            on_stream_selected,
+            metadata_args,
+            yt,
+        )
+
+
+def _get_audio_from_youtube(
+    youtube_url: str,
+    output_dir: str,
+    filename: str,
+    audio_only_first: bool,
+    stream_remux: bool,
+    on_stream_selected: StreamSelectedCallback,
+    metadata_args: List[str],
+    yt: Optional[YouTube],
+) -> str:
+    if audio_only_first:
+        if stream_remux:
+            try:
+                return _stream_audio_from_youtube_to_m4a(
+                    youtube_url, output_dir, filename, on_stream_selected, metadata_args, yt
+                )
+            except BotDetection:
+                raise
+            except Exception as error:
+                print(f"Streaming download failed ({error}), retrying as a two-step download")
+            yt = None
+        try:
+            return _remux_to_clean_m4a(
+                _download_mp4_audio_from_youtube(
+                    youtube_url, output_dir, filename, on_stream_selected, yt
+                ),
+                metadata_args,
+            )
+        except BotDetection:
+            # Not a problem with the stream - the video route would be refused
+            # too. Let the caller's retry rounds deal with it.
+            raise
+        except Exception as error:
+            print(f"Audio-only download failed ({error}), falling back to the video stream")
+        return _get_audio_from_youtube_video(
+            youtube_url,
+            output_dir,
+            filename,
+            on_stream_selected,
+            metadata_args,
+            audio_fallback=False,
+        )
+
+    return _get_audio_from_youtube_video(
+        youtube_url, output_dir, filename, on_stream_selected, metadata_args, audio_fallback=True
+    )
+
 
-    if _is_mp4_file_audio_only(mp4_filepath):
-        return _remux_to_clean_m4a(mp4_filepath)
+def _get_audio_from_youtube_video(
+    youtube_url: str,
+    output_dir: str,
+    filename: str,
+    on_stream_selected: StreamSelectedCallback,
+    metadata_args: List[str],
+    audio_fallback: bool,
+) -> str:
+    """Download the video and extract its audio. If the extraction fails and
+    `audio_fallback` is set, download the audio stream directly instead."""
+    mp4_filepath = _download_mp4_video_from_youtube(
+        youtube_url, output_dir, filename, on_stream_selected
+    )
 
-    # If mp4 file contains video, we have to extract the audio track
-    video_processing_failed = False
     try:
-        # Extract the audio file from the previously downloaded .mp4 file.
-        audio_filepath = _extract_audio_from_mp4_video(mp4_filepath)
-    except KeyError as error:
-        print(f"Error extracting mp3 from {mp4_filepath}: {error}")
-        video_processing_failed = True
+        return _extract_audio_from_mp4_video(mp4_filepath, metadata_args)
+    except subprocess.CalledProcessError as error:
+        print(f"Error extracting the audio from {mp4_filepath}: {error}")
     finally:
-        os.remove(mp4_filepath)
+        if os.path.exists(mp4_filepath):
+            os.remove(mp4_filepath)
 
     # In case of error, download the audio directly using the only_audio=True flag. This is not
     # the default approach because this can lead to corrupted downloaded files, so we only use
     # it as a fallback.
-    if video_processing_failed:
-        audio_filepath = _remux_to_clean_m4a(
-            _download_mp4_audio_from_youtube(youtube_url, output_dir, filename)
+    if not audio_fallback:
+        raise CorruptAudioDownloadError(
+            f"Could not extract the audio from the video for '{filename}'"
         )
-
-    return audio_filepath
+    return _remux_to_clean_m4a(
+        _download_mp4_audio_from_youtube(youtube_url, output_dir, filename, on_stream_selected),
+        metadata_args,
+    )
 
 
 def _download_mp4_video_from_youtube(
-    youtube_url: str, output_dir: str, filename: str
+    youtube_url: str, output_dir: str, filename: str, on_stream_selected: StreamSelectedCallback
 ) -> str:
     """This function downloads an mp4 video stream from youtube."""
     # Ensure the filename contains the correct extension
@@ -68,15 +192,23 @@ def _download_mp4_video_from_youtube(
     # that failure mode entirely.
     yt = YouTube(youtube_url, client="WEB_MUSIC")
 
-    # Get stream with video in mp4 format, order by Average Bit Rate and take highest bit rate
-    video = yt.streams.filter(subtype="mp4").order_by("abr").last()
-    video.download(output_path=output_dir, max_retries=NUM_RETRIES, filename=filename)
+    # Get the mp4 stream with the best audio for its size (streams without audio
+    # have no Average Bit Rate and aren't candidates)
+    video = _select_stream(yt.streams.filter(subtype="mp4"), youtube_url, on_stream_selected)
+    with phase("download"):
+        video.download(output_path=output_dir, max_retries=NUM_RETRIES, filename=filename)
 
-    return os.path.join(output_dir, filename)
+    mp4_filepath = os.path.join(output_dir, filename)
+    _log_bytes_transferred(os.path.getsize(mp4_filepath), "video stream")
+    return mp4_filepath
 
 
 def _download_mp4_audio_from_youtube(
-    youtube_url: str, output_dir: str, filename: str
+    youtube_url: str,
+    output_dir: str,
+    filename: str,
+    on_stream_selected: StreamSelectedCallback,
+    yt: Optional[YouTube] = None,
 ) -> str:
     """This function downloads an mp4 audio stream from youtube."""
     # Ensure the filename contains the correct extension
@@ -85,37 +217,186 @@ def _download_mp4_audio_from_youtube(
 
     print(f"\nDownloading '{filename.rstrip(FILE_EXTENSION_MP4)}'")
 
-    yt = YouTube(youtube_url, client="WEB_MUSIC")
+    if yt is None:
+        yt = YouTube(youtube_url, client="WEB_MUSIC")
+    audio = _get_best_audio_stream(yt, youtube_url, on_stream_selected)
+    with phase("download"):
+        audio.download(output_path=output_dir, max_retries=NUM_RETRIES, filename=filename)
+
+    mp4_filepath = os.path.join(output_dir, filename)
+    transferred_bytes = os.path.getsize(mp4_filepath)
+    try:
+        _verify_audio_download(mp4_filepath, transferred_bytes, audio.filesize, yt.length)
+    except Exception:
+        os.remove(mp4_filepath)
+        raise
+    _log_bytes_transferred(transferred_bytes, "audio-only stream")
+    return mp4_filepath
+
+
+def _stream_audio_from_youtube_to_m4a(
+    youtube_url: str,
+    output_dir: str,
+    filename: str,
+    on_stream_selected: StreamSelectedCallback,
+    metadata_args: List[str],
+    yt: Optional[YouTube] = None,
+) -> str:
+    """Download the best audio-only stream and remux it on the fly: the bytes go
+    from pytubefix straight into ffmpeg's stdin, and ffmpeg writes the clean
+    .m4a. The fragmented DASH file is never written to disk, which halves the
+    writes per track - noticeable on slow USB sticks and SD cards.
+
+    The ffmpeg arguments match _remux_to_clean_m4a's (the explicit `ipod` muxer
+    is what ffmpeg picks there from the .m4a extension), so the result is the
+    same file the two-step path produces. ffmpeg writes to a `.part` file that
+    is only renamed to the final name once it's complete and verified, so an
+    interrupted download never looks finished to a later skip check.
+    """
+    filename = filename.removesuffix(FILE_EXTENSION_MP4)
+    print(f"\nDownloading '{filename}'")
+
+    if yt is None:
+        yt = YouTube(youtube_url, client="WEB_MUSIC")
+    audio = _get_best_audio_stream(yt, youtube_url, on_stream_selected)
+
+    m4a_filepath = os.path.join(output_dir, filename + FILE_EXTENSION_M4A)
+    part_filepath = m4a_filepath + FILE_EXTENSION_PART
+    process = subprocess.Popen(
+        [
+            _get_ffmpeg_exe(),
+            "-v",
+            "error",
+            "-y",
+            "-i",
+            "pipe:0",
+            "-map",
+            "0:a:0",
+            "-c",
+            "copy",
+            "-movflags",
+            "+faststart",
+            *metadata_args,
+            "-f",
+            "ipod",
+            part_filepath,
+        ],
+        stdin=subprocess.PIPE,
+    )
+    assert process.stdin is not None  # Always set with stdin=PIPE.
+    writer = _CountingWriter(process.stdin)
+    try:
+        # Downloading and remuxing overlap here, so they're timed as one phase.
+        with phase("download"):
+            audio.stream_to_buffer(writer)
+            process.stdin.close()
+            return_code = process.wait()
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, "ffmpeg")
+        _verify_audio_download(part_filepath, writer.bytes_written, audio.filesize, yt.length)
+        os.replace(part_filepath, m4a_filepath)
+    except BaseException:
+        process.kill()
+        process.wait()
+        if os.path.exists(part_filepath):
+            os.remove(part_filepath)
+        raise
+
+    _log_bytes_transferred(writer.bytes_written, "audio-only stream, piped into the remux")
+    return m4a_filepath
 
-    # Get stream with only audio in mp4 format, order by Average Bit Rate and take highest bit rate
-    video = yt.streams.filter(only_audio=True, subtype="mp4").order_by("abr").last()
 
-    video.download(output_path=output_dir, max_retries=NUM_RETRIES, filename=filename)
+class _CountingWriter:
+    """Write-only file-like wrapper that counts the bytes passed through it, since
+    a piped download leaves no file behind to measure."""
 
-    return os.path.join(output_dir, filename)
+    def __init__(self, buffer: IO[bytes]):
+        self._buffer = buffer
+        self.bytes_written = 0
 
+    def write(self, data: bytes) -> int:
+        self._buffer.write(data)
+        self.bytes_written += len(data)
+        return len(data)
 
-def _extract_audio_from_mp4_video(video_filepath: str) -> str:
-    """This function extracts the audio of an mp4 video."""
-    if not video_filepath.endswith(FILE_EXTENSION_MP4):
-        raise ValueError(f"Input video is not in mp4 format: {video_filepath}")
 
-    output_filename = video_filepath.replace(FILE_EXTENSION_MP4, FILE_EXTENSION_MP3)
+def _get_best_audio_stream(
+    yt: YouTube, youtube_url: str, on_stream_selected: StreamSelectedCallback
+):
+    """Audio-only stream in mp4 format with the best audio for its size."""
+    return _select_stream(
+        yt.streams.filter(only_audio=True, subtype="mp4"), youtube_url, on_stream_selected
+    )
+
+
+def _select_stream(streams, youtube_url: str, on_stream_selected: StreamSelectedCallback):
+    candidate = select_stream(get_youtube_candidates(streams))
+    if candidate is None:
+        raise CorruptAudioDownloadError(f"No mp4 stream with audio available for {youtube_url}")
+    if on_stream_selected is not None:
+        on_stream_selected(candidate)
+    return candidate.stream
+
+
+def _verify_audio_download(
+    media_filepath: str, transferred_bytes: int, expected_bytes: int, expected_duration_s: int
+) -> None:
+    """Check a direct audio-only download for the corruption it's prone to: a
+    truncated transfer (fewer bytes received than the stream advertises), or a
+    file whose audio doesn't cover the video's length. Raises
+    CorruptAudioDownloadError if either check fails."""
+    if expected_bytes and transferred_bytes != expected_bytes:
+        raise CorruptAudioDownloadError(
+            f"Incomplete download: {transferred_bytes} of {expected_bytes} bytes"
+        )
+    actual_duration_s = _get_media_duration_s(media_filepath)
+    if actual_duration_s is None:
+        raise CorruptAudioDownloadError("Unreadable audio stream: ffmpeg reports no duration")
+    if expected_duration_s and abs(actual_duration_s - expected_duration_s) > DURATION_TOLERANCE_SECONDS:
+        raise CorruptAudioDownloadError(
+            f"Audio lasts {actual_duration_s:.0f}s but the video is {expected_duration_s}s long"
+        )
+
+
+def _log_bytes_transferred(num_bytes: int, stream_kind: str) -> None:
+    add_bytes(num_bytes)
+    print(f"Transferred {num_bytes / 1_000_000:.1f} MB ({stream_kind})")
+
 
-    video_clip = VideoFileClip(video_filepath)
-    audio_clip = video_clip.audio
-    audio_clip.write_audiofile(output_filename, codec="mp3")
-    video_clip.close()
+def _extract_audio_from_mp4_video(video_filepath: str, metadata_args: List[str]) -> str:
+    """This function extracts the audio of an mp4 video.
 
-    return output_filename
+    The AAC audio track is stream-copied out of the video into an .m4a - no
+    decoding, no re-encoding - exactly like `_remux_to_clean_m4a` does for
+    audio-only downloads (it maps only the first audio stream, so the video
+    track is simply left behind). Any transcoding happens once, later, in the
+    conversion step, instead of adding a lossy MP3 generation here.
+    """
+    if not video_filepath.endswith(FILE_EXTENSION_MP4):
+        raise ValueError(f"Input video is not in mp4 format: {video_filepath}")
 
+    return _remux_to_clean_m4a(video_filepath, metadata_args)
 
-def _is_mp4_file_audio_only(mp4_filepath: str) -> bool:
-    """This function checks whether an mp4 file is audio only."""
-    return not ffmpeg_parse_infos(mp4_filepath)["video_found"]
+
+def _get_media_duration_s(filepath: str) -> Optional[float]:
+    """Duration of a media file in seconds, as reported by ffmpeg's input summary,
+    or None if ffmpeg can't read one from it."""
+    # Without an output file ffmpeg just describes the input and exits with an
+    # error status, so the return code carries no information here.
+    result = subprocess.run(
+        [_get_ffmpeg_exe(), "-hide_banner", "-i", filepath],
+        capture_output=True,
+        text=True,
+        errors="replace",
+    )
+    match = _FFMPEG_DURATION_PATTERN.search(result.stderr)
+    if match is None:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
 
 
-def _remux_to_clean_m4a(mp4_filepath: str) -> str:
+def _remux_to_clean_m4a(mp4_filepath: str, metadata_args: List[str]) -> str:
     """Remux a downloaded audio-only MP4 into a standard .m4a container.
 
     YouTube serves audio-only streams as fragmented DASH MP4 (a `sidx` index
@@ -127,27 +408,37 @@ def _remux_to_clean_m4a(mp4_filepath: str) -> str:
 
     Remuxing with ffmpeg (`-c copy`) rewrites only the container: the AAC audio
     stream is copied bit-for-bit, so the operation is lossless and takes well
-    under a second per file.
+    under a second per file. `metadata_args` (see get_ffmpeg_metadata_args) tag
+    the file in the same pass.
     """
     m4a_filepath = os.path.splitext(mp4_filepath)[0] + FILE_EXTENSION_M4A
-    subprocess.run(
-        [
-            _get_ffmpeg_exe(),
-            "-v",
-            "error",
-            "-y",
-            "-i",
-            mp4_filepath,
-            "-map",
-            "0:a:0",
-            "-c",
-            "copy",
-            "-movflags",
-            "+faststart",
-            m4a_filepath,
-        ],
-        check=True,
-    )
+    try:
+        with phase("remux"):
+            subprocess.run(
+                [
+                    _get_ffmpeg_exe(),
+                    "-v",
+                    "error",
+                    "-y",
+                    "-i",
+                    mp4_filepath,
+                    "-map",
+                    "0:a:0",
+                    "-c",
+                    "copy",
+                    "-movflags",
+                    "+faststart",
+                    *metadata_args,
+                    m4a_filepath,
+                ],
+                check=True,
+            )
+    except subprocess.CalledProcessError:
+        # Don't leave a half-written .m4a behind for a skip check to mistake for a
+        # finished download.
+        if os.path.exists(m4a_filepath):
+            os.remove(m4a_filepath)
+        raise
     os.remove(mp4_filepath)
     return m4a_filepath
 
@@ -155,7 +446,7 @@ def _remux_to_clean_m4a(mp4_filepath: str) -> str:
 def _get_ffmpeg_exe() -> str:
     """Return the ffmpeg executable to use.
 
-    Prefer the binary bundled with moviepy's imageio-ffmpeg dependency, so the
+    Prefer the binary bundled with imageio-ffmpeg (installed with moviepy), so the
     remux works even without a system-wide ffmpeg installation; fall back to
     ffmpeg on PATH.
     """
@@ -11,6 +11,11 @@ from src.data_handling import (
     find_closest_matching_result,
     get_song_search_string,
 )
+from src.metrics import phase
+from src.rate_limiting import rate_limited
+from src.search_cache import get_search_cache
+
+SEARCH_SOURCE = "youtube"
 
 
 class NoMatchingYoutubeVideoFoundError(Exception):
@@ -18,11 +23,22 @@ class NoMatchingYoutubeVideoFoundError(Exception):
 
 
 def get_youtube_search_results(input_string: str, n_results: int = 5) -> List[dict]:
-    """This function searches a string on youtube, loads and sorts the best 5 potential matches"""
+    """This function searches a string on youtube, loads and sorts the best 5 potential matches.
+    Results are served from the on-disk search cache when this exact search was run before."""
+    return get_search_cache().get_or_fetch(
+        SEARCH_SOURCE,
+        input_string,
+        n_results,
+        lambda: _fetch_youtube_search_results(input_string, n_results),
+    )
+
+
+def _fetch_youtube_search_results(input_string: str, n_results: int) -> List[dict]:
     # Make GET request to youtube
-    raw_results = YoutubeSearch(
-        search_terms=input_string, max_results=n_results
-    ).to_dict()
+    with rate_limited(SEARCH_SOURCE), phase("search"):
+        raw_results = YoutubeSearch(
+            search_terms=input_string, max_results=n_results
+        ).to_dict()
 
     # Extract the relevant data and format it
     formatted_results = [
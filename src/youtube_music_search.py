@@ -3,6 +3,7 @@ source for every track regardless of where the playlist itself came from
 (Spotify or Tidal), replacing youtube_id_search.py's free-text search parsing
 with ytmusicapi's structured results (exact artist name, exact duration in
 seconds) - no login needed, search is fully public."""
+import threading
 from typing import Dict, List, Optional
 
 from ytmusicapi import YTMusic
@@ -13,8 +14,15 @@ from src.data_handling import (
     find_closest_matching_result,
     get_song_search_string,
 )
+from src.http_session import get_http_session
+from src.metrics import phase
+from src.rate_limiting import rate_limited
+from src.search_cache import get_search_cache
+
+SEARCH_SOURCE = "youtube_music"
 
 _ytmusic_search_client: Optional[YTMusic] = None
+_ytmusic_search_client_lock = threading.Lock()
 
 
 class NoMatchingYoutubeMusicVideoFoundError(Exception):
@@ -22,15 +30,26 @@ class NoMatchingYoutubeMusicVideoFoundError(Exception):
 
 
 def _get_search_client() -> YTMusic:
+    """Process-wide client, created on first use by whichever matching worker
+    thread gets there first."""
     global _ytmusic_search_client
-    if _ytmusic_search_client is None:
-        _ytmusic_search_client = YTMusic()
-    return _ytmusic_search_client
+    with _ytmusic_search_client_lock:
+        if _ytmusic_search_client is None:
+            _ytmusic_search_client = YTMusic(requests_session=get_http_session())
+        return _ytmusic_search_client
 
 
 def get_youtube_music_search_results(query: str, limit: int = 5) -> List[dict]:
-    """Search YouTube Music for tracks matching a query."""
-    results = _get_search_client().search(query, filter="songs", limit=limit)
+    """Search YouTube Music for tracks matching a query, served from the on-disk
+    search cache when this exact search was run before."""
+    return get_search_cache().get_or_fetch(
+        SEARCH_SOURCE, query, limit, lambda: _fetch_youtube_music_search_results(query, limit)
+    )
+
+
+def _fetch_youtube_music_search_results(query: str, limit: int) -> List[dict]:
+    with rate_limited(SEARCH_SOURCE), phase("search"):
+        results = _get_search_client().search(query, filter="songs", limit=limit)
     return [
         {
             "video_id": r["videoId"],
@@ -23,6 +23,7 @@ from src.data_handling import (
     COLUMN_TRACK_NAME,
     COLUMN_YOUTUBE_ID,
 )
+from src.http_session import get_http_session
 
 EXPORT_COLUMNS = [
     COLUMN_ARTIST_NAME,
@@ -66,7 +67,7 @@ def export_playlist_to_csv(playlist_id: str, output_path: str) -> Tuple[str, int
     are skipped rather than left Pending: auto-matching them from a
     possibly-wrong title would silently download the wrong thing."""
     try:
-        playlist = YTMusic().get_playlist(playlist_id, limit=None)
+        playlist = YTMusic(requests_session=get_http_session()).get_playlist(playlist_id, limit=None)
     except Exception as exc:
         # ytmusicapi surfaces private/nonexistent playlists as raw KeyErrors
         # from its response navigation, so any failure here gets one message.
@@ -0,0 +1,87 @@
+"""Script to summarize a metrics JSONL file written with `--metrics` (see
+src/metrics.py): p50/p95 wall time per phase, for each stage, plus throughput."""
+import argparse
+import json
+import math
+import sys
+from collections import defaultdict
+from typing import Dict, List
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def load_records(filepath: str) -> List[Dict]:
+    records = []
+    with open(filepath, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A run killed mid-write leaves a partial last line.
+                continue
+    return records
+
+
+def print_summary(records: List[Dict]) -> None:
+    records_by_stage: Dict[str, List[Dict]] = defaultdict(list)
+    for record in records:
+        records_by_stage[record["stage"]].append(record)
+
+    for stage, stage_records in records_by_stage.items():
+        n_failed = sum(1 for record in stage_records if not record["ok"])
+        print(f"\n{stage}: {len(stage_records)} track(s), {n_failed} failed")
+
+        seconds_by_phase: Dict[str, List[float]] = defaultdict(list)
+        for record in stage_records:
+            for phase_name, seconds in record["phases"].items():
+                seconds_by_phase[phase_name].append(seconds)
+            seconds_by_phase["total"].append(record["total_s"])
+
+        print(f"  {'phase':<24}{'count':>7}{'p50 (s)':>10}{'p95 (s)':>10}{'sum (s)':>10}")
+        # Slowest phases first; the overall total always last.
+        phase_names = sorted(
+            (name for name in seconds_by_phase if name != "total"),
+            key=lambda name: -sum(seconds_by_phase[name]),
+        ) + ["total"]
+        for phase_name in phase_names:
+            values = sorted(seconds_by_phase[phase_name])
+            print(
+                f"  {phase_name:<24}{len(values):>7}{percentile(values, 0.5):>10.2f}"
+                f"{percentile(values, 0.95):>10.2f}{sum(values):>10.1f}"
+            )
+
+        throughputs = sorted(
+            record["throughput_bytes_per_s"]
+            for record in stage_records
+            if record.get("throughput_bytes_per_s")
+        )
+        if throughputs:
+            total_mb = sum(record["bytes"] for record in stage_records) / 1_000_000
+            print(
+                f"  throughput: p50 {percentile(throughputs, 0.5) / 1_000_000:.2f} MB/s, "
+                f"p95 {percentile(throughputs, 0.95) / 1_000_000:.2f} MB/s, "
+                f"{total_mb:.1f} MB transferred"
+            )
+
+
+def main():
+    """Read a metrics file and print a per-stage, per-phase summary."""
+    parser = argparse.ArgumentParser(
+        description="Summarize per-track timing metrics written with --metrics."
+    )
+    parser.add_argument("file_path", help="Path to the metrics JSONL file", type=str)
+    args = parser.parse_args()
+
+    records = load_records(args.file_path)
+    if not records:
+        print(f"No metrics records found in {args.file_path}")
+        sys.exit(1)
+    print_summary(records)
+
+
+if __name__ == "__main__":
+    main()